@@ -9,7 +9,11 @@
 #
 # The function is invoked by a PubSub topic triggered by the Cloud Build. We do
 # the trimming only on successful completion of a build which has pushed any
-# image. We still look at all images, just in case a previous run has failed.
+# image, and only in the repositories of the images it has pushed, so that the
+# cost of a run is proportional to what the build has pushed, not to the size of
+# the registry. Any other message, e.g., an empty one published by hand or on a
+# schedule, triggers the full sweep of all repositories, which also catches up
+# with anything a failed run has missed.
 #
 # This machinery is well below the GCP free tier limit, and cost you nothing.
 # The only caveat is to deploy it in the same multiregion (roughly, continent)
@@ -27,11 +31,47 @@
 # the Docker registry API (which Google just redirects to Docker), nor for the
 # runtimeconfig API, which is in beta and does not have a client support
 # (yet?). Everything is handled using REST APIs with the requests library.
-
-import base64, json, requests, sys
+#
+# After a large rebuild there may be hundreds of untagged images, and deleting
+# them one by one may outlive the function timeout. Repositories are listed and
+# images deleted concurrently, by up to MAX_WORKERS requests at once. Registry
+# requests are retried with exponential backoff and jitter on 429 and 5xx
+# responses and on connection errors, and registry tokens are obtained once per
+# repository, and again only if rejected with a 401.
+#
+# Miller stamps images with the build key as an extra 'bk-<key>' tag (see
+# libexec/miller.py). Such a tag does not make an image live: a manifest whose
+# tags all begin with BUILDKEY_TAG has been superseded by a rebuild, and is
+# deleted as untagged, its 'bk-' tags first, since GCR refuses to delete a
+# tagged manifest.
+#
+# The full sweep walks the registry catalog breadth-first, from the project
+# root down through every level of nested repositories, like project/team/image,
+# following the Docker v2 pagination of listings, and starts deleting untagged
+# images as soon as each page listing them arrives.
+#
+# For testing, set REGISTRY_ENDPOINT in the environment to the base URL of a
+# local registry stub, e.g. 'http://localhost:5000', which then receives all
+# requests that would go to 'https://<location>.gcr.io'.
+
+import base64, json, os, random, requests, sys, threading, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urljoin
+
+MAX_WORKERS = 8       # Concurrent registry requests.
+MAX_ATTEMPTS = 6      # Tries of a registry request before giving up.
+BACKOFF_BASE = 0.5    # Seconds; the cap of the first backoff, then doubled...
+BACKOFF_MAX = 30      # ...up to this many.
+PAGE_SIZE = 100       # Entries per page of a listing, the 'n' parameter.
+REGISTRY_ENDPOINT = os.environ.get('REGISTRY_ENDPOINT')
+BUILDKEY_TAG = 'bk-'  # Same as in libexec/miller.py.
 
 # Globals.
 g_sess = requests.Session()
+g_sess.mount('https://', requests.adapters.HTTPAdapter(
+  pool_maxsize=MAX_WORKERS))
+g_sess.mount('http://', requests.adapters.HTTPAdapter(
+  pool_maxsize=MAX_WORKERS))
 
 # Report a fatal error in context associated with an HTTP response.
 def _failed(resp, reason):
@@ -97,58 +137,193 @@ def _get_location(project, gctoken):
                      f"configuration value 'gs_location'")
 
 
-# Walk all repositories in registry. The registry has its own authentication,
-# which is performed by a separate endpoint. Another notable architecture detail
-# is that each image requires its own separate authentication with a 'push'
-# scope; the whole registry allows only the 'pull' scope to enumerate images.
-# This can be called locally for debugging, as it does not try to access
-# metadata server (or even GCP API libraries) by itself. The GCP registry
-# implements the Docker API v2: https://docs.docker.com/registry/spec/api/.
-def _delete_untagged_images(project, location, gctoken):
-  service=f"{location}.gcr.io"        # Registry service.
-  gcauth={'Authorization': gctoken}   # GCP auth headers.
-
-  # Trade a GCP token for the registry API token for given library and scope.
-  # Return a dict with the Authorization header for the registry.
-  def _authorize(library='', scope='pull'):
+# Perform a registry request, retrying on throttling, server errors and broken
+# connections, with the "full jitter" exponential backoff: sleep a random time
+# up to the cap, which doubles with each attempt. A Retry-After in seconds from
+# the server is honored, if longer. The last response is returned whatever its
+# status, or the last connection error is raised.
+def _retrying(method, url, **kwargs):
+  for attempt in range(MAX_ATTEMPTS):
+    last = attempt == MAX_ATTEMPTS - 1
+    try:
+      resp = g_sess.request(method, url, **kwargs)
+    except requests.ConnectionError:
+      if last: raise
+      resp = None
+    if resp is not None and resp.status_code != 429 and resp.status_code < 500:
+      return resp
+    if last:
+      return resp
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+    after = resp is not None and resp.headers.get('Retry-After')
+    if after and after.isdigit():
+      delay = max(delay, min(BACKOFF_MAX, int(after)))
+    time.sleep(delay)
+
+
+# Registry tokens, one per repository and scope. The registry has its own
+# authentication, which is performed by a separate endpoint, where a GCP token
+# is traded for a registry token. Another notable architecture detail is that
+# each image requires its own separate authentication with a 'push' scope; the
+# whole registry allows only the 'pull' scope to enumerate images.
+class _RegistryAuth:
+  def __init__(my, base, service, project, gctoken):
+    my.base = base
+    my.service = service
+    my.project = project
+    my.gcauth = {'Authorization': gctoken}  # GCP auth headers.
+    my.lock = threading.Lock()
+    my.tokens = {}
+
+  # Return a dict with the Authorization header for the registry for given
+  # library and scope. If rejected is given, it is the header that was just
+  # rejected, and a new token is obtained unless another thread already has.
+  def Headers(my, library='', scope='pull', rejected=None):
+    key = (library, scope)
+    with my.lock:
+      auth = my.tokens.get(key)
+    if auth and auth != rejected:
+      return auth
     if library: library = '/' + library
-    resp = g_sess.get((f"https://{service}/v2/token?scope=repository:"
-                       f"{project}{library}:{scope}&service={service}"),
-                      headers=gcauth)
+    resp = _retrying('GET', f"{my.base}/v2/token",
+                     params={'scope': (f"repository:{my.project}{library}:"
+                                       f"{scope}"),
+                             'service': my.service},
+                     headers=my.gcauth)
     _check_2xx(resp)
-    repo_token='Bearer ' + json.loads(resp.text)['token'];
-    return {'Authorization': repo_token}
-
-  # GCP allows only the 'pull', readonly scope at the top level.
-  resp = g_sess.get(f'https://{service}/v2/{project}/tags/list',
-                    headers=_authorize())
+    auth = {'Authorization': 'Bearer ' + json.loads(resp.text)['token']}
+    with my.lock:
+      my.tokens[key] = auth
+    return auth
+
+  # Perform a retrying registry request authorized for library and scope. If
+  # the token is rejected, get a new one and retry once. The url, if given,
+  # replaces the one made of path, e.g., to follow a next page link.
+  def Request(my, method, path, library='', scope='pull', url=None):
+    repo = f"{my.project}/{library}" if library else my.project
+    url = url or f"{my.base}/v2/{repo}/{path}"
+    auth = my.Headers(library, scope)
+    resp = _retrying(method, url, headers=auth)
+    if resp.status_code == 401:
+      auth = my.Headers(library, scope, rejected=auth)
+      resp = _retrying(method, url, headers=auth)
+    return resp
+
+
+# True if the repository path is to be left alone.
+def _excluded(img):
+  # GCF images are stored here upon deployment. Ignore.
+  return img == 'gcf' or img.startswith('gcf/')
+
+
+# Fetch a page of the listing of the repository project/img, or of the project
+# root if img is empty. url is the link to the page, None for the first one.
+# Return a tuple of (untagged * children * next), where untagged is a list of
+# (digest * size in bytes * bk- tags) of untagged images, children are the names
+# of nested repositories, and next is the link to the next page, None if it is
+# the last.
+# The size is from the GCR extension to the tag list, and the children are in
+# the GCR 'child' extension; the size is 0 if the registry does not report it.
+def _list_page(auth, img, url=None):
+  # Authorize with the 'push', R/W scope, since we are deleting images. GCP
+  # allows only the 'pull', readonly scope at the top level, where we delete
+  # nothing anyway.
+  resp = auth.Request('GET', f"tags/list?n={PAGE_SIZE}", img,
+                      'push' if img else 'pull', url=url)
   _check_2xx(resp)
+  listing = json.loads(resp.text)
+  untagged = [(sha, int(man.get('imageSizeBytes') or 0), man['tag'])
+              for sha, man in (listing.get('manifest') or {}).items()
+              if all(t.startswith(BUILDKEY_TAG) for t in man['tag'])]
+  nextpage = resp.links.get('next', {}).get('url')
+  return (untagged if img else [], listing.get('child') or [],
+          nextpage and urljoin(resp.url, nextpage))
+
+
+# Delete the image project/img@sha, after deleting its build key tags, if any.
+# Return True if deleted, False if it has been already gone, e.g., deleted by a
+# concurrent run.
+def _delete_image(auth, img, sha, tags=()):
+  print(f"Deleting untagged image {auth.project}/{img}@{sha}")
+  for tag in tags:
+    resp = auth.Request('DELETE', f"manifests/{tag}", img, 'push')
+    if resp.status_code != 404:
+      _check_2xx(resp, only200 = False)
+  resp = auth.Request('DELETE', f"manifests/{sha}", img, 'push')
+  if resp.status_code == 404:
+    return False
+  _check_2xx(resp, only200 = False)  # Expect 200 or 202 on success.
+  return True
 
-  images=json.loads(resp.text)['child']
-  delcount = 0
-  for img in images:
-    if img == 'gcf':  # GCF images are stored here upon deployment. Ignore.
-      continue
-    # Authorize with the 'push', R/W scope, since we are deleting images.
-    auth = _authorize(img, 'push')
-    resp = g_sess.get(f'https://{service}/v2/{project}/{img}/tags/list',
-                      headers=auth)
-    _check_2xx(resp)
-    versions=json.loads(resp.text).get('manifest')
-    if not versions:
-      continue  # Maybe a deeper-nested image. We don't use them, GCP does.
-
-    for sha, man in iter(versions.items()):
-      if man['tag'] == []:  # Better be explicit than sorry.
-        print(f"Deleting untagged image {project}/{img}@{sha}")
-        resp = g_sess.delete(
-          f'https://{service}/v2/{project}/{img}/manifests/{sha}',
-          headers=auth)
-        _check_2xx(resp, only200 = False)  # Expect 200 or 202 on success.
-        delcount += 1
 
-  if not delcount:
-    print(f"No untagged images were found in {service}/{project}/{images}")
+# Delete untagged images in the repositories images of the project, e.g.,
+# ['cxx', 'kaldi'], or in all repositories in registry if images is None. This
+# can be called locally for debugging, as it does not try to access metadata
+# server (or even GCP API libraries) by itself. The GCP registry implements the
+# Docker API v2: https://docs.docker.com/registry/spec/api/.
+def _delete_untagged_images(project, location, gctoken, images=None):
+  service = f"{location}.gcr.io"  # Registry service.
+  auth = _RegistryAuth(REGISTRY_ENDPOINT or f"https://{service}", service,
+                       project, gctoken)
+
+  # Listings of pages and deletions share the pool. Each deletion is submitted
+  # as soon as the page listing the image arrives, the next page of a listing as
+  # soon as its link is known, and with the full sweep, the listing of a nested
+  # repository as soon as it is seen, which makes the walk breadth-first. A
+  # manifest may show up on more than one page; it is deleted once. Failures do
+  # not stop the other requests; the first one is raised in the end, after the
+  # summary is printed.
+  walk = images is None
+  repos = set() if walk else {img for img in images if not _excluded(img)}
+  deleted, gone, nbytes, errors = 0, 0, 0, []
+  seen = set()
+  start = time.monotonic()
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+    pending = {}
+    def list_page(img, url=None):
+      pending[pool.submit(_list_page, auth, img, url)] = ('list', img)
+
+    for img in [''] if walk else sorted(repos):
+      list_page(img)
+    while pending:
+      done, __ = wait(pending, return_when=FIRST_COMPLETED)
+      for f in done:
+        what, arg = pending.pop(f)
+        try:
+          res = f.result()
+        except Exception as e:
+          errors.append(e)
+          continue
+        if what == 'delete':
+          if res:
+            deleted += 1
+            nbytes += arg
+          else:
+            gone += 1
+          continue
+        untagged, children, nextpage = res
+        if nextpage:
+          list_page(arg, nextpage)
+        for sha, size, tags in untagged:
+          if (arg, sha) not in seen:
+            seen.add((arg, sha))
+            pending[pool.submit(_delete_image, auth, arg, sha,
+                                tags)] = ('delete', size)
+        for child in children if walk else ():
+          child = f"{arg}/{child}" if arg else child
+          if child not in repos and not _excluded(child):
+            repos.add(child)
+            list_page(child)
+
+  if not (seen or errors):
+    print(f"No untagged images were found in {len(repos)} repositories of "
+          f"{service}/{project}")
+  else:
+    print(f"Deleted {deleted} untagged images of {nbytes/2**20:.1f} MiB from "
+          f"{len(repos)} repositories in {time.monotonic() - start:.1f}s; "
+          f"{gone} were already gone, {len(errors)} requests failed")
+  if errors:
+    raise errors[0]
 
 
 # This is used if we have no idea where the message came from. Obtain all IDs in
@@ -181,26 +356,38 @@ def delete_untagged_images(evt, ctx):
     print(f"No new images pushed in build {attrs['buildId']}, skipping cleanup")
     return True
 
-  parts = str.split(images[0], '/')  # ['us.gcr.io', 'projname', 'cxx']
-  project = parts[1]
-  parts = str.split(parts[0], '.')   # ['us', 'gcr', 'io']
-  location = parts[0]
-  if location not in ['us','eu','asia']:
-    raise RuntimeError(f"The target of the image {images[0]} is not pointing " +
-                       f"to one of the known locations ['us','eu','asia']. " +
-                       f"Aborting. BuildId was '{attrs['buildId']}'")
+  # Group the repositories of pushed images by project and location. Images are
+  # named like 'us.gcr.io/projname/cxx:1.0', possibly nested, and with a tag or
+  # a digest, or neither. Images pushed elsewhere than GCR are not our concern.
+  repos = {}
+  for img in images:
+    host, project, repo = (img.split('/', 2) + ['', ''])[:3]
+    repo = repo.partition('@')[0].partition(':')[0]
+    location, dot, domain = host.partition('.')
+    if domain != 'gcr.io' or not (project and repo):
+      print(f"Not cleaning up non-GCR image {img}")
+      continue
+    if location not in ['us','eu','asia']:
+      raise RuntimeError(f"The target of the image {img} is not pointing " +
+                         "to one of the known locations ['us','eu','asia']. " +
+                         f"Aborting. BuildId was '{attrs['buildId']}'")
+    repos.setdefault((project, location), set()).add(repo)
+  if not repos:
+    return True
 
   gctoken = _get_gctoken()
 
-  _delete_untagged_images(project, location, gctoken)
+  for (project, location), rr in sorted(repos.items()):
+    _delete_untagged_images(project, location, gctoken, rr)
   return True
 
 
 # For local debugging.
 if __name__ == '__main__':
-  if len(sys.argv) != 4:
-    exit(f"Usage: {sys.argv[0]} <project> <location> <authtoken>")
+  if len(sys.argv) < 4:
+    exit(f"Usage: {sys.argv[0]} <project> <location> <authtoken> [<repo>...]")
   # If no token type, assume 'Bearer'.
   token = sys.argv[3]
   if ' ' not in token: token = 'Bearer ' + token
-  _delete_untagged_images(sys.argv[1], sys.argv[2], token)
+  _delete_untagged_images(sys.argv[1], sys.argv[2], token,
+                          sys.argv[4:] or None)
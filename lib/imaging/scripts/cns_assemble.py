@@ -0,0 +1,845 @@
+#!/usr/bin/env python3
+# -*- python-indent-offset: 2; -*-
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2020 Kirill 'kkm' Katsnelson
+
+# Assemble the CNS disk from the artifacts listed in the manifest produced by
+# 'miller.py --gather'. The manifest has 4 tokens per line, of which the 3rd
+# and the 4th are the kind and location of the artifact, e.g.:
+#
+#   srilm 1.7.3 gs gs://somebucket/tarballs/srilm.tar.gz#1578015192714080
+#   mkl 2019.5 image us.gcr.io/my-project/mkl:2019.5
+#
+# Only the opt/ (or ./opt/) subtree of every artifact is extracted into the
+# target directory, which is the mount point of the CNS disk, so that the
+# files land under <target>/opt.
+#
+# Tarballs are read from GCS. Images are pulled straight from the registry v2
+# API, without Docker: the manifest is resolved (picking the linux/amd64 image
+# from a manifest list), and each layer blob is streamed and applied on top of
+# the lower ones, with the OCI whiteouts and opaque directories in it removing
+# what the lower layers of the same image have put there.
+#
+# All artifacts are downloaded and extracted at the same time, each in its own
+# thread, and all layers of an image are downloaded at the same time, too, but
+# applied in order. Each tarball or layer is read in --chunk-size ranges, a few
+# of which are fetched ahead by a pool of --jobs connections shared by all of
+# them, and the chunks are fed in order through the decompressor to the tar
+# reader. Nothing touches the disk except the extracted files, and the memory
+# held by the chunks in flight is bounded by --memory. The checksum of every
+# object and blob is computed as it streams, and verified when it has been read
+# in full. A failed range request is retried, not the whole download.
+#
+# Files of different artifacts do not normally overlap (except directories),
+# but if they do, the artifact later in the manifest wins, as it would if they
+# were extracted one by one in order, images first, then tarballs. Each file is
+# extracted under a temporary name, and renamed into place only if no later
+# artifact has written it.
+#
+# This script runs on the stock Ubuntu image of the assembly VM, and must use
+# only the standard library of Python 3.6. The CRC32C computed in Python is
+# very slow, so a C implementation is used if there is one (the google_crc32c
+# module, or crcmod with its extension, which gsutil uses), and absent it, the
+# MD5 is checked instead, if the object has one; all but composite objects do.
+# Layers are checked against their SHA-256 digest.
+#
+# Requests are authenticated with the token of the VM service account from the
+# metadata server; the registry gets it in exchange for its own token. Options
+# --endpoint and --registry-endpoint (or CNS_GCS_ENDPOINT and
+# CNS_REGISTRY_ENDPOINT in the environment) point the assembler to different
+# API servers, such as the stand-ins in maint/cnsbench.py, and --anonymous
+# tells it not to bother with credentials.
+
+import argparse as ap
+import base64
+import collections
+import functools
+import hashlib
+import http.client
+import io
+import json
+import os
+import random
+import re
+import sys
+import tarfile
+import threading
+import time
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional as Opt, Tuple
+from urllib.parse import quote, urlencode, urljoin, urlsplit
+
+GCS_ENDPOINT = 'https://storage.googleapis.com'
+METADATA_TOKEN = ('http://metadata.google.internal/computeMetadata/v1/'
+                  'instance/service-accounts/default/token')
+MiB = 1024 * 1024
+CHUNK_SIZE = 16 * MiB
+MEMORY = 512 * MiB
+JOBS = 16
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+TIMEOUT = 60
+
+ME = os.path.basename(sys.argv[0])
+
+def _Say(*args) -> None:
+  print(f"{ME}:", *args, file=sys.stderr, flush=True)
+
+class AssemblyError(Exception): pass
+
+#----- Checksums. --------------------------------------------------------------
+
+def _MakeCrc32cTable() -> List[int]:
+  table = []
+  for i in range(256):
+    c = i
+    for __ in range(8):
+      c = (c >> 1) ^ (0x82F63B78 if c & 1 else 0)
+    table.append(c)
+  return table
+
+_CRC32C_TABLE = _MakeCrc32cTable()
+
+def Crc32c(data:bytes, crc:int=0) -> int:
+  "CRC32C of data, continuing from crc, computed in Python. Some 10MB/s."
+  table = _CRC32C_TABLE
+  crc ^= 0xFFFFFFFF
+  for b in data:
+    crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+  return crc ^ 0xFFFFFFFF
+
+# Return a C implementation of Crc32c(), if one is available.
+def _FindFastCrc32c() -> Opt[Callable[..., int]]:
+  try:
+    import google_crc32c
+    if google_crc32c.implementation == 'c':
+      return lambda data, crc=0: google_crc32c.extend(crc, data)
+  except (ImportError, AttributeError):
+    pass
+  try:
+    import crcmod
+    import crcmod.predefined
+    if crcmod.crcmod._usingExtension:  # pylint: disable=protected-access
+      return crcmod.predefined.mkPredefinedCrcFun('crc-32c')
+  except (ImportError, AttributeError):
+    pass
+  return None
+
+FAST_CRC32C = _FindFastCrc32c()
+
+
+class Checksum:
+  """Running checksum of a GCS object or a registry blob.
+
+  meta is either the object resource with the 'crc32c' and 'md5Hash' fields,
+  base64 encoded, as GCS reports them, and then CRC32C or MD5 is checked,
+  whichever is cheaper; or the layer descriptor with the 'digest' field, and
+  then it is checked. If none is present, nothing is checked.
+  """
+  def __init__(my, meta:dict):
+    my.kind, my._expect = None, None
+    crc, md5 = meta.get('crc32c'), meta.get('md5Hash')
+    digest = meta.get('digest', '')
+    if digest.startswith('sha256:'):
+      my.kind, my._expect = 'sha256', digest
+      my._hash = hashlib.sha256()
+    elif crc and (FAST_CRC32C or not md5):
+      my.kind, my._expect = 'crc32c', crc
+      my._crcfun, my._crc = FAST_CRC32C or Crc32c, 0
+    elif md5:
+      my.kind, my._expect = 'md5', md5
+      my._hash = hashlib.md5()
+
+  def Update(my, data:bytes) -> None:
+    if my.kind == 'crc32c':
+      my._crc = my._crcfun(data, my._crc)
+    elif my.kind:
+      my._hash.update(data)
+
+  def Digest(my) -> Opt[str]:
+    "The checksum of the data so far, encoded the same way as it is expected."
+    if my.kind == 'crc32c':
+      return base64.b64encode(my._crc.to_bytes(4, 'big')).decode()
+    if my.kind == 'md5':
+      return base64.b64encode(my._hash.digest()).decode()
+    if my.kind == 'sha256':
+      return f"sha256:{my._hash.hexdigest()}"
+    return None
+
+  def Verify(my, what:str) -> None:
+    if my.kind and my.Digest() != my._expect:
+      raise AssemblyError(f"{my.kind} mismatch for {what}: expected "
+                          f"{my._expect}, computed {my.Digest()}")
+
+#----- HTTP access. ------------------------------------------------------------
+
+class _Retry(Exception): pass
+
+class _HttpClient:
+  """Retrying GETs over keep-alive connections, one per thread and server.
+
+  Each request is authorized by the callable auth(challenge), called first with
+  challenge=None, and, if the server replies 401, once again with the value of
+  its WWW-Authenticate header. It returns the Authorization header to send, or
+  None to send none.
+  """
+  def __init__(my):
+    my._local = threading.local()
+
+  def _Connection(my, scheme:str, netloc:str) -> http.client.HTTPConnection:
+    conns = my._local.__dict__.setdefault('conns', {})
+    conn = conns.get((scheme, netloc))
+    if not conn:
+      cls = (http.client.HTTPSConnection if scheme == 'https' else
+             http.client.HTTPConnection)
+      conn = conns[scheme, netloc] = cls(netloc, timeout=TIMEOUT)
+    return conn
+
+  def _Drop(my, scheme:str, netloc:str) -> None:
+    conn = my._local.__dict__.get('conns', {}).pop((scheme, netloc), None)
+    if conn:
+      conn.close()
+
+  # Send a GET request, and return the response status, headers and body.
+  # Connection errors, 429 and 5xx responses are retried with a full jitter
+  # exponential backoff, and a 401 once with a fresh authorization. Redirects
+  # are returned as they are. Only the path is logged, as the query of a signed
+  # URL is a credential.
+  def _Request(my, url:str, headers:Opt[dict]=None,
+               auth:Opt[Callable[..., Opt[str]]]=None
+               ) -> Tuple[int,http.client.HTTPMessage,bytes]:
+    u = urlsplit(url)
+    path = u.path + (f"?{u.query}" if u.query else '')
+    challenge = None
+    for attempt in range(MAX_ATTEMPTS):
+      hdrs = dict(headers or {})
+      authz = auth and auth(challenge=challenge)
+      if authz:
+        hdrs['Authorization'] = authz
+      try:
+        conn = my._Connection(u.scheme, u.netloc)
+        conn.request('GET', path, headers=hdrs)
+        resp = conn.getresponse()
+        body = resp.read()
+        if resp.status == 401 and auth and challenge is None:
+          challenge = resp.getheader('WWW-Authenticate', '')
+          continue
+        if resp.status == 429 or resp.status >= 500:
+          raise _Retry(f"HTTP {resp.status}")
+        return resp.status, resp.headers, body
+      except (OSError, http.client.HTTPException, _Retry) as e:
+        my._Drop(u.scheme, u.netloc)
+        if attempt + 1 >= MAX_ATTEMPTS:
+          raise AssemblyError(f"GET {u.path} failed: {e}") from e
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+        _Say(f"Retrying GET {u.path} in {delay:.1f}s after error: {e}")
+        time.sleep(delay)
+    raise AssemblyError(f"GET {u.path} failed: authorization rejected")
+
+
+# Return the bytes [start, end) of a ranged GET response body.
+def _Slice(what:str, status:int, body:bytes, start:int, end:int) -> bytes:
+  if status not in (200, 206):
+    raise AssemblyError(f"Cannot read {what}: HTTP {status} {body[:200]!r}")
+  if status == 200:  # The whole object; happens if the range covers it.
+    body = body[start:end]
+  if len(body) != end - start:
+    raise AssemblyError(f"Short read of {what} at {start}: "
+                        f"{len(body)} of {end - start} bytes")
+  return body
+
+
+class MetadataToken:
+  "Callable returning the VM service account token, cached until near expiry."
+  def __init__(my):
+    my._lock = threading.Lock()
+    my._token, my._expires = None, 0
+
+  def __call__(my, refresh:bool=False) -> str:
+    with my._lock:
+      if refresh or time.time() > my._expires - 60:
+        req = urllib.request.Request(METADATA_TOKEN,
+                                     headers={'Metadata-Flavor': 'Google'})
+        with urllib.request.urlopen(req, timeout=TIMEOUT) as resp:
+          tok = json.loads(resp.read().decode())
+        my._token = tok['access_token']
+        my._expires = time.time() + int(tok.get('expires_in', 300))
+      return my._token
+
+#----- GCS access. -------------------------------------------------------------
+
+class GcsClient(_HttpClient):
+  """Minimal GCS JSON API client.
+
+  token: a callable returning a bearer token, called again with refresh=True
+         if the token is rejected; or None to send requests unauthenticated.
+  """
+  def __init__(my, endpoint:Opt[str]=None,
+               token:Opt[Callable[..., str]]=None):
+    super().__init__()
+    my._base = (endpoint or GCS_ENDPOINT).rstrip('/') + '/storage/v1'
+    my._token = token
+
+  def _Auth(my, challenge:Opt[str]=None) -> str:
+    return f"Bearer {my._token(refresh=challenge is not None)}"
+
+  def _Get(my, path:str, headers:Opt[dict]=None) -> Tuple[int,bytes]:
+    status, __, body = my._Request(my._base + path, headers,
+                                   my._Auth if my._token else None)
+    return status, body
+
+  def _Path(my, bucket:str, name:str) -> str:
+    return f"/b/{quote(bucket, safe='')}/o/{quote(name, safe='')}"
+
+  def GetObject(my, bucket:str, name:str, generation:Opt[int]) -> dict:
+    "Return the object resource, with only the fields we need."
+    query = '?fields=size,generation,crc32c,md5Hash'
+    if generation:
+      query += f"&generation={generation}"
+    status, body = my._Get(my._Path(bucket, name) + query)
+    if status != 200:
+      raise AssemblyError(f"Cannot get gs://{bucket}/{name}#{generation}: "
+                          f"HTTP {status} {body[:200]!r}")
+    return json.loads(body.decode())
+
+  def ReadRange(my, bucket:str, name:str, generation:int,
+                start:int, end:int) -> bytes:
+    "Return the bytes [start, end) of the object's generation."
+    path = (my._Path(bucket, name) +
+            f"?alt=media&generation={generation}")
+    status, body = my._Get(path, {'Range': f"bytes={start}-{end - 1}"})
+    return _Slice(f"gs://{bucket}/{name}#{generation}", status, body,
+                  start, end)
+
+#----- Registry access. --------------------------------------------------------
+
+# Accept all manifest kinds that miller.py accepts, so that the registry does
+# not try to convert the manifest to the schema 1.
+MANIFEST_ACCEPT = ', '.join((
+  'application/vnd.docker.distribution.manifest.v2+json',
+  'application/vnd.docker.distribution.manifest.list.v2+json',
+  'application/vnd.oci.image.manifest.v1+json',
+  'application/vnd.oci.image.index.v1+json'))
+
+# The platform picked from a manifest list (OCI index).
+PLATFORM = ('linux', 'amd64')
+
+_REDIRECTS = frozenset((301, 302, 303, 307, 308))
+
+class RegistryClient(_HttpClient):
+  """Minimal registry v2 API client, only what is needed to pull an image.
+
+  endpoint: replaces https://<registry> in all requests, if given.
+  token: a callable returning the VM service account token, which is traded
+         for registry tokens when the registry asks for them; or None to ask
+         for anonymous registry tokens.
+  """
+  def __init__(my, endpoint:Opt[str]=None,
+               token:Opt[Callable[..., str]]=None):
+    super().__init__()
+    my._endpoint = endpoint and endpoint.rstrip('/')
+    my._token = token
+    my._regtokens = {}  # (registry, repo) => Authorization header.
+    my._locations = {}  # Blob digest => the URL the registry redirected to.
+
+  def _Url(my, registry:str, repo:str, path:str) -> str:
+    return f"{my._endpoint or 'https://' + registry}/v2/{repo}/{path}"
+
+  # Answer the WWW-Authenticate challenge of the registry, and return the
+  # Authorization header. GCR and Artifact Registry accept the user
+  # 'oauth2accesstoken' with an access token for the password, either right
+  # away with the Basic scheme, or at the token endpoint of the Bearer scheme.
+  def _Answer(my, challenge:str) -> Opt[str]:
+    scheme, __, params = challenge.partition(' ')
+    basic = my._token and 'Basic ' + base64.b64encode(
+      f"oauth2accesstoken:{my._token()}".encode()).decode()
+    if scheme.lower() == 'basic':
+      return basic
+    params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+    realm = params.pop('realm', None)
+    if scheme.lower() != 'bearer' or not realm:
+      raise AssemblyError(f"Unsupported registry challenge '{challenge}'")
+    url = realm + ('&' if '?' in realm else '?') + urlencode(params)
+    status, __, body = my._Request(url, {'Authorization': basic}
+                                   if basic else None)
+    if status != 200:
+      raise AssemblyError(f"Cannot get registry token from {realm}: "
+                          f"HTTP {status} {body[:200]!r}")
+    tok = json.loads(body.decode())
+    return f"Bearer {tok.get('token') or tok['access_token']}"
+
+  # The auth callable for the repository: the cached registry token, or a new
+  # one if the registry has rejected it.
+  def _Auth(my, registry:str, repo:str) -> Callable[..., Opt[str]]:
+    def auth(challenge:Opt[str]=None) -> Opt[str]:
+      if challenge is not None:
+        my._regtokens[registry, repo] = my._Answer(challenge)
+      return my._regtokens.get((registry, repo))
+    return auth
+
+  def GetManifest(my, registry:str, repo:str, ref:str) -> dict:
+    """Return the image manifest of repo:ref, or repo@ref if ref is a digest.
+
+    If it is a manifest list (or an OCI index), the manifest of the PLATFORM
+    image it lists is returned.
+    """
+    bydigest = ref.startswith('sha256:')
+    what = f"{registry}/{repo}{'@' if bydigest else ':'}{ref}"
+    status, __, body = my._Request(
+      my._Url(registry, repo, f"manifests/{ref}"),
+      {'Accept': MANIFEST_ACCEPT}, my._Auth(registry, repo))
+    if status != 200:
+      raise AssemblyError(f"Cannot get manifest of {what}: "
+                          f"HTTP {status} {body[:200]!r}")
+    if bydigest and f"sha256:{hashlib.sha256(body).hexdigest()}" != ref:
+      raise AssemblyError(f"Digest mismatch for manifest of {what}")
+    manifest = json.loads(body.decode())
+    if 'manifests' in manifest:
+      for m in manifest['manifests']:
+        plat = m.get('platform', {})
+        if (plat.get('os'), plat.get('architecture')) == PLATFORM:
+          return my.GetManifest(registry, repo, m['digest'])
+      raise AssemblyError(f"No {'/'.join(PLATFORM)} image in {what}")
+    if manifest.get('schemaVersion') != 2 or 'layers' not in manifest:
+      raise AssemblyError(f"Unsupported manifest of {what}, schema version "
+                          f"{manifest.get('schemaVersion')}")
+    return manifest
+
+  def ReadBlob(my, registry:str, repo:str, digest:str,
+               start:int, end:int) -> bytes:
+    """Return the bytes [start, end) of the blob.
+
+    GCR and Artifact Registry redirect blob requests to a signed storage URL.
+    It is remembered, and the following ranges are read from it directly,
+    until it expires.
+    """
+    rng = {'Range': f"bytes={start}-{end - 1}"}
+    loc = my._locations.get(digest)
+    if loc:
+      status, __, body = my._Request(loc, rng)
+      if status in (400, 401, 403):
+        loc = None
+    if not loc:
+      url = my._Url(registry, repo, f"blobs/{digest}")
+      status, headers, body = my._Request(url, rng, my._Auth(registry, repo))
+      if status in _REDIRECTS:
+        loc = urljoin(url, headers.get('Location', ''))
+        my._locations[digest] = loc
+        status, __, body = my._Request(loc, rng)
+    return _Slice(f"{registry}/{repo}@{digest}", status, body, start, end)
+
+#----- Streaming reads. --------------------------------------------------------
+
+# A stream of bytes to extract, a tarball or an image layer: what to call it in
+# messages, its size, the function returning its bytes [start, end), and the
+# Checksum to verify it against.
+Blob = collections.namedtuple('Blob', 'what size fetch checksum')
+
+class RangedReader(io.RawIOBase):
+  """Sequential reader of a Blob, fetching up to window chunks ahead.
+
+  The chunks are fetched by the executor, and the first window of them is
+  requested right away. The checksum is updated with each chunk as it is
+  consumed; call Finish() after reading what is needed to read the rest, and
+  verify the checksum. abort is checked before every chunk, so that a failure
+  elsewhere stops the reader soon.
+  """
+  def __init__(my, blob:Blob, executor:ThreadPoolExecutor,
+               chunk:int, window:int, abort:threading.Event):
+    super().__init__()
+    my._fetch, my._what = blob.fetch, blob.what
+    my._executor = executor
+    my._size, my._chunk, my._window = blob.size, chunk, max(1, window)
+    my._checksum, my._abort = blob.checksum, abort
+    my._pending = collections.deque()  # Futures of chunks, in order.
+    my._next = 0                       # Offset of the next chunk to fetch.
+    my._buf = memoryview(b'')          # Unread part of the current chunk.
+    my._Schedule()
+
+  def readable(my) -> bool:
+    return True
+
+  def _Schedule(my) -> None:
+    while len(my._pending) < my._window and my._next < my._size:
+      end = min(my._next + my._chunk, my._size)
+      my._pending.append(my._executor.submit(my._fetch, my._next, end))
+      my._next = end
+
+  def _NextChunk(my) -> bool:
+    if my._abort.is_set():
+      raise AssemblyError(f"Reading {my._what} aborted")
+    my._Schedule()
+    if not my._pending:
+      return False
+    data = my._pending.popleft().result()
+    my._Schedule()
+    my._checksum.Update(data)
+    my._buf = memoryview(data)
+    return True
+
+  def readinto(my, b) -> int:
+    if not my._buf and not my._NextChunk():
+      return 0
+    n = min(len(b), len(my._buf))
+    b[:n] = my._buf[:n]
+    my._buf = my._buf[n:]
+    return n
+
+  def Finish(my) -> None:
+    "Read the rest of the blob, if any, and verify the checksum."
+    my._buf = memoryview(b'')
+    while my._NextChunk():
+      pass
+    my._checksum.Verify(my._what)
+
+  def close(my) -> None:
+    for f in my._pending:
+      f.cancel()
+    my._pending.clear()
+    super().close()
+
+#----- Extraction. -------------------------------------------------------------
+
+# Keep the tar semantics of 'tar x' run by root: owners and modes are restored
+# as archived. Member names are sanitized by us, see _OptName().
+_EXTRACT_ARGS = ({'filter': 'fully_trusted'}
+                 if hasattr(tarfile, 'fully_trusted_filter') else {})
+
+# 'opt/x' or './opt/x' => 'opt/x'. None for anything not under opt/, or with
+# a '..' in the path.
+def _OptName(name:str) -> Opt[str]:
+  while name.startswith('./'):
+    name = name[2:]
+  name = name.rstrip('/')
+  if name != 'opt' and not name.startswith('opt/'):
+    return None
+  if '..' in name.split('/'):
+    return None
+  return name
+
+# Whiteouts in image layers, per the OCI image spec: 'd/.wh.x' hides d/x of
+# the lower layers, and 'd/.wh..wh..opq' hides everything in d of the lower
+# layers, but not d itself. Other '.wh..wh.' names are AUFS internals.
+WH_PREFIX = '.wh.'
+WH_OPAQUE = '.wh..wh..opq'
+
+# If the member name is a whiteout, return the path under opt/ it hides, and
+# whether only the contents of it are hidden; the path is None if nothing under
+# opt/ is hidden. Return None if the name is not a whiteout.
+def _Whiteout(name:str) -> Opt[Tuple[Opt[str],bool]]:
+  head, __, base = name.rstrip('/').rpartition('/')
+  if not base.startswith(WH_PREFIX):
+    return None
+  if base == WH_OPAQUE:
+    # An opaque root hides all of the lower layers, opt/ included.
+    return (_OptName(head) if head not in ('', '.') else 'opt'), True
+  if base.startswith(WH_PREFIX + WH_PREFIX):
+    return None, False
+  base = base[len(WH_PREFIX):]
+  return _OptName(f"{head}/{base}" if head else base), False
+
+
+class Extractor:
+  """Extract the opt/ subtrees of artifacts into root, later artifacts winning.
+
+  Every stream is identified by the index of the artifact in the manifest and
+  of the layer in the image, (artifact, layer), with the layer 0 for tarballs.
+  For every path, the index of the stream that has written it is remembered,
+  and a stream does not overwrite a path written by a later one. Directories
+  are shared, and remember all streams that have put something in them.
+
+  A whiteout removes only what the lower layers of the same image have put in
+  place, and only when nothing else is there, directories. If another artifact
+  has had the same file, it is lost when it has been overwritten by the lower
+  layer. This is an odd overlap, which never happens in practice.
+  """
+  def __init__(my, root:str):
+    my.root = root
+    my._owners = {}  # Path under root => index of the stream.
+    my._dirs = {}    # Directory under root => set of indices of the streams.
+    my._lock = threading.Lock()
+
+  # Claim path for stream index, and call fn() while holding the claim, if
+  # no later stream owns the path.
+  def _Claim(my, index:Tuple[int,int], path:str,
+             fn:Callable[[],None]) -> bool:
+    with my._lock:
+      if my._owners.get(path, (-1, -1)) > index:
+        return False
+      fn()
+      my._owners[path] = index
+      return True
+
+  # Make the directory path and its parents for stream index. Parents may be
+  # created by other artifacts concurrently, and tarfile does not expect them
+  # to pop up, and whiteouts must know not to remove them.
+  def _MakeDirs(my, index:Tuple[int,int], path:str) -> None:
+    with my._lock:
+      d = path
+      while d:
+        my._dirs.setdefault(d, set()).add(index)
+        d = os.path.dirname(d)
+      os.makedirs(os.path.join(my.root, path), exist_ok=True)
+
+  def _Unlink(my, path:str) -> None:
+    full = os.path.join(my.root, path)
+    if os.path.lexists(full) and not os.path.isdir(full):
+      os.unlink(full)
+
+  def Whiteout(my, index:Tuple[int,int], path:str, opaque:bool) -> None:
+    "Remove what the lower layers of the image have put in path, or under it."
+    image, layer = index
+    lower = lambda i: i[0] == image and i[1] < layer
+    hidden = lambda p: p.startswith(path + '/') or (p == path and not opaque)
+    with my._lock:
+      for p in [p for p, i in my._owners.items() if hidden(p) and lower(i)]:
+        my._Unlink(p)
+        del my._owners[p]
+      # Children sort after their parents, so go in reverse.
+      for d in sorted((d for d in my._dirs if hidden(d)), reverse=True):
+        my._dirs[d] = {i for i in my._dirs[d] if not lower(i)}
+        if not my._dirs[d]:
+          del my._dirs[d]
+          try:
+            os.rmdir(os.path.join(my.root, d))
+          except OSError:
+            pass  # The mount point.
+
+  def Extract(my, index:Tuple[int,int], fileobj,
+              layered:bool=False) -> Tuple[int,int]:
+    """Extract the tar stream; return the number of files and their total size.
+
+    If layered, the stream is an image layer, and whiteouts in it are applied
+    to the lower layers of the image instead of being extracted.
+    """
+    nfiles = nbytes = 0
+    with tarfile.open(fileobj=fileobj, mode='r|*', bufsize=MiB) as tf:
+      for m in tf:
+        wh = layered and _Whiteout(m.name)
+        if wh:
+          if wh[0]:
+            my.Whiteout(index, *wh)
+          continue
+        name = _OptName(m.name)
+        if not name:
+          continue
+        m.name = name
+        if m.islnk():
+          m.linkname = _OptName(m.linkname) or m.linkname
+        my._MakeDirs(index, name if m.isdir() else os.path.dirname(name))
+        if m.isdir():
+          tf.extract(m, my.root, **_EXTRACT_ARGS)
+        elif m.isfile():
+          final = m.name
+          m.name = f"{final}.~cns{index[0]}.{index[1]}~"
+          tf.extract(m, my.root, **_EXTRACT_ARGS)
+          tmp = os.path.join(my.root, m.name)
+          if my._Claim(index, final,
+                       lambda: os.replace(tmp, os.path.join(my.root, final))):
+            nfiles += 1
+            nbytes += m.size
+          else:
+            os.unlink(tmp)
+        else:
+          # Links and special files are cheap to make under the lock.
+          my._Claim(index, name,
+                    lambda: (my._Unlink(name),
+                             tf.extract(m, my.root, **_EXTRACT_ARGS)))
+    return nfiles, nbytes
+
+#----- The assembly. -----------------------------------------------------------
+
+# 'gs://bucket/path/name.tar.gz#1234' => ('bucket', 'path/name.tar.gz', 1234).
+def ParseGsUri(uri:str) -> Tuple[str,str,Opt[int]]:
+  if not uri.startswith('gs://'):
+    raise AssemblyError(f"Not a gs:// URI: '{uri}'")
+  path, __, gen = uri[5:].partition('#')
+  bucket, __, name = path.partition('/')
+  if not (bucket and name) or (gen and not gen.isdigit()):
+    raise AssemblyError(f"Invalid gs:// URI: '{uri}'")
+  return bucket, name, int(gen) if gen else None
+
+# 'us.gcr.io/proj/mkl:2019.5' => ('us.gcr.io', 'proj/mkl', '2019.5'); or
+# 'us.gcr.io/proj/mkl@sha256:...' => ('us.gcr.io', 'proj/mkl', 'sha256:...').
+def ParseImageRef(ref:str) -> Tuple[str,str,str]:
+  registry, __, rest = ref.partition('/')
+  if '@' in rest:
+    repo, __, tag = rest.partition('@')
+  else:
+    repo, __, tag = rest.rpartition(':')
+  if not (registry and repo and tag) or '/' in tag:
+    raise AssemblyError(f"Invalid image reference: '{ref}'")
+  return registry, repo, tag
+
+KINDS = ('image', 'gs')
+
+# Return the list of (kind * location) of artifacts in the manifest lines.
+# Images go first, then tarballs, each in the order of the manifest, which is
+# also the order in which they win over each other's files.
+def ReadManifest(lines) -> List[Tuple[str,str]]:
+  arts = []
+  for ln, line in enumerate(lines, 1):
+    tokens = line.split()
+    if not tokens or tokens[0].startswith('#'):
+      continue
+    if len(tokens) != 4 or tokens[2] not in KINDS:
+      raise AssemblyError(f"Manifest line {ln} is malformed: '{line.strip()}'")
+    arts.append((tokens[2], tokens[3]))
+  return sorted(arts, key=lambda a: KINDS.index(a[0]))
+
+def _ResolveGs(gcs:GcsClient, uri:str) -> List[Blob]:
+  bucket, name, generation = ParseGsUri(uri)
+  meta = gcs.GetObject(bucket, name, generation)
+  size = int(meta['size'])
+  if not size:
+    raise AssemblyError(f"Artifact {uri} is empty")
+  gen = int(meta['generation'])
+  return [Blob(f"gs://{bucket}/{name}#{gen}", size,
+               functools.partial(gcs.ReadRange, bucket, name, gen),
+               Checksum(meta))]
+
+def _ResolveImage(registry:RegistryClient, ref:str) -> List[Blob]:
+  reg, repo, tag = ParseImageRef(ref)
+  blobs = []
+  for layer in registry.GetManifest(reg, repo, tag)['layers']:
+    mtype, digest = layer.get('mediaType', ''), layer['digest']
+    # Layers are tars, compressed or not, which tarfile tells apart by itself;
+    # but Python knows not zstd.
+    if 'tar' not in mtype or 'zstd' in mtype:
+      raise AssemblyError(f"Layer {digest} of {ref} has unsupported type "
+                          f"'{mtype}'")
+    if int(layer['size']):
+      blobs.append(Blob(f"{reg}/{repo}@{digest}", int(layer['size']),
+                        functools.partial(registry.ReadBlob, reg, repo,
+                                          digest),
+                        Checksum(layer)))
+  return blobs
+
+# Return the chunk size, and how many chunks ahead each stream of the given
+# sizes may be read, so that all of them together stay within the memory. Each
+# stream holds the chunk being consumed and up to window more, but never more
+# than its size. If not even one chunk ahead fits, the chunk is halved, down to
+# 1 MiB, which then has to do.
+def _Plan(sizes:List[int], chunk:int, memory:int) -> Tuple[int,int]:
+  def need(chunk:int, window:int) -> int:
+    return sum(min(s, (window + 1) * chunk) for s in sizes)
+  while chunk > MiB and need(chunk, 1) > memory:
+    chunk //= 2
+  window = 1
+  while (window * chunk < max(sizes, default=0) and
+         need(chunk, window + 1) <= memory):
+    window += 1
+  return chunk, window
+
+
+def _AssembleOne(ext:Extractor, executor:ThreadPoolExecutor, index:int,
+                 kind:str, what:str, blobs:List[Blob], chunk:int, window:int,
+                 abort:threading.Event) -> None:
+  t0 = time.perf_counter()
+  # All layers start to be read at once, but are applied one by one.
+  readers = [RangedReader(b, executor, chunk, window, abort) for b in blobs]
+  nfiles = nbytes = 0
+  try:
+    for layer, reader in enumerate(readers):
+      n, b = ext.Extract((index, layer), reader, layered=kind == 'image')
+      reader.Finish()
+      nfiles, nbytes = nfiles + n, nbytes + b
+  finally:
+    for reader in readers:
+      reader.close()
+  size = sum(b.size for b in blobs)
+  checks = '/'.join(sorted({b.checksum.kind or 'no' for b in blobs}))
+  layers = f"{len(blobs)} layers, " if kind == 'image' else ''
+  secs = time.perf_counter() - t0
+  _Say(f"Extracted {nfiles} files, {nbytes / MiB:.1f} MiB from {what} "
+       f"({size / MiB:.1f} MiB, {layers}{checks} checksum verified) "
+       f"in {secs:.1f}s, {size / MiB / secs:.1f} MiB/s")
+
+
+def Assemble(arts:List[Tuple[str,str]], root:str, gcs:GcsClient,
+             registry:RegistryClient, jobs:int=JOBS, chunk:int=CHUNK_SIZE,
+             memory:int=MEMORY) -> None:
+  """Extract opt/ from all artifacts (kind * location) into root, concurrently.
+
+  The tarballs and layers of all artifacts are read at the same time, in chunks
+  planned so that all of them together stay within the memory budget.
+  """
+  if not arts:
+    return
+  resolve = {'gs': functools.partial(_ResolveGs, gcs),
+             'image': functools.partial(_ResolveImage, registry)}
+  ext = Extractor(root)
+  abort = threading.Event()
+  errors = []
+  def run(index:int, kind:str, what:str, blobs:List[Blob]) -> None:
+    try:
+      _AssembleOne(ext, fetcher, index, kind, what, blobs, chunk, window,
+                   abort)
+    except Exception as e:  # pylint: disable=broad-except
+      if not abort.is_set():
+        # Our own errors name the object already; tarfile's and OS ones don't.
+        errors.append(str(e) if isinstance(e, AssemblyError) else
+                      f"{what}: {e}")
+      abort.set()
+
+  with ThreadPoolExecutor(max_workers=jobs) as fetcher, \
+       ThreadPoolExecutor(max_workers=len(arts)) as workers:
+    blobs = list(workers.map(lambda a: resolve[a[0]](a[1]), arts))
+    sizes = [b.size for bb in blobs for b in bb]
+    chunk, window = _Plan(sizes, chunk, memory)
+    _Say(f"Assembling {len(arts)} artifacts of {len(sizes)} streams, "
+         f"{sum(sizes) / MiB:.1f} MiB into {root}, {jobs} connections, "
+         f"{chunk / MiB:g} MiB chunks, {window} ahead per stream")
+    for f in [workers.submit(run, i, kind, what, bb)
+              for i, ((kind, what), bb) in enumerate(zip(arts, blobs))]:
+      f.result()
+  if errors:
+    raise AssemblyError('; '.join(errors))
+
+
+def _main(argv=None) -> int:
+  p = ap.ArgumentParser(
+    description="Extract opt/ from the artifacts in a CNS disk manifest.")
+  a = p.add_argument
+  a('manifest', help="Manifest file, as output by 'miller.py --gather'.")
+  a('target', help="Directory to extract opt/ into, e.g., /mnt.")
+  a('--jobs', '-j', metavar='N', type=int, default=JOBS,
+    help="Concurrent range requests. Default %(default)s.")
+  a('--chunk-size', metavar='MIB', type=int, default=CHUNK_SIZE // MiB,
+    help="Size of a range request, MiB. Default %(default)s.")
+  a('--memory', metavar='MIB', type=int, default=MEMORY // MiB,
+    help="Memory budget for chunks in flight, MiB. Default %(default)s.")
+  a('--endpoint', metavar='URL', default=os.environ.get('CNS_GCS_ENDPOINT'),
+    help=f"GCS JSON API endpoint. Default {GCS_ENDPOINT}.")
+  a('--registry-endpoint', metavar='URL',
+    default=os.environ.get('CNS_REGISTRY_ENDPOINT'),
+    help="Registry API endpoint. Default https://<registry of the image>.")
+  a('--anonymous', action='store_true',
+    help="Do not authenticate requests; for testing with local stand-ins.")
+  o = p.parse_args(argv)
+  if o.jobs < 1 or o.chunk_size < 1 or o.memory < o.chunk_size:
+    p.error('Need positive --jobs and --chunk-size, and --memory at least '
+            'as large as --chunk-size')
+
+  if not FAST_CRC32C:
+    _Say("No C implementation of CRC32C, will check MD5 where available")
+  token = None if o.anonymous else MetadataToken()
+  gcs = GcsClient(o.endpoint, token)
+  registry = RegistryClient(o.registry_endpoint, token)
+  t0 = time.perf_counter()
+  try:
+    with open(o.manifest) as f:
+      arts = ReadManifest(f)
+    Assemble(arts, o.target, gcs, registry,
+             o.jobs, o.chunk_size * MiB, o.memory * MiB)
+  except (OSError, AssemblyError, tarfile.TarError) as e:
+    _Say(f"Assembly failed: {e}")
+    return 1
+  _Say(f"Assembled {len(arts)} artifacts in {time.perf_counter() - t0:.1f}s")
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(_main())
@@ -17,16 +17,6 @@ MetaAttr() {
   curl -fsS -HMetadata-Flavor:Google "$metaroot/v1/$1"
 }
 
-# Untar either 'opt/' or './opt/' directory. tar makes this quite non-trivial!
-# See: https://serverfault.com/a/998062/279581
-ExtractOptFromTar() {
-  tar xv --no-anchored \
-         --transform='s:^\(\./\)\?[^o][^p][^t]/:.deleteme/&:' \
-         --show-transformed-names \
-      opt/ &&
-    rm -rf .deleteme
-}
-
 # A helper function to merge *{user,system}.slice.env files.
 # E.g. cd /mnt/opt/etc; MergeSlices > environment
 MergeSlices() {
@@ -82,6 +72,10 @@ do_all() {
   snapshot=$(MetaAttr instance/attributes/snapshot) || return
   echo "Target snapshot name: '$snapshot'"
 
+  # Optional, empty or missing if the snapshot has no manifest digest.
+  digest=$(MetaAttr instance/attributes/digest 2>/dev/null) || digest=
+  echo "Manifest digest: '$digest'"
+
   # Target disk is the second one attached to this VM.
   diskname=$(gcloud compute instances describe $myname \
                     --zone=$myzone \
@@ -103,52 +97,22 @@ do_all() {
   echo 'dumpe2fs report of the filesystem:'
   dumpe2fs -h $dev
 
-  # We do not mount into /opt, because tar expansion may cause other directories
-  # to pop up, and interfere with the system if they are in '/'. This way, they
-  # will land under /mnt.
+  # We do not mount into /opt, because the assembler extracts the opt/ directory
+  # of the artifacts into a target root, and that should not be '/'.
   echo "Mounting target filesystem $dev into /mnt/opt"
   mkdir -p /mnt/opt
   mount -orw,noatime,discard $dev /mnt/opt || return
 
-  cd /mnt
-
-  image_registries=$(
-    perl <$manifest -lne '($t,$a)=(split)[2,3];
-                          $a=~s:/.*::;
-                          print "https://$a" if $t eq "image"' |
-      sort -u) || return
-
-  if [[ $image_registries ]]; then
-    echo "All image registries in the manifest: [" $image_registries "]"
-    echo "Installing Docker snap package"
-    snap install docker || return
-    for reg in $image_registries; do
-      echo "Authenticating gcloud against registry $reg"
-      # The only weird way to auth gcloud snap in docker snap.
-      docker login -u oauth2accesstoken \
-             -p "$(gcloud auth print-access-token)" $reg || return
-    done
-
-    images=$(awk <$manifest '$3=="image" {print $4}') || return
-    for im in $images; do
-      echo "Pulling image $im"
-      docker pull $im  >/dev/null || return
-
-      echo "Extracting image $im"
-      # Docker needs an entrypoint command, for our drone images have none.
-      # We use 'true', even though it's not present; as good as anything.
-      docker container create --name work $im true >/dev/null || return
-      docker container export work | ExtractOptFromTar || return
-      docker container rm work >/dev/null || return
-      docker image rm $im >/dev/null || return
-    done
-  fi
-
-  gsobjects=$(awk <$manifest '$3=="gs" {print $4}') || return
-  for gs in $gsobjects; do
-    echo "Fetching and extracting $gs"
-    gsutil cat "$gs" | gunzip -c | ExtractOptFromTar || return
-  done
+  # All artifacts are fetched concurrently, tarballs from GCS in ranges, and
+  # images layer by layer straight from the registry, and unpacked as they
+  # arrive. Where the same file is in more than one artifact, the one listed
+  # later in the manifest wins, images first, then tarballs, as it did when they
+  # were extracted one by one. The assembler is passed in Daisy sources, which
+  # are visible to us in the bucket at the 'sources' attribute.
+  echo "Fetching and extracting all artifacts"
+  gsutil -q cp "$(MetaAttr instance/attributes/sources)/cns_assemble.py" \
+         /tmp/ || return
+  python3 /tmp/cns_assemble.py $manifest /mnt || return
 
   # Merge all *.slice.env files to their destinations, and then remove.
   echo "Combining and removing .slice.env files"
@@ -187,6 +151,7 @@ do_all() {
   # had time to implement, but some day, like, maybe...
   labels='--labels=burrmill=1,disposition=p,disklabel=burrmill_cns'
   labels+=$(awk <$manifest '{printf ",bmv_%s=%s",$1,$2}') || return
+  labels+=${digest:+,bmdigest=$digest}
 
   echo "Creating snapshot $snapshot from disk $diskname"
   (set -x
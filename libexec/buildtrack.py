@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- python-indent-offset: 2; -*-
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2020 Kirill 'kkm' Katsnelson
+
+# Track completion of Cloud Builds. Given a project and build IDs, wait until
+# at least one of the builds completes, print a line
+#
+#   done ID STATUS SECS
+#
+# for every build observed completed, where SECS is the time the build ran,
+# not counting the time it spent in the queue, and exit. With --all, keep
+# waiting and reporting until all builds complete. Lines are printed as soon as
+# completions are observed, so the caller may read them from a pipe.
+#
+# With --follow, the IDs of more builds to watch are read from stdin, one per
+# line, as they are started, and the tracker exits when stdin is closed, even
+# if some builds have not completed, as the caller is evidently gone. This way,
+# a caller which starts new builds as others complete, like 'bm-node-software
+# build', runs one tracker for the whole build, which keeps its polling interval
+# and pays the startup cost once.
+#
+# All builds are watched with a single builds.list request per poll, filtered
+# by build IDs, and with only the fields we need requested. The polling interval
+# starts at --min-interval, and grows by half each time a poll brings no news
+# up to --max-interval; any change of status of any build resets it back. When
+# most builds take 15+ minutes, there is no point in hammering the API every 10
+# seconds, but we still want to notice quickly when a build that has only been
+# queued starts, as it may be the short one.
+#
+# The Build API is messy. This is a definition of possible build status codes:
+# https://cloud.google.com/cloud-build/docs/api/reference/rest/Shared.Types/Status
+# Now try to tell what should I infer from STATUS_UNKNOWN. Retry request?
+# Consider it failed? And there is no documented way, AFAIK, to tell if the
+# build has completed or not. I am using quite a reasonable observation that
+# the 'finishTime' field is not set in ongoing builds. But it's undocumented.
+# The terminal statuses are also checked, for a good measure.
+#
+# --endpoint (or CLOUDBUILD_ENDPOINT in the environment) points the tracker to
+# a different API server, such as a local stand-in for testing, and --anonymous
+# tells it not to bother with credentials.
+
+import argparse as ap
+import calendar
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+from typing import (Callable,
+                    Iterator,
+                    List,
+                    Mapping as Map,
+                    Optional as Opt,
+                    Iterable as Seq,
+                    Tuple)
+
+import requests
+
+CLOUDBUILD_API = 'https://cloudbuild.googleapis.com'
+BUILD_FIELDS = 'builds(id,status,startTime,finishTime)'
+TERMINAL = frozenset(('SUCCESS', 'FAILURE', 'INTERNAL_ERROR', 'TIMEOUT',
+                      'CANCELLED', 'EXPIRED'))
+MAX_ERRORS = 5  # Consecutive failed polls before giving up.
+
+ME = os.path.basename(sys.argv[0])
+
+def _Say(*args) -> None:
+  print(f"{ME}:", *args, file=sys.stderr, flush=True)
+
+# '2020-05-04T12:34:56.123456789Z' => seconds since epoch. Cloud Build reports
+# nanoseconds; these are of no interest, and strptime does not grok them.
+def _ParseTime(ts:Opt[str]) -> Opt[float]:
+  m = ts and re.match(r'(\d+-\d+-\d+T\d+:\d+:\d+)(\.\d+)?Z$', ts)
+  if not m: return None
+  t = time.strptime(m[1], '%Y-%m-%dT%H:%M:%S')
+  return calendar.timegm(t) + float(m[2] or 0)
+
+# Run time of a completed build in whole seconds; 0 if it never started.
+def BuildSeconds(build:dict) -> int:
+  start = _ParseTime(build.get('startTime'))
+  finish = _ParseTime(build.get('finishTime'))
+  return round(finish - start) if start and finish else 0
+
+def IsComplete(build:dict) -> bool:
+  return bool(build.get('finishTime')) or build.get('status') in TERMINAL
+
+
+class BuildTracker:
+  """Poll a set of Cloud Builds of a project with one request per poll.
+
+  token: a callable returning a bearer token, called again with refresh=True
+         if the token is rejected; or None to send requests unauthenticated.
+  """
+  def __init__(my, project:str, endpoint:Opt[str]=None,
+               token:Opt[Callable[..., str]]=None):
+    my.url = (f"{(endpoint or CLOUDBUILD_API).rstrip('/')}"
+              f"/v1/projects/{project}/builds")
+    my.token = token
+    my.session = requests.Session()
+
+  def _Get(my, params:dict) -> requests.Response:
+    def get(refresh:bool) -> requests.Response:
+      headers = ({'Authorization': f"Bearer {my.token(refresh=refresh)}"}
+                 if my.token else {})
+      return my.session.get(my.url, params=params, headers=headers)
+    resp = get(refresh=False)
+    if resp.status_code == 401 and my.token:
+      resp = get(refresh=True)
+    return resp
+
+  def Poll(my, ids:Seq[str]) -> Map[str,dict]:
+    """Return the build resources of the builds ids, keyed by ID.
+
+    Builds not (yet) known to the API are missing from the result.
+    """
+    ids = sorted(set(ids))
+    params = {'filter': ' OR '.join(f'build_id="{i}"' for i in ids),
+              'pageSize': len(ids),
+              'fields': f"nextPageToken,{BUILD_FIELDS}"}
+    found = {}
+    while True:
+      resp = my._Get(params)
+      resp.raise_for_status()
+      data = resp.json()
+      found.update((b['id'], b) for b in data.get('builds', ()))
+      params['pageToken'] = data.get('nextPageToken')
+      if not params['pageToken']: break
+    return found
+
+  def Watch(my, ids:Seq[str], min_interval:float, max_interval:float,
+            more:Opt[queue.Queue]=None) -> Iterator[List[Tuple[str,str,int]]]:
+    """Yield lists of (id * status * seconds) of builds just observed complete.
+
+    The first poll is made right away, and each following one after the
+    adaptive interval. Polls that observe no completions yield nothing. Stops
+    when all builds have completed. Transient API errors are retried, up to
+    MAX_ERRORS in a row, then the last one is raised.
+
+    more: if given, IDs of more builds to watch are taken from this queue while
+          waiting, and a new build resets the interval. Watching continues
+          even when no builds are pending, until None is taken from the queue,
+          which stops it right away.
+    """
+    pending = set(ids)
+    seen:Map[str,Opt[str]] = {}
+    interval, errors = min_interval, 0
+
+    # Wait secs, or forever if None, or until more builds come. Return True if
+    # any have.
+    def wait(secs:Opt[float]) -> bool:
+      nonlocal more
+      if more is None:
+        time.sleep(secs)
+        return False
+      added = False
+      try:
+        i = more.get(timeout=secs)
+        while i is not None:
+          pending.add(i)
+          added = True
+          i = more.get_nowait()
+        more = None
+        pending.clear()
+      except queue.Empty:
+        pass
+      return added
+
+    while pending or more is not None:
+      if not pending:
+        wait(None)
+        interval = min_interval
+        continue
+      try:
+        builds = my.Poll(pending)
+        errors = 0
+      except (requests.ConnectionError, requests.HTTPError) as e:
+        resp = getattr(e, 'response', None)
+        if resp is not None and resp.status_code < 500 and \
+           resp.status_code != 429:
+          raise
+        errors += 1
+        if errors >= MAX_ERRORS:
+          raise
+        _Say(f"Retrying after error: {e}")
+        wait(interval)
+        interval = min(max_interval, interval * 2)
+        continue
+
+      done = []
+      changed = False
+      for i in sorted(pending):
+        b = builds.get(i, {})
+        status = b.get('status')
+        changed |= seen.get(i) != status
+        seen[i] = status
+        if IsComplete(b):
+          done.append((i, status or 'STATUS_UNKNOWN', BuildSeconds(b)))
+      pending.difference_update(i for i, *__ in done)
+      if done:
+        yield done
+      if not pending: continue
+
+      interval = min_interval if changed else min(max_interval, interval * 1.5)
+      if wait(interval):
+        interval = min_interval
+
+
+# Cached gcloud token. Do not pay for the SDK import if --anonymous.
+def _GcloudToken(refresh:bool=False) -> str:
+  import gcsdk_undoc  # In libexec/, next to us.
+  # A margin longer than any token lifetime forces a refresh.
+  return gcsdk_undoc.credentials.GetFreshToken(
+    **({'margin': 24 * 3600} if refresh else {}))
+
+
+def _main(argv:Opt[Seq[str]]=None) -> int:
+  p = ap.ArgumentParser(
+    description="Wait for Cloud Builds to complete, and report them.")
+  a = p.add_argument
+  a('ids', metavar='ID', nargs='*', help="Build IDs to watch.")
+  a('--project', required=True, help="Project ID of the builds.")
+  a('--all', action='store_true',
+    help="Wait until all builds complete, not only the first one.")
+  a('--follow', action='store_true',
+    help=("Also watch builds with IDs read from stdin, one per line, and stop "
+          "when it is closed. Implies --all."))
+  a('--min-interval', metavar='SECS', type=float, default=5,
+    help="Shortest interval between polls. Default %(default)s.")
+  a('--max-interval', metavar='SECS', type=float, default=30,
+    help="Longest interval between polls. Default %(default)s.")
+  a('--endpoint', metavar='URL', default=os.environ.get('CLOUDBUILD_ENDPOINT'),
+    help=f"Cloud Build API endpoint. Default {CLOUDBUILD_API}.")
+  a('--anonymous', action='store_true',
+    help="Do not authenticate requests; for testing with a local stand-in.")
+  o = p.parse_args(argv)
+  if not 0 < o.min_interval <= o.max_interval:
+    p.error('Need 0 < --min-interval <= --max-interval')
+  if not (o.ids or o.follow):
+    p.error('Need build IDs to watch, or --follow')
+
+  more = None
+  if o.follow:
+    more = queue.Queue()
+    def read_stdin():
+      for line in sys.stdin:
+        if line.strip():
+          more.put(line.strip())
+      more.put(None)
+    threading.Thread(target=read_stdin, daemon=True).start()
+
+  tracker = BuildTracker(o.project, o.endpoint,
+                         token=None if o.anonymous else _GcloudToken)
+  try:
+    for done in tracker.Watch(o.ids, o.min_interval, o.max_interval, more):
+      for i, status, secs in done:
+        print('done', i, status, secs, flush=True)
+      if not (o.all or o.follow): break
+  except requests.RequestException as e:
+    _Say(f"Cannot get status of builds: {e}")
+    return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(_main())
@@ -0,0 +1,164 @@
+# -*- python-indent-offset: 2; -*-
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2020 Kirill 'kkm' Katsnelson
+
+"""Small persistent caches shared between invocations of BurrMill tools.
+
+A cache is a JSON object stored in a file under the user's cache directory,
+$XDG_CACHE_HOME/burrmill, or ~/.cache/burrmill by default. Concurrent access
+from different processes is serialized with an advisory lock on a companion
+.lock file, and from threads of the same process with a mutex. The file is
+replaced atomically on write, so that a reader never sees a partial file.
+
+Caches are an optimization only. Any failure to read the cache file, including
+a missing or corrupt file, is indistinguishable from an empty cache, and any
+failure to write it is silently ignored.
+"""
+
+import fcntl as _fcntl
+import json as _json
+import os as _os
+import threading as _threading
+
+from contextlib import contextmanager as _contextmanager
+
+def UserCacheDir(create:bool=True) -> str:
+  "Return the BurrMill cache directory, creating it if it does not exist."
+  base = (_os.environ.get('XDG_CACHE_HOME') or
+          _os.path.join(_os.path.expanduser('~'), '.cache'))
+  path = _os.path.join(base, 'burrmill')
+  if create:
+    _os.makedirs(path, mode=0o700, exist_ok=True)
+  return path
+
+
+class CacheFile:
+  """A JSON dict persisted in the file <UserCacheDir()>/<name>.json.
+
+  Use Locked() to read-modify-write the dict while holding the lock, and
+  Load() to take a consistent snapshot without modifying it. Files are created
+  readable only by the user, as some caches hold credentials.
+
+  For the common pattern of looking up entries many times and adding a few,
+  Get() reads from a snapshot loaded once on the first use, and Put() stores
+  entries both in the snapshot and the file. A long-running process calls
+  Refresh() to pick up changes made to the file by other processes.
+  """
+  def __init__(my, name:str):
+    my.name = name
+    my._mutex = _threading.Lock()
+    my._path = None
+    my._snap = None
+    my._snapstamp = None
+    my._snaplock = _threading.Lock()
+
+  def _Path(my) -> str:
+    if not my._path:
+      my._path = _os.path.join(UserCacheDir(), my.name + '.json')
+    return my._path
+
+  @_contextmanager
+  def _Flock(my, op):
+    with my._mutex:
+      try:
+        fd = _os.open(my._Path() + '.lock', _os.O_RDWR|_os.O_CREAT, 0o600)
+      except OSError:
+        yield False
+        return
+      try:
+        _fcntl.flock(fd, op)
+        yield True
+      finally:
+        _os.close(fd)  # Also releases the lock.
+
+  # Identity of the file content: it is replaced, never rewritten in place.
+  def _Stamp(my) -> tuple:
+    try:
+      st = _os.stat(my._Path())
+      return st.st_ino, st.st_mtime_ns, st.st_size
+    except OSError:
+      return ()
+
+  # Load the snapshot if not yet loaded; call with _snaplock held.
+  def _Snap(my) -> dict:
+    if my._snap is None:
+      my._snapstamp = my._Stamp()  # Before reading: err on reloading again.
+      my._snap = my.Load()
+    return my._snap
+
+  def _Read(my) -> dict:
+    try:
+      with open(my._Path(), 'r') as f:
+        data = _json.load(f)
+      return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+      return {}
+
+  def _Write(my, data:dict) -> None:
+    tmp = f"{my._Path()}.{_os.getpid()}.tmp"
+    try:
+      fd = _os.open(tmp, _os.O_WRONLY|_os.O_CREAT|_os.O_TRUNC, 0o600)
+      with open(fd, 'w') as f:
+        _json.dump(data, f, separators=(',', ':'))
+      _os.replace(tmp, my._Path())
+    except OSError:
+      try: _os.unlink(tmp)
+      except OSError: pass
+
+  def Load(my) -> dict:
+    "Return a snapshot of the cache content; empty dict if none."
+    with my._Flock(_fcntl.LOCK_SH):
+      return my._Read()
+
+  @_contextmanager
+  def Locked(my):
+    """Context manager yielding the cache dict under an exclusive lock.
+
+    Changes made to the dict are written back when the context exits without
+    an exception. Do not perform long operations, such as network requests,
+    while holding the lock: it blocks every other user of the same cache.
+    """
+    with my._Flock(_fcntl.LOCK_EX) as locked:
+      data = my._Read() if locked else {}
+      orig = _json.dumps(data, sort_keys=True)
+      yield data
+      if locked and _json.dumps(data, sort_keys=True) != orig:
+        my._Write(data)
+
+  def Clear(my) -> None:
+    "Remove the cache file and forget the snapshot."
+    with my._snaplock:
+      my._snap = {}
+    with my._Flock(_fcntl.LOCK_EX):
+      try: _os.unlink(my._Path())
+      except OSError: pass
+
+  def Get(my, key:str, default=None):
+    "Return the entry for key from the snapshot of the cache."
+    with my._snaplock:
+      return my._Snap().get(key, default)
+
+  def Refresh(my) -> None:
+    "Forget the snapshot if the file has changed since it was loaded."
+    with my._snaplock:
+      if my._snap is not None and my._Stamp() != my._snapstamp:
+        my._snap = None
+
+  def Put(my, entries:dict, expired=None) -> None:
+    """Merge entries into the snapshot and the cache file.
+
+    expired: optional predicate on the (key, value) pair. Matching entries are
+             dropped from the snapshot, and from the file while it is being
+             rewritten anyway.
+    """
+    with my._snaplock:
+      snap = my._Snap()
+      if expired:
+        for k in [k for k, v in snap.items() if expired(k, v)]:
+          del snap[k]
+      snap.update(entries)
+      with my.Locked() as data:
+        if expired:
+          for k in [k for k, v in data.items() if expired(k, v)]:
+            del data[k]
+        data.update(entries)
@@ -29,13 +29,24 @@ GDMD=Gdmd
 #   2) there is an image in the compute family,
 #   3) and there is a snapshot of the CNS disk.
 #
+# The snapshot may be optionally specified by name, or with '-m', the newest
+# one with the manifest matching the current Millfiles, if any.
+#
 # Upon success, return the URI of the CNS disk snapshot.
 VerifyPrereqsAndGetCnsDisk() {
   local cns_snapshot=${1-}  # May be optionally specified.
+  local digest=
 
   # Pull general config, just to make sure it exists; we do not use it here.
   GetProjectGsConfig
 
+  if [[ $cns_snapshot = -m ]]; then
+    cns_snapshot=
+    digest=$(miller_client.py --digest --project=$project) ||
+      Die "Unable to compute the manifest digest of the current Millfiles"
+    digest=${digest#digest }
+  fi
+
   # Only test if a base image is available; we use family name for deployment.
   # We run the check in parallel with the next one, note the &.
   [[ $($GC images list --verbosity=none --limit=1 --format='get(selfLink)' \
@@ -45,16 +56,24 @@ VerifyPrereqsAndGetCnsDisk() {
   filt='labels.burrmill:* AND labels.disklabel=burrmill_cns'
   # If specific snapshot was requested:
   [[ $cns_snapshot ]] && filt+=" AND name=$cns_snapshot"
-  # Find the (latest or the only matching by name) snapshot.
-  cns_snapshot=$($GC snapshots list --format='json(name)' \
-                     --sort-by=~creationTimestamp --limit=1   \
-                     --filter="$filt" |
-                   $JQ -r '.[].name//""')  # Or you'll get text 'null' if null.
+  # Find the (latest or the only matching by name or digest) snapshot.
+  if [[ $digest ]]; then
+    cns_snapshot=$(FindCnsSnapshots $digest '' --format='json(name)' |
+                     $JQ -r '.[0].name//""')
+  else
+    cns_snapshot=$($GC snapshots list --format='json(name)' \
+                       --sort-by=~creationTimestamp --limit=1   \
+                       --filter="$filt" |
+                     $JQ -r '.[].name//""')  # Or you'll get text 'null' if null.
+  fi
   Dbg1 "Using CNS snapshot: '$cns_snapshot'"
 
   wait -n || Die "No base images in the family $(C c)$image_family_compute$(C)"\
                  "exist. Build one with the '$(C c bm-os-image build)' command."
 
+  [[ $cns_snapshot || ! $digest ]] ||
+    Die "No CNS disk snapshot matches the current Millfiles." \
+        "Build one with the '$(C c bm-node-software build)' command."
   [[ $cns_snapshot ]] ||
     Die "No usable CNS disk snapshots were found." \
         "Build one with the '$(C c bm-node-software)' tool"
@@ -62,6 +81,45 @@ VerifyPrereqsAndGetCnsDisk() {
   echo "$cns_snapshot"
 }
 
+#==============================================================================#
+# FindCnsSnapshots
+#==============================================================================#
+# Find CNS snapshots by their manifest digest, which 'miller.py --gather
+# --digest' reports, and is stamped on the snapshot as the label 'bmdigest'.
+# Snapshots in the local index of miller.py are only checked to still exist;
+# absent these, snapshots are found by the label. Either way, it is a single
+# 'snapshots list' request, with the filter doing all the work on the server
+# side, and no scanning of all snapshots. The index is updated with what has
+# been found.
+#
+# $1 is the digest. $2, if not empty, is a gcloud filter to match snapshots
+# which were made before the digest label was introduced, by their bmv_*
+# labels. The rest of arguments are passed to 'gcloud compute snapshots list',
+# and must include a --format=json(...), with at least the field 'name'.
+#
+# stdout is the JSON array of the found snapshots, newest first.
+FindCnsSnapshots() {
+  local digest=${1?} legacy=${2?} filt found indexed jlist=[]
+  shift 2
+  filt='labels.burrmill:* AND labels.disklabel=burrmill_cns'
+  indexed=$(miller_client.py --project=$project --find-snapshot=$digest)
+  Dbg1 "Indexed snapshots with manifest digest $digest: [" $indexed "]"
+
+  [[ $indexed ]] &&
+    jlist=$($GC snapshots list "$@" --sort-by=~creationTimestamp \
+                --filter="$filt AND name=(${indexed//$'\n'/ })")
+  if [[ $jlist == '[]' ]]; then
+    filt+=" AND (labels.bmdigest=$digest${legacy:+ OR ($legacy)})"
+    jlist=$($GC snapshots list "$@" --sort-by=~creationTimestamp \
+                --filter="$filt")
+  fi
+
+  found=$($JQ -r <<<"$jlist" '.[].name')
+  [[ $found == "$indexed" ]] ||
+    miller_client.py --project=$project --index-snapshots $digest $found
+  echo "$jlist"
+}
+
 # Return a list of deployments that are not obviously broken. For a thorough
 # check, there is LoadAndValidateClusterState. With -g, returns only those
 # which have no errors in the latest deployment status record. bm-power performs
@@ -14,9 +14,25 @@ regard, so choose your poison.
 # This is embarrasing. Google should un-undocument this API.
 # https://github.com/GoogleCloudPlatform/docker-credential-gcr/blob/e84196148/credhelper/helper.go#L212-L215
 
+# Importing the Cloud SDK is slow: it needs locating the SDK installation by
+# running 'which gcloud', and the import itself pulls in a lot of modules. Many
+# users of this package can do their job without calling into the SDK at all
+# (e.g., if everything they need is passed on the command line), so the SDK is
+# not touched until one of the submodules credentials, project or storage is
+# first accessed as an attribute of the package:
+#
+#   import gcsdk_undoc
+#   gcsdk_undoc.storage.ListObjects(...)  # SDK is imported only here.
+#
 # Use functions to scope away imported names and local variables, to avoid
 # polluting our module namespace.
 
+import threading as _threading
+
+_SUBMODULES = frozenset(('credentials', 'project', 'storage'))
+_bootstrap_lock = _threading.Lock()
+_bootstrapped = False
+
 # Locate SDK lib and lib/third_party directories and prepend them to the
 # sys.path. 'gcloud info' shows the lib/third_party goes before lib/.
 def _ExtendSyspath():
@@ -33,9 +49,6 @@ def _ExtendSyspath():
   assert os.path.exists(path)
   sys.path.insert(0, path)
 
-_ExtendSyspath()
-del _ExtendSyspath
-
 # This is What They do Themselves: see <sdk>/lib/googlecloudsdk/gcloud_main.py.
 # This is how authentication in devshell or GCE "magically" works.
 #
@@ -52,13 +65,23 @@ def _RegisterGcsdkCredProviders():
     pass
   store.GceCredentialProvider().Register()
 
+def _Bootstrap():
+  global _bootstrapped
+  with _bootstrap_lock:
+    if not _bootstrapped:
+      _ExtendSyspath()
+      _RegisterGcsdkCredProviders()
+      _bootstrapped = True
 
-_RegisterGcsdkCredProviders()
-del _RegisterGcsdkCredProviders
-
-# These would fail before we muck with the sys.path.
-# pylint: disable=wrong-import-position
-from . import credentials, project, storage
+# PEP 562 module attribute hook, called only if the attribute is not found.
+# Importing a submodule sets it as the package attribute, so that this is
+# invoked at most once per submodule.
+def __getattr__(name):
+  if name not in _SUBMODULES:
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+  _Bootstrap()
+  import importlib
+  return importlib.import_module('.' + name, __name__)
 
 def ApToDict(aps) -> dict:
   """Convert list of AdditionalProperty messages to dict.
@@ -4,7 +4,20 @@
 
 "Undocumented gcloud credential store access"
 
+# The SDK must be located first, in case this module is imported directly,
+# and not through the package attribute access.
+from . import _Bootstrap
+_Bootstrap()
+
+# pylint: disable=wrong-import-position
+import calendar as _calendar
+import threading as _threading
+import time as _time
+
 import googlecloudsdk.core.credentials.store as _credstore  # Undocumented.
+import googlecloudsdk.core.properties as _properties
+
+from cachefile import CacheFile as _CacheFile  # In libexec/, next to us.
 
 # Expose aliases to types consumed or returned in this module.
 # pylint: disable=unused-import
@@ -47,11 +60,48 @@ def GetScoped(scopes=None) -> Credentials:
   return Credentials.from_authorized_user_info(vars(ucr), scopes=scopes)
 
 
-def GetFreshToken() -> str:
-  "Get a fresh Bearer access token, good for about 60 minutes."
-  ucr = _credstore.Load()
-  _credstore.Refresh(ucr)
-  try:
-    return ucr.access_token
-  except AttributeError:
-    return ucr.token
+# Access tokens obtained by GetFreshToken() are cached, in this process and in
+# a cache file shared by all BurrMill tools, keyed by the gcloud account. The
+# file is readable only by the user, like the gcloud credential store itself.
+TOKEN_MARGIN = 300  # Refresh tokens expiring in less than that, seconds.
+
+_token_cache = _CacheFile('gcloud-tokens')
+_token_lock = _threading.Lock()
+
+def _IsValid(ent, margin) -> bool:
+  return bool(ent) and ent['expires'] > _time.time() + margin
+
+
+def GetFreshToken(margin: int = TOKEN_MARGIN) -> str:
+  """Get a Bearer access token, good for at least margin seconds more.
+
+  A cached token is returned if it has not yet come within margin seconds
+  of its expiry. Otherwise the token is refreshed, which takes a round trip
+  to the OAuth endpoint, and a refreshed token is good for about 60 minutes.
+  Concurrent callers from threads of the same process share both the token
+  and the refresh; processes share the token, but may each refresh it if
+  they find it expiring at the same time.
+  """
+  with _token_lock:
+    account = _properties.VALUES.core.account.Get() or '(default)'
+    ent = _token_cache.Get(account)
+    if _IsValid(ent, margin):
+      return ent['token']
+
+    # Another process may have refreshed the token since the snapshot was
+    # taken. The file lock is not held during the refresh, as it would block
+    # all BurrMill tools of the user on the network round trip.
+    ent = _token_cache.Load().get(account)
+    if not _IsValid(ent, margin):
+      ucr = _credstore.Load()
+      _credstore.Refresh(ucr)
+      try:
+        token, expiry = ucr.access_token, ucr.token_expiry  # oauth2client.
+      except AttributeError:
+        token, expiry = ucr.token, ucr.expiry  # google-auth.
+      # Both libraries use naive datetime in UTC.
+      expires = (_calendar.timegm(expiry.utctimetuple()) if expiry
+                 else _time.time() + 3000)
+      ent = {'token': token, 'expires': expires}
+    _token_cache.Put({account: ent})
+    return ent['token']
@@ -4,6 +4,12 @@
 
 "Access projects using gcloud internal undocumented API."
 
+# The SDK must be located first, in case this module is imported directly,
+# and not through the package attribute access.
+from . import _Bootstrap
+_Bootstrap()
+
+# pylint: disable=wrong-import-position
 from types import SimpleNamespace as _Ducky
 
 import googlecloudsdk.core.properties as _properties
@@ -9,24 +9,56 @@ are exposed from it:
 
   Bucket
   Object
+  StorageObjectsDeleteRequest
   StorageObjectsListRequest
 
 so that you can refer to storage.Bucket instead of rather unwieldy
 googlecloudsdk.third_party.apis.storage.v1.storage_v1_messages.Bucket.
 """
 
-from typing import Sequence as _Sequence
-import apitools.base.py.list_pager as _pager
+# The SDK must be located first, in case this module is imported directly,
+# and not through the package attribute access.
+from . import _Bootstrap
+_Bootstrap()
+
+# pylint: disable=wrong-import-position
+import threading as _threading
+import time as _time
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor, \
+                               as_completed as _as_completed
+from typing import Callable as _Callable, Iterator as _Iterator, \
+                   Optional as _Optional, Sequence as _Sequence, \
+                   Tuple as _Tuple
+import apitools.base.py.batch as _batch
+import apitools.base.py.encoding as _encoding
+import apitools.base.py.http_wrapper as _http_wrapper
 import googlecloudsdk.api_lib.storage.storage_api as _gsapi
+import googlecloudsdk.api_lib.util.apis as _apis
 import googlecloudsdk.third_party.apis.storage.v1.storage_v1_messages as _gsmv1
 
 # Expose aliases to types consumed or returned in this module.
 # pylint: disable=unused-import
 from googlecloudsdk.third_party.apis.storage.v1.storage_v1_messages import(
-  Object, Bucket, StorageObjectsListRequest)
+  Object, Bucket, StorageObjectsDeleteRequest, StorageObjectsListRequest)
 
 from . import project as _project
 
+RequestHook = _Callable[[str, str, int, float, float, int], None]
+_request_hook: _Optional[RequestHook] = None
+
+def SetRequestHook(hook: _Optional[RequestHook]) -> None:
+  """Observe HTTP requests made by ListObjects().
+
+  hook(method, url, status, start, seconds, nbytes) is called from the thread
+  that made the request after each response, including those to requests which
+  are retried, where start is the time.perf_counter() when the request was
+  sent, seconds is its latency, and nbytes is the length of the response body.
+  Set None to remove the hook.
+  """
+  global _request_hook
+  _request_hook = hook
+
+
 def ListBuckets(project_id: str = None) -> _Sequence[Bucket]:
   # Documentation lifted from the gRPC message docstrings, abridged.
   """List buckets in a project.
@@ -74,7 +106,8 @@ def ListBuckets(project_id: str = None) -> _Sequence[Bucket]:
   return gsclient.ListBuckets(project_id)
 
 
-def ListObjects(bucket: str, **kwargs) -> _Sequence[Object]:
+def ListObjects(bucket: str, *, fields: str = None, page_size: int = None,
+                prefetch: bool = False, **kwargs) -> _Iterator[Object]:
   # Documentation lifted from the gRPC message docstrings, abridged.
   # Here the StorageClient API is not adequate, as it does not return non-
   # current versions in a versioned bucket, and we do use versions. We use
@@ -82,7 +115,22 @@ def ListObjects(bucket: str, **kwargs) -> _Sequence[Object]:
   # response messages directly.
   """List objects in a bucket.
 
-  Arguments are used to construct the StorageObjectsListRequest message,
+  These keyword-only arguments control how the listing is fetched:
+
+    fields: Comma-separated list of Object fields to return, e.g.
+        'name,generation,metadata'. Other fields of the returned messages
+        are left unset. This may cut the response size by an order of
+        magnitude. Default is to return all fields.
+    page_size: Number of objects to request per page, 1000 at most. Default
+        is the service default, which is also the maximum.
+    prefetch: If true, the next page is requested in a background thread as
+        soon as the current page is received, so that its round trip overlaps
+        with the consumption of the current page by the caller.
+
+  Every call makes its own client, so that listings may run concurrently in
+  different threads.
+
+  Other arguments are used to construct the StorageObjectsListRequest message,
   which is then executed by the gcloud-authenticated client. They are
   passed via kwargs (except 'bucket', which is required):
 
@@ -163,5 +211,102 @@ def ListObjects(bucket: str, **kwargs) -> _Sequence[Object]:
     updated: The modification time of the object metadata in RFC 3339 format.
   """
   request = _gsmv1.StorageObjectsListRequest(bucket=bucket, **kwargs)
-  gsrpcclient = _gsapi.StorageClient().client
-  return _pager.YieldFromList(gsrpcclient.objects, request)
+  if page_size:
+    request.maxResults = page_size
+  global_params = None
+  if fields:
+    global_params = _gsmv1.StandardQueryParameters(
+      fields=f"nextPageToken,prefixes,items({fields})")
+  client = _gsapi.StorageClient().client
+  service = client.objects
+
+  # The client checks every response with check_response_func, which raises on
+  # errors that should be retried. Observe responses there. There is at most
+  # one request in flight, so one start time will do.
+  hook, sent = _request_hook, [0.0]
+  if hook:
+    check = client.check_response_func or _http_wrapper.CheckResponse
+    def CheckResponse(resp):
+      now = _time.perf_counter()
+      hook('GET', resp.request_url, resp.status_code, sent[0], now - sent[0],
+           resp.length)
+      sent[0] = now  # A retry is sent next, if any.
+      check(resp)
+    client.check_response_func = CheckResponse
+
+  def FetchPage(token):
+    req = _encoding.CopyProtoMessage(request)
+    req.pageToken = token
+    sent[0] = _time.perf_counter()
+    return service.List(req, global_params=global_params)
+
+  if not prefetch:
+    token = None
+    while True:
+      page = FetchPage(token)
+      yield from page.items
+      token = page.nextPageToken
+      if not token: return
+
+  # Keep at most one request in flight, as the client is not thread-safe.
+  with _ThreadPoolExecutor(max_workers=1) as executor:
+    pending = executor.submit(FetchPage, None)
+    while pending:
+      page = pending.result()
+      pending = (page.nextPageToken and
+                 executor.submit(FetchPage, page.nextPageToken))
+      yield from page.items
+
+
+# The batch endpoint of the JSON API. The global www.googleapis.com/batch
+# endpoint, which apitools uses by default, has been shut down.
+BATCH_URL = 'https://storage.googleapis.com/batch/storage/v1'
+BATCH_MAX = 100  # The service limit of calls per batch request.
+
+def DeleteObjects(bucket: str, objects: _Sequence[_Tuple[str, int]], *,
+                  batch_size: int = BATCH_MAX, jobs: int = 4
+                  ) -> _Iterator[_Tuple[str, int, _Optional[str]]]:
+  """Delete specific generations of objects in a bucket.
+
+  objects is a sequence of (name, generation) pairs; generation may be None
+  to delete the current version of the object. The deletions are sent in
+  batch requests of up to batch_size calls each (at most BATCH_MAX), and up to
+  jobs batch requests are in flight at the same time.
+
+  Yields (name, generation, error) for each object as soon as the batch with
+  it completes, in no particular order. error is None if the object has been
+  deleted or did not exist (the latter is not an error for the purpose of
+  deletion), or the text of the error otherwise.
+  """
+  batch_size = max(1, min(batch_size, BATCH_MAX))
+  objects = list(objects)
+  batches = [objects[i:i + batch_size]
+             for i in range(0, len(objects), batch_size)]
+  if not batches: return
+
+  # Neither the client nor its HTTP transport are thread-safe. Give each
+  # worker thread its own client, and reuse it for all its batches.
+  local = _threading.local()
+
+  def RunBatch(objs):
+    client = getattr(local, 'client', None)
+    if not client:
+      client = local.client = _apis.GetClientInstance('storage', 'v1')
+    breq = _batch.BatchApiRequest(batch_url=BATCH_URL)
+    for name, generation in objs:
+      breq.Add(client.objects, 'Delete',
+               _gsmv1.StorageObjectsDeleteRequest(
+                 bucket=bucket, object=name, generation=generation))
+    return objs, breq.Execute(client.http, max_batch_size=batch_size)
+
+  with _ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+    for future in _as_completed([executor.submit(RunBatch, b)
+                                 for b in batches]):
+      objs, calls = future.result()
+      for (name, generation), call in zip(objs, calls):
+        error = None
+        if call.is_error:
+          status = getattr(call.exception, 'status_code', None)
+          if status != 404:
+            error = str(call.exception)
+        yield name, generation, error
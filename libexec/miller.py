@@ -21,17 +21,31 @@
 # How come this limited scope "helper script" to process a 5-10 line Millfile
 # grew up to nearly 900 lines of code in length, I have no idea.
 
+# Cold start time is tracked from here. What the interpreter spends before
+# this point is beyond our control anyway.
+import time
+T_START = time.perf_counter()
+
 import argparse as ap
+import hashlib
+import heapq
+import io
 import json
 import os.path
 import pprint as pp
 import re
+import signal
+import socket
+import socketserver
 import sys
+import threading
+import traceback
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
 from dataclasses import dataclass, field
 from fileinput import FileInput
-from functools import reduce
-from itertools import chain, filterfalse
+from itertools import chain
 from os import environ
 from typing import (Callable,
                     List,
@@ -41,18 +55,27 @@ from typing import (Callable,
                     Set,
                     Iterable as Seq,
                     Tuple)
+from urllib.parse import quote
 
 import requests  # Not in stdlib, but ubiquitous. Cloud Shell has it.
 
-from gcsdk_undoc import *  # Our package in libexec/.
+from cachefile import CacheFile  # Our modules in libexec/.
+from miller_client import DefaultSocketPath
+# Our package in libexec/. The SDK is not imported until first use of its
+# submodules, as in gcsdk.storage.ListObjects().
+import gcsdk_undoc as gcsdk
+from gcsdk_undoc import ApToDict
 
 #==============================================================================#
 # Global globals (some sections define more).
 #==============================================================================#
 
 g_session = None         # Session library's session.
-g_gtoken:str = None      # Bearer token, good for 60 minutes.
+g_gtoken:str = None      # Bearer token, good for 5+ minutes.
 g_debug:int = 0          # This is set early in args_parse.
+g_jobs:int = 8           # Max concurrent artifact probes, --jobs.
+g_max_stale:int = 0      # Trust cached artifact state this fresh, --max-stale.
+g_lock = threading.RLock()  # Guards lazy initialization from probe threads.
 g_project:str = None     # Project string ID
 gs_location:str = None   # Multiregion, e.g. 'us' from global config.
 gs_software:str = None   # Name of the Software bucket, also from config.
@@ -65,20 +88,29 @@ FATAL = 'FATAL'
 SGR0 = ''
 
 # Try to spice it up with colors, if terminfo is available and functioning.
-try:
-  import curses
-  curses.setupterm()
-  sgr0 = curses.tigetstr('sgr0')
-  setaf = curses.tigetstr('setaf')
-  if sgr0 and setaf:
-    r, y, w = (curses.tparm(setaf, i).decode('ascii') for i in (9,11,15))
-    SGR0 = sgr0.decode('ascii')
-    INFO = w + INFO + SGR0
-    WARNING = y + WARNING + w
-    FATAL = r + FATAL + w
-  del setaf, sgr0, r, y, w
-except Exception:
-  pass
+# Initializing curses takes a noticeable time, so do it only when the first
+# message is printed; most runs never print anything.
+g_colors_ready = False
+
+def _setup_colors() -> None:
+  global g_colors_ready, INFO, WARNING, FATAL, SGR0
+  if g_colors_ready: return
+  with g_lock:
+    if g_colors_ready: return
+    g_colors_ready = True
+    try:
+      import curses
+      curses.setupterm()
+      sgr0 = curses.tigetstr('sgr0')
+      setaf = curses.tigetstr('setaf')
+      if sgr0 and setaf:
+        r, y, w = (curses.tparm(setaf, i).decode('ascii') for i in (9,11,15))
+        SGR0 = sgr0.decode('ascii')
+        INFO = w + INFO + SGR0
+        WARNING = y + WARNING + w
+        FATAL = r + FATAL + w
+    except Exception:
+      pass
 
 #==============================================================================#
 # Stderr message reporting functions.
@@ -88,18 +120,164 @@ def _say(*args) -> None:
   print(ME, ':', *args, SGR0, sep='', file=sys.stderr)
 
 def debug(level:int, *args) -> None:
-  if g_debug >= level: _say(f"DEBUG({level}):", *args)
+  if g_debug >= level: _setup_colors(); _say(f"DEBUG({level}):", *args)
 
 def info(*args) -> None:
-  _say(INFO, ':', *args)
+  _setup_colors(); _say(INFO, ':', *args)
 
 def warn(*args) -> None:
-  _say(WARNING, ':', *args)
+  _setup_colors(); _say(WARNING, ':', *args)
 
 def fatal(*args) -> NoReturn:
-  _say(FATAL, ':', *args)
+  _setup_colors(); _say(FATAL, ':', *args)
   sys.exit(1)
 
+#==============================================================================#
+# Instrumentation: --stats and --trace.
+#==============================================================================#
+
+# When a run is slow, these tell where the time goes. Phases of the run, like
+# the SDK import, token refresh, project configuration fetch, GCS listing and
+# artifact probes, are timed with span(), and every HTTP request is recorded
+# with its latency, status and response size: those made over g_session by a
+# response hook, and those made by the SDK storage client by the request hook
+# of gcsdk_undoc.storage. With --stats, a JSON summary is printed to stderr at
+# the end of the run; with --trace FILE, all phases and requests are written to
+# FILE as Chrome trace events, for chrome://tracing or ui.perfetto.dev. Phases
+# nest, and their times are inclusive. When neither is requested, g_stats is
+# None, and the hooks return right away.
+
+# Coarse classes of requests for the summary; the trace has every URL.
+REQUEST_CLASSES = (
+  (r'/storage/v1/b/[^/]+/o$', 'gcs objects.list'),
+  (r'/storage/v1/b/[^/]+/o/', 'gcs object'),
+  (r'/v2/token$', 'registry token'),
+  (r'/v2/.+/manifests/', 'registry manifest'),
+  (r'/v2/.+/tags/list$', 'registry tags'),
+  (r'//runtimeconfig\.', 'runtimeconfig'),
+)
+
+def _request_class(url:str) -> str:
+  path = url.partition('?')[0]
+  for rx, label in REQUEST_CLASSES:
+    if re.search(rx, path): return label
+  return path.split('/')[2] if '//' in path else path  # The host.
+
+
+class Stats:
+  "Timings of phases and HTTP requests of one run, safe to add from threads."
+  def __init__(my, origin:float):
+    my.origin = origin  # perf_counter() at time 0 of the trace.
+    my.phases:Map[str,dict] = {}
+    my.requests:Map[str,dict] = {}
+    my._events:List[dict] = []
+    my._tids:Map[int,int] = {}
+    my._lock = threading.Lock()
+
+  # Add a trace event. Threads are numbered in the order of their first event.
+  def _Event(my, name:str, cat:str, start:float, secs:float, args:dict):
+    ident = threading.get_ident()
+    tid = my._tids.get(ident)
+    if tid is None:
+      tid = my._tids[ident] = len(my._tids) + 1
+      my._events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                         'tid': tid,
+                         'args': {'name': threading.current_thread().name}})
+    my._events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': 1,
+                       'tid': tid, 'ts': round(1e6 * (start - my.origin)),
+                       'dur': round(1e6 * secs), 'args': args})
+
+  def Phase(my, name:str, start:float, secs:float, args:dict) -> None:
+    with my._lock:
+      ent = my.phases.setdefault(name, {'count': 0, 'secs': 0})
+      ent['count'] += 1
+      ent['secs'] += secs
+      my._Event(name, 'phase', start, secs, args)
+
+  def Request(my, method:str, url:str, status:int, start:float, secs:float,
+              nbytes:int) -> None:
+    label = f"{method} {_request_class(url)}"
+    with my._lock:
+      ent = my.requests.setdefault(label, {'count': 0, 'secs': 0, 'max_secs': 0,
+                                           'bytes': 0, 'status': {}})
+      ent['count'] += 1
+      ent['secs'] += secs
+      ent['max_secs'] = max(ent['max_secs'], secs)
+      ent['bytes'] += nbytes
+      ent['status'][status] = ent['status'].get(status, 0) + 1
+      my._Event(label, 'http', start, secs,
+                {'url': url, 'status': status, 'bytes': nbytes})
+
+  def Summary(my) -> dict:
+    def rounded(ent:dict) -> dict:
+      return {k: round(v, 3) if isinstance(v, float) else v
+              for k, v in ent.items()}
+    with my._lock:
+      return {
+        'wall_secs': round(time.perf_counter() - my.origin, 3),
+        'phases': {k: rounded(v) for k, v in sorted(my.phases.items())},
+        'requests': {k: rounded(v) for k, v in sorted(my.requests.items())},
+        'total_requests': sum(v['count'] for v in my.requests.values()),
+        'total_bytes': sum(v['bytes'] for v in my.requests.values()),
+      }
+
+  def WriteTrace(my, path:str) -> None:
+    with my._lock, open(path, 'w') as f:
+      json.dump({'traceEvents': my._events, 'displayTimeUnit': 'ms'}, f)
+
+
+g_stats:Opt[Stats] = None
+
+# Time the block as the phase name. args are shown with the trace event.
+@contextmanager
+def span(name:str, **args):
+  if not g_stats:
+    yield
+    return
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    g_stats.Phase(name, start, time.perf_counter() - start, args)
+
+# The response hook of g_session. The hook is called when the headers are
+# received; the body is read here, as it would be right after the hook anyway.
+def _on_response(resp:requests.Response, *__, **___) -> None:
+  if not g_stats: return
+  start = time.perf_counter() - resp.elapsed.total_seconds()
+  nbytes = len(resp.content)
+  g_stats.Request(resp.request.method, resp.url, resp.status_code, start,
+                  time.perf_counter() - start, nbytes)
+
+# The request hook of gcsdk_undoc.storage.
+def _on_sdk_request(method:str, url:str, status:int, start:float, secs:float,
+                    nbytes:int) -> None:
+  if g_stats:
+    g_stats.Request(method, url, status, start, secs, nbytes)
+
+# Collect stats for the duration of the block if stats or trace is requested,
+# and report them at its end, even if it ends with an error. origin is the
+# start of the run; the time from the origin to the block is the 'startup'.
+@contextmanager
+def collect_stats(stats:bool, trace:Opt[str], origin:float):
+  global g_stats
+  if not (stats or trace):
+    yield
+    return
+  g_stats = Stats(origin)
+  g_stats.Phase('startup', origin, time.perf_counter() - origin, {})
+  try:
+    yield
+  finally:
+    summary, st, g_stats = g_stats.Summary(), g_stats, None
+    if stats:
+      print(json.dumps(summary, indent=2), file=sys.stderr)
+    if trace:
+      try:
+        st.WriteTrace(trace)
+      except OSError as e:
+        warn(f"Cannot write trace file {trace}: {e}")
+
 #==============================================================================#
 # Misc small data classes and type signatures.
 #==============================================================================#
@@ -154,7 +332,7 @@ def _sanitize_gsbucket_url(buck:str) -> str:
 # Scope argparser under the carpet, we need it once. The only side effect is
 # that this function sets the g_debug variable as soon as arguments are parsed,
 # and starts logging debug info even before it returns.
-def parse_args() -> ap.Namespace:
+def parse_args(argv:Opt[Seq[str]]=None) -> ap.Namespace:
   global g_debug
 
   def default_millfiles() -> Seq[str]:
@@ -222,14 +400,102 @@ machinery, external to this script.
   a('--targets', '-t', type=str, metavar='TARGET[,TARGET...]',
     help=("Build only these targets. Default is to consider all targets."))
   a('--gather', action='store_true', help="'gather', n. Opposite of 'build'.")
+  a('--dag', action='store_true',
+    help=("Output the build sequence as a dependency graph, with 'need' "
+          "directives, instead of ranks separated by 'wait'."))
+  a('--format', choices=('text', 'ndjson'), default='text',
+    help=("Output directives as text lines, or as JSON records, one per line, "
+          "streamed as artifact probes complete. Default '%(default)s'."))
+  a('--estimate', action='store_true',
+    help=("With --dag, also report the expected wall time of the build "
+          "sequence, based on the durations of previous builds."))
+  a('--max-builds', metavar='N', type=int, default=MAX_BUILDS,
+    help=("Number of concurrent builds assumed by --estimate. "
+          "Default %(default)s."))
+  a('--stamp', nargs=2, metavar=('NAME', 'KEY'),
+    help=("Stamp the artifact of the target NAME with the build KEY from the "
+          "--dag output, after a successful build."))
+  a('--record', nargs=3, metavar=('NAME', 'VER', 'SECS'),
+    help=("Record the duration of a successful build of the target NAME, "
+          "version VER ('-' if none), for estimates."))
+  a('--digest', action='store_true',
+    help=("Print 'digest HEX', the digest of the CNS disk manifest, after the "
+          "manifest with --gather, or else only the digest, computed from "
+          "Millfiles alone, without looking up artifacts."))
+  a('--find-snapshot', metavar='DIGEST',
+    help=("Print names of CNS snapshots with the manifest DIGEST, newest "
+          "first, from the local index. Requires --project."))
+  a('--index-snapshots', nargs='+', metavar=('DIGEST', 'NAME'),
+    help=("Set names of CNS snapshots with the manifest DIGEST in the local "
+          "index, newest first, or forget it if none. Requires --project."))
+  a('--gc', action='store_true',
+    help=("Delete noncurrent generations of tarballs which are not the "
+          "artifact of any target in Millfiles, or of a --keep version."))
+  a('--keep', metavar='NAME=VER', action='append', default=[],
+    help=("With --gc, also keep the tarball of the target NAME, version VER, "
+          "e.g. one in a CNS snapshot. May be repeated."))
+  a('--dry-run', '-n', action='store_true',
+    help="With --gc, only report what would be deleted, and bytes reclaimed.")
+  a('--jobs', '-j', metavar='N', type=int, default=g_jobs,
+    help=f"Probe up to N artifacts concurrently. Default {g_jobs}.")
+  a('--gcs-api', choices=('sdk', 'json'), default=g_gcs_api,
+    help=("List GCS objects with the Cloud SDK client, or the lighter direct "
+          f"JSON API requests. Default '{g_gcs_api}'."))
+  a('--stats', action='store_true',
+    help=("Print a JSON summary of the time spent in each phase of the run, "
+          "and of the HTTP requests made, to stderr at exit."))
+  a('--trace', metavar='FILE',
+    help=("Write phases and HTTP requests of the run to FILE as Chrome trace "
+          "events, for chrome://tracing or ui.perfetto.dev."))
+  a('--max-stale', metavar='SECS', type=int, default=g_max_stale,
+    help=("Use artifact state cached by previous runs if not older than SECS, "
+          "without checking it. Default is to always revalidate it."))
   # Optional, but save on remote API calls if supplied *correctly*.
   a('--gs-location', metavar='LOC', type=str, help='Optional')
   a('--gs-software', metavar='GSPATH', type=str, help='Optional')
   a('--project', metavar='NAME', type=str, help='Optional')
-
-  o = p.parse_args()
+  # Service mode, see miller_client.py.
+  a('--serve', action='store_true',
+    help=("Run as a service answering requests of miller_client.py, keeping "
+          "credentials, configuration and artifact state warm."))
+  a('--socket', metavar='PATH',
+    help=("Unix socket to listen on with --serve. Default $MILLER_SOCKET, or "
+          "miller.sock in the user's cache directory."))
+  a('--serve-ttl', metavar='SECS', type=int, default=SERVE_TTL,
+    help=("Forget the project configuration and artifact state after SECS "
+          "with --serve. Default %(default)s."))
+
+  o = p.parse_args(argv)
   g_debug = max(0, o.debug)
 
+  if o.jobs < 1:
+    p.error(f"--jobs must be a positive number, not {o.jobs}")
+  if o.max_builds < 1:
+    p.error(f"--max-builds must be a positive number, not {o.max_builds}")
+  if o.estimate and not o.dag:
+    p.error('--estimate requires --dag')
+  if (o.find_snapshot or o.index_snapshots) and not o.project:
+    p.error('--find-snapshot and --index-snapshots require --project')
+  for digest in (o.find_snapshot, *(o.index_snapshots or ())[:1]):
+    if digest and not re.fullmatch(r'[0-9a-f]+', digest):
+      p.error(f"Invalid manifest digest '{digest}'")
+  if o.digest and (o.dag or o.stamp or o.gc):
+    p.error('--digest makes sense only alone or with --gather')
+  if (o.keep or o.dry_run) and not o.gc:
+    p.error('--keep and --dry-run require --gc')
+  if o.gc and (o.gather or o.dag or o.stamp or o.record or o.targets or
+               o.force or o.format != 'text'):
+    p.error('--gc considers all targets, and produces text output only')
+  for kv in o.keep:
+    if not re.fullmatch(r'[^=\s]+=[^=\s]+', kv):
+      p.error(f"--keep value must be in the form NAME=VERSION, not '{kv}'")
+  if o.record:
+    try:
+      o.record[2] = float(o.record[2])
+    except ValueError:
+      p.error(f"--record duration must be a number, not '{o.record[2]}'")
+    if o.record[1] == '-':
+      o.record[1] = None
   if o.omit_std and not o.files:
     p.error('No files to process; some are required with -m/--omit-std.')
   if not o.omit_std:
@@ -382,22 +648,37 @@ def _check_200(resp):
           f"{resp.status_code}. Full response was: {vars(resp)}")
 
 
-# Requests library and bearer token lazy intialization.
+# Requests library and bearer token lazy intialization. The connection pool is
+# sized so that concurrent probes do not fight for connections to one host.
 def _ensure_requests_session_and_gtoken():
   global g_session, g_gtoken
-  if not g_session:
-    g_session = requests.Session()
-  if not g_gtoken:
-    g_gtoken = 'Bearer ' + credentials.GetFreshToken()
+  with g_lock:
+    if not g_session:
+      g_session = requests.Session()
+      g_session.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=4, pool_maxsize=max(10, g_jobs)))
+      g_session.hooks['response'].append(_on_response)
+    if not g_gtoken:
+      with span('sdk-import'):
+        credentials = gcsdk.credentials
+      with span('gtoken'):
+        g_gtoken = 'Bearer ' + credentials.GetFreshToken()
 
 # Project config lazy intialization.
 #
 # If known to the invoker, better passed via command line or the environment to
 # save on a couple API call roundtrips.
 def _ensure_gs_config():
+  with g_lock:
+    _ensure_gs_config_locked()
+
+def _ensure_gs_config_locked():
   global g_project, gs_location, gs_software
   if not g_project:
-    g_project = project.GetCurrent()
+    with span('sdk-import'):
+      project = gcsdk.project
+    with span('project'):
+      g_project = project.GetCurrent()
     if not g_project:
       fatal('Cannot determine active project. Use "gcloud config list" to '
             'check your local configuration. If using the Cloud Shell, select '
@@ -415,7 +696,8 @@ def _ensure_gs_config():
           f"{g_project}/configs/burrmill/variables/globals")
 
   # Response is a JSON string like { "text": "gs_location=us gs_...", ...}.
-  resp = g_session.get(vurl, headers = {'Authorization': g_gtoken})
+  with span('gs-config'):
+    resp = g_session.get(vurl, headers = {'Authorization': g_gtoken})
   _check_200(resp)
 
   debug(1, f"Got project config '{resp.text}'")
@@ -439,116 +721,414 @@ def _ensure_gs_config():
                   f"gs_software={gs_sofware}")
   gs_software = v
 
+#----- Listing GCS objects. ----------------------------------------------------
+
+# The objects can be listed either with the SDK storage client, or directly with
+# the GCS JSON API over our requests session (--gcs-api=json). The latter does
+# not import the apitools and storage API modules from the SDK at all, which
+# saves a good chunk of the startup time. Both produce GcsObject records.
+
+# Either way, only the fields of GcsObject are requested, which makes pages
+# much smaller, and the next page is prefetched while the current one is being
+# processed.
+
+# The endpoint may be pointed to a local stand-in with MILLER_GCS_ENDPOINT, e.g.
+# 'http://localhost:8000', for testing and benchmarking (see maint/millbench.py).
+GCS_JSON_API = (environ.get('MILLER_GCS_ENDPOINT') or
+                'https://storage.googleapis.com') + '/storage/v1'
+GCS_OBJECT_FIELDS = 'name,generation,metageneration,metadata,timeDeleted'
+GCS_SIZED_FIELDS = GCS_OBJECT_FIELDS + ',size'
+GCS_REVALIDATE_FIELDS = 'name,generation,metageneration,timeDeleted'
+g_gcs_api:str = 'sdk'  # 'sdk' or 'json', --gcs-api.
+
+@dataclass(frozen=True)
+class GcsObject:
+  "The fields of a GCS object that we care about."
+  name:str
+  generation:int
+  metageneration:int
+  metadata:Map[str,str]  # Empty if the object has none.
+  timeDeleted:Opt[str]   # Only tested for presence.
+  size:int = 0           # Only if requested in the fields, see list_objects.
+
+
+def _list_objects_sdk(bucket:str, fields:str, **kwargs) -> Seq[GcsObject]:
+  with span('sdk-import'):
+    storage = gcsdk.storage
+  storage.SetRequestHook(_on_sdk_request)
+  for o in storage.ListObjects(bucket=bucket, fields=fields,
+                                     prefetch=True, **kwargs):
+    yield GcsObject(o.name, o.generation, o.metageneration,
+                    ApToDict(o.metadata), o.timeDeleted and str(o.timeDeleted),
+                    o.size or 0)
+
+
+def _list_objects_json(bucket:str, fields:str, **kwargs) -> Seq[GcsObject]:
+  _ensure_requests_session_and_gtoken()
+  url = f"{GCS_JSON_API}/b/{bucket}/o"
+  params = {k: str(v).lower() if isinstance(v, bool) else v
+            for k, v in kwargs.items()}
+  params['fields'] = f"nextPageToken,items({fields})"
+
+  def fetch_page(token:Opt[str]) -> dict:
+    resp = g_session.get(url, params={**params, 'pageToken': token},
+                         headers={'Authorization': g_gtoken})
+    _check_200(resp)
+    return json.loads(resp.text)
+
+  with ThreadPoolExecutor(max_workers=1) as executor:
+    pending = executor.submit(fetch_page, None)
+    while pending:
+      page = pending.result()
+      token = page.get('nextPageToken')
+      pending = token and executor.submit(fetch_page, token)
+      for o in page.get('items', ()):
+        yield GcsObject(o['name'], int(o['generation']),
+                        int(o['metageneration']), o.get('metadata') or {},
+                        o.get('timeDeleted'), int(o.get('size', 0)))
+
+
+# List objects in a bucket; kwargs are the parameters of the objects.list API
+# call, such as prefix, delimiter and versions. The object size is not needed
+# to find artifacts, and is returned only if fields are GCS_SIZED_FIELDS.
+def list_objects(bucket:str, fields:str=GCS_OBJECT_FIELDS,
+                 **kwargs) -> Seq[GcsObject]:
+  if g_gcs_api == 'json':
+    return _list_objects_json(bucket, fields, **kwargs)
+  return _list_objects_sdk(bucket, fields, **kwargs)
+
+#----- Persistent artifact state. ----------------------------------------------
+
+# The state of artifacts observed in previous runs is kept in a cache file, so
+# that a run can cheaply revalidate it instead of fetching it again. For the
+# tarballs directory, the entry holds the candidate index (g_tarball_index
+# below), the number of all tarball objects in the directory, current and
+# noncurrent, and their signature: the SHA-256 of the sorted list of (name *
+# generation * metageneration * current) of them all. Revalidation lists all
+# versions, too, but without the metadata, which makes up the bulk of a page.
+# Any upload or deletion of any generation, e.g., by the lifecycle rules or by
+# 'miller.py gc', and any metadata change, even of a noncurrent generation,
+# changes the signature; only then the full listing is requested. For images,
+# the entry holds the manifest digest and ETag of the image:tag (digest is None
+# if the image did not exist), for a conditional HEAD request.
+#
+# Entries younger than --max-stale seconds are used without revalidation at
+# all. This is useful for quick status checks, but obviously not when the
+# state is expected to change, e.g., when gathering just built artifacts.
+
+g_artifact_state = CacheFile('artifact-state')
+
+def _state_is_fresh(ent:Opt[dict]) -> bool:
+  return bool(ent) and time.time() - ent['time'] < g_max_stale
+
 #----- GS service globals, for tarballs. ---------------------------------------
 
-# 4-tuples (version * current * name * generation) list.
-# - version is set to '' if not set, otherwise sort fails.
-# - current: 0 if deleted, 1 if current.
-# - filename w/o the 'tarballs/' prefix
-# - generation number.
-g_tarball_cache = None
+# We look for objects, superseded or not, with our Version metadatum, and also
+# for "courtesy" matches of the form NAME-VERSION.tar.gz, but only if they have
+# no Version set (this way lays insanity if the versions in the name and
+# metadata do not match), and only if they are current (i.e., the user has
+# deleted such a file, and it's "gone" if non-current). Thus, we ignore
+# non-current objects without the Version metadatum.
+#
+# The index maps (filename * version) to the best candidate (current *
+# generation * buildkey) for this key, where the filename is w/o the 'tarballs/'
+# prefix, version is '' if not set, current is 1 for current objects and 0 for
+# deleted ones, buildkey is the value of the buildkey metadatum or None, and the
+# best candidate is the max of the triple: the current object if any, then the
+# latest non-current generation. Unversioned objects are indexed
+# under the version '', and only if current. A lookup tries the exact versioned
+# match first, and then the courtesy match. The versioned bucket may hold many
+# thousands of noncurrent generations, but the index has only as many entries
+# as there are distinct name-version pairs, and is built in one pass over the
+# listing, page by page as it streams in.
+TarballIndex = Map[Tuple[str,str],Tuple[int,int,Opt[str]]]
+
+g_tarball_index:Opt[TarballIndex] = None
 
 TARBALLS_DIR = 'tarballs/'
-GSSW_WARN_THRESHOLD = 150
-GSSW_ERROR_THRESHOLD = 1000
 
-def _ensure_tarball_cache():
-  global g_tarball_cache
-  if g_tarball_cache is not None:  # Can be a genuinely empty list.
-    return
-
-  g_tarball_cache = []
-  for o in storage.ListObjects(bucket=gs_software,
-                               prefix=TARBALLS_DIR,
-                               delimiter='/',  # Do not search "subdirectories".
-                               versions=True): # Show all versions though.
+# When the names of the tarball targets to look up are known in advance, and
+# they are few compared to the number of objects in the directory seen during
+# the last full listing, list only objects with the prefix 'tarballs/<name>'
+# for each target name, concurrently, instead of the whole directory.
+PREFIX_LIST_RATIO = 10
+g_tarball_names:Opt[Set[str]] = None
+
+def plan_tarball_lookups(names:Seq[str]) -> None:
+  "Declare the names of all tarball targets which are going to be looked up."
+  global g_tarball_names
+  g_tarball_names = frozenset(names)
+
+def _list_tarball_objects(prefix:str, versions:bool,
+                          fields:str=GCS_OBJECT_FIELDS) -> Seq['GcsObject']:
+  return list_objects(bucket=gs_software,
+                      fields=fields,
+                      prefix=TARBALLS_DIR + prefix,
+                      delimiter='/',      # Do not search "subdirectories".
+                      versions=versions)  # Show all versions, or not.
+
+# The index is loaded once, by the first probe thread that needs it, while the
+# others wait on g_tarball_lock. g_lock is held only to look at the globals and
+# to publish the index, never while listing: the per-prefix listings run in
+# probe threads of their own, which must not wait on a lock held by the thread
+# waiting for them. With --gcs-api=json, the session and token are set up
+# before these start; the SDK makes a client per listing.
+g_tarball_lock = threading.Lock()
+
+def _ensure_tarball_index():
+  global g_tarball_index
+  with g_tarball_lock:
+    with g_lock:
+      if g_tarball_index is not None:  # Can be a genuinely empty dict.
+        return
+      names = g_tarball_names
+      if g_gcs_api == 'json':
+        _ensure_requests_session_and_gtoken()
+
+    state = g_artifact_state.Get(f"gs://{gs_software}/{TARBALLS_DIR}")
+    count = state and state.get('count')
+    if names is not None and count and len(names) * PREFIX_LIST_RATIO < count:
+      debug(1, f"Looking up {len(names)} tarball name prefixes instead of "
+               f"listing all {count} objects")
+      with span('tarball-index', prefixes=len(names)):
+        index = {}
+        for part in probe_all(_load_tarball_index, sorted(names)):
+          index.update(part)
+    else:
+      with span('tarball-index'):
+        index = _load_tarball_index('')
+
+    with g_lock:
+      g_tarball_index = index
+
+
+# The signature of the tarball directory state, see above.
+def _tarball_signature(objects:Seq[GcsObject]) -> str:
+  return hashlib.sha256(json.dumps(sorted(
+    [o.name, o.generation, o.metageneration, not o.timeDeleted]
+    for o in objects)).encode()).hexdigest()
+
+# Build index of tarballs, or, when prefix is not empty, of only those whose
+# names start with the prefix. The cached state is keyed by the prefix, too.
+def _load_tarball_index(prefix:str) -> TarballIndex:
+  where = f"gs://{gs_software}/{TARBALLS_DIR}{prefix}"
+  state = g_artifact_state.Get(where)
+  if state and not all(len(e) == 5 for e in state.get('index', [()])):
+    state = None  # Written by an older version.
+  if _state_is_fresh(state):
+    debug(1, f"Using cached directory of {where}, "
+             f"{int(time.time() - state['time'])}s old")
+    return {(n, v): (c, g, k) for n, v, c, g, k in state['index']}
+
+  if state:
+    # The listing without metadata is much cheaper than the full one.
+    signature = _tarball_signature(
+      o for o in _list_tarball_objects(prefix, versions=True,
+                                       fields=GCS_REVALIDATE_FIELDS)
+      if o.name.endswith('.tar.gz'))
+    if signature == state.get('signature'):
+      debug(1, f"Cached directory of {where} revalidated, no changes")
+      g_artifact_state.Put({where: {**state, 'time': time.time()}})
+      return {(n, v): (c, g, k) for n, v, c, g, k in state['index']}
+    debug(1, f"Directory of {where} has changed, reloading")
+
+  index, objects = {}, []
+  for o in _list_tarball_objects(prefix, versions=True):
     if not o.name.endswith('.tar.gz'):
       continue
-    # We look for objects, superseded or not, with our Version metadatum, and
-    # also for "courtesy" matches of the form NAME-VERSION.tar.gz, but only if
-    # they have no Version set (this way lays insanity if the versions in the
-    # name and metadata do not match), and only if they are current (i.e., the
-    # user has deleted such a file, and it's "gone" if non-current). Thus, we
-    # ignore non-current objects without the Version metadatum.
-    #
-    # To make a single pass over the array and select the first found match as
-    # satisfying the search criterion, sort current files with the version, then
-    # non-current with the version, and files without the version meta the last.
-    # To avoid mucking with Python's date comparisons, which are non-trivial,
-    # simply use an integer currency status, 1 for current and 0 for non-current
-    # (objects which have the delete time set). The reverse sort on (version *
-    # currency) will do, the non-versioned objects go to the end of the list.
-    #
-    # The list is not normally long, 20-40 objects is a practically expected
-    # size. Give a warning if suspiciously large, fail fatally if crazy large.
-    # The user must have put some stuff that does not belong there.
-    version = ApToDict(o.metadata).get('version', '')
+    objects.append(o)
+    version = o.metadata.get('version', '')
     current = 0 if o.timeDeleted else 1
     if not (version or current): continue
-    name = o.name.rpartition('/')[-1]
-    g_tarball_cache.append((version, current, name, o.generation))
-
-    if len(g_tarball_cache) == GSSW_WARN_THRESHOLD:
-      warn(f"The number of tarballs in gs://{gs_software}/{TARBALLS_DIR} is "
-           f"over {GSSW_WARN_THRESHOLD}. Did you put something there that "
-           f"does not belong?")
-    if len(g_tarball_cache) >= GSSW_ERROR_THRESHOLD:
-      fatal(f"The number of tarballs in gs://{gs_software}/{TARBALLS_DIR} is "
-            f"over {GSSW_ERROR_THRESHOLD}. Clean it up.")
-
-  g_tarball_cache.sort(reverse=True)  # In-place.
-  debug(1, (f"Loaded directory of gs://{gs_software}/{TARBALLS_DIR}, "
-            f"{len(g_tarball_cache)} potential candidate tarball files"))
-  debug(2, 'Cached candidate list, in match-first order:\n',
-           pp.pformat(g_tarball_cache,2))
+    key = (o.name.rpartition('/')[-1], version)
+    cand = (current, o.generation, o.metadata.get('buildkey'))
+    if cand > index.get(key, (-1, -1, None)):
+      index[key] = cand
+
+  g_artifact_state.Put({where: {
+    'time': time.time(),
+    'count': len(objects),
+    'signature': _tarball_signature(objects),
+    'index': [[n, v, *cand] for (n, v), cand in index.items()]}})
+  debug(1, (f"Loaded directory of {where}, {len(objects)} tarball objects, "
+            f"{len(index)} potential candidates"))
+  debug(2, ('Candidate index, (name, version) => '
+            '(current, generation, buildkey):\n'),
+           pp.pformat(index,2))
+  return index
+
+#----- Registry bearer tokens. -------------------------------------------------
+
+# The registry has its own authentication: a gtoken is traded for a registry
+# token scoped to a single repository. These tokens are good for a while (GCR
+# issues them for a few hours), and are kept in a cache file keyed by registry,
+# repository and scope, so that back-to-back invocations, like the build and
+# gather passes of bm-node-software, do not trade the same token twice. Tokens
+# in the file are loaded once per process and merged back when a new one is
+# obtained; entries are considered expired REGTOKEN_MARGIN seconds early.
+
+# Likewise, MILLER_REGISTRY_ENDPOINT replaces 'https://<registry>' in all
+# registry requests.
+REGISTRY_ENDPOINT = environ.get('MILLER_REGISTRY_ENDPOINT')
+
+def _registry_url(registry:str) -> str:
+  return REGISTRY_ENDPOINT or f"https://{registry}"
+
+REGTOKEN_MARGIN = 60
+REGTOKEN_DEFAULT_TTL = 60  # The Docker spec default if 'expires_in' is absent.
+
+g_regtokens = CacheFile('registry-tokens')  # {'registry repo scope': {...}}
+
+def _registry_token(registry:str, repo:str, scope:str='pull',
+                    rejected:Opt[str]=None) -> str:
+  key = f"{registry} {repo} {scope}"
+  ent = g_regtokens.Get(key)
+  if (ent and ent['token'] != rejected and
+      ent['expires'] > time.time() + REGTOKEN_MARGIN):
+    return ent['token']
+
+  # Trade gtoken for the registry token.
+  _ensure_requests_session_and_gtoken()
+  now = time.time()
+  resp = g_session.get(f"{_registry_url(registry)}/v2/token",
+                       params={'service': registry,
+                               'scope': f"repository:{repo}:{scope}"},
+                       headers={'Authorization': g_gtoken})
+  _check_200(resp)
+  tokjs = json.loads(resp.text)
+  ent = {'token': 'Bearer ' + tokjs['token'],
+         'expires': now + int(tokjs.get('expires_in', REGTOKEN_DEFAULT_TTL))}
+  debug(2, f"Obtained registry token for {key}, "
+           f"good for {int(ent['expires'] - now)}s")
+  # Drop expired tokens while at it.
+  g_regtokens.Put({key: ent}, expired=lambda k, v: v['expires'] <= now)
+  return ent['token']
+
+
+# Perform a request to the registry API v2 for the repository repo, e.g.,
+# ('HEAD', 'us.gcr.io', 'my-project/mkl', 'manifests/2019.5'). If the cached
+# registry token is rejected, obtain a new one and retry the request once.
+def _registry_request(method:str, registry:str, repo:str, path:str,
+                      scope:str='pull', headers:Opt[dict]=None,
+                      **kwargs) -> requests.Response:
+  _ensure_requests_session_and_gtoken()
+  url = f"{_registry_url(registry)}/v2/{repo}/{path}"
+  token = _registry_token(registry, repo, scope)
+  resp = g_session.request(method, url, **kwargs,
+                           headers={**(headers or {}), 'Authorization': token})
+  if resp.status_code == 401:
+    debug(1, f"Registry token for {repo} was rejected, getting a new one")
+    token = _registry_token(registry, repo, scope, rejected=token)
+    resp = g_session.request(method, url, **kwargs,
+                             headers={**(headers or {}),
+                                      'Authorization': token})
+  return resp
 
 #----- Artifact locators and their dispatch. -----------------------------------
 
-DepFinder = Callable[[str,Opt[str]],Opt[str]]
+# An artifact found by a DepFinder. Its spec is 'kind uri', e.g.,
+#   gs gs://my-software/tarballs/kaldi.tar.gz#1588041253412345
+#   image us.gcr.io/my-project/mkl:2019.5
+# buildkeys are the build keys stamped on the artifact, none if it is unstamped.
+# The same artifact may be stamped with more than one key, if rebuilding it
+# with changed inputs has produced a byte-identical image. revision is the
+# object generation of a tarball, or the manifest digest of an image.
+@dataclass(frozen=True)
+class Artifact:
+  kind:str
+  uri:str
+  buildkeys:Tuple[str,...] = ()
+  revision:Opt[str] = None
+  def __str__(my):
+    return f"{my.kind} {my.uri}"
+
+DepFinder = Callable[[str,Opt[str]],Opt[Artifact]]
 
-def _find_tarball(name:str, ver:Opt[str]) -> Opt[str]:
+def _find_tarball(name:str, ver:Opt[str]) -> Opt[Artifact]:
   _ensure_gs_config()
-  _ensure_tarball_cache()
+  _ensure_tarball_index()
 
-  name_tgz = name + ".tar.gz"
-  namever_tgz = f"{name}-{ver}.tar.gz" if ver else None
-  for gver, __, gname, gener in g_tarball_cache:
-    if ((gname == name_tgz and gver == ver) or
-        (gname == namever_tgz and not gver)):
-      res = f"gs://{gs_software}/{TARBALLS_DIR}{gname}#{gener}"
-      debug(1, f"Found tarball {res} for name='{name}' and version='{ver}'")
-      return 'gs ' + res
+  if ver:
+    for key in ((name + '.tar.gz', ver), (f"{name}-{ver}.tar.gz", '')):
+      cand = g_tarball_index.get(key)
+      if cand:
+        res = f"gs://{gs_software}/{TARBALLS_DIR}{key[0]}#{cand[1]}"
+        debug(1, f"Found tarball {res} for name='{name}' and version='{ver}'")
+        return Artifact('gs', res, (cand[2],) if cand[2] else (),
+                        str(cand[1]))
 
   debug(1, f"No tarball found for name='{name}' and version='{ver}'")
   return None
 
 
-def _find_image(name:str, ver:Opt[str]) -> Opt[str]:
+# Accept all manifest kinds, so that the registry reports the digest of the
+# manifest as pushed, and does not try to convert it to the schema 1.
+MANIFEST_ACCEPT = ', '.join((
+  'application/vnd.docker.distribution.manifest.v2+json',
+  'application/vnd.docker.distribution.manifest.list.v2+json',
+  'application/vnd.oci.image.manifest.v1+json',
+  'application/vnd.oci.image.index.v1+json'))
+
+def _find_image(name:str, ver:Opt[str]) -> Opt[Artifact]:
   _ensure_gs_config()
-  _ensure_requests_session_and_gtoken()
 
   registry = f"{gs_location}.gcr.io"  # Registry service
   image = f"{g_project}/{name}"       # Image reference sans the tag.
 
-  # Trade gtoken for the registry token.
-  resp = g_session.get((f"https://{registry}/v2/token?service={registry}"
-                        f"&scope=repository:{image}:pull"),
-                       headers={'Authorization': g_gtoken})
-  _check_200(resp)
-  reg_token = 'Bearer ' + json.loads(resp.text)['token']
-
-  # Check if image:tag exists with the HEAD request.
+  # Check if image:tag exists with the HEAD request, conditional on the ETag
+  # from the last run if the image existed then.
   ver = ver or 'latest'
   imageref = f"{registry}/{image}:{ver}"
-  resp = g_session.head(f"https://{registry}/v2/{image}/manifests/{ver}",
-                        headers={'Authorization': reg_token})
-  if resp.status_code == 200:
-    debug(1, f"Found existing image {imageref}")
-    return 'image ' + imageref
-  if resp.status_code == 404:
-    debug(1, f"Image {imageref} does not exist")
-    return None
-  _check_200(resp)  # We know it's not 200; report a detailed error.
+  state = g_artifact_state.Get(imageref)
+  if _state_is_fresh(state):
+    debug(1, f"Using cached state of image {imageref}")
+    digest = state['digest']
+  else:
+    headers = {'Accept': MANIFEST_ACCEPT}
+    if state and state['etag']:
+      headers['If-None-Match'] = state['etag']
+    resp = _registry_request('HEAD', registry, image, f"manifests/{ver}",
+                             headers=headers)
+    if resp.status_code == 304:
+      digest, etag = state['digest'], state['etag']
+    elif resp.status_code == 200:
+      digest = resp.headers.get('Docker-Content-Digest') or '-'
+      etag = resp.headers.get('ETag')
+    elif resp.status_code == 404:
+      digest = etag = None
+    else:
+      _check_200(resp)  # We know it's not 200; report a detailed error.
+    # Build keys are looked up again only if the image has changed.
+    if state and state['digest'] == digest and 'buildkeys' in state:
+      buildkeys = state['buildkeys']
+    else:
+      buildkeys = digest and _image_buildkeys(registry, image, digest)
+    state = {'time': time.time(), 'digest': digest, 'etag': etag,
+             'buildkeys': buildkeys}
+    g_artifact_state.Put({imageref: state})
+
+  if digest:
+    debug(1, f"Found existing image {imageref}@{digest}")
+    return Artifact('image', imageref, tuple(state.get('buildkeys') or ()),
+                    digest)
+  debug(1, f"Image {imageref} does not exist")
+  return None
+
+
+# The build key of an image is stamped as an additional tag 'bk-<key>' of the
+# same manifest. To find it, list the tags of the repository: the GCR extension
+# to the tag list response maps each manifest digest to its tags. Registries
+# without this extension leave all images unstamped.
+BUILDKEY_TAG = 'bk-'
+
+def _image_buildkeys(registry:str, image:str, digest:str) -> List[str]:
+  resp = _registry_request('GET', registry, image, 'tags/list')
+  _check_200(resp)
+  tags = json.loads(resp.text).get('manifest', {}).get(digest, {}).get('tag')
+  keys = sorted(t[len(BUILDKEY_TAG):] for t in tags or ()
+                if t.startswith(BUILDKEY_TAG))
+  debug(2, f"Build keys of {registry}/{image}@{digest}: {keys}")
+  return keys
 
 
 # Dependency checker map; also defines valid full target directive names.
@@ -558,6 +1138,205 @@ depfind_dispatch:Map[str,DepFinder] = {
   'tar': _find_tarball,
 }
 
+#----- Stamping artifacts with build keys. -------------------------------------
+
+# Tarballs are stamped with the buildkey metadatum. This changes the
+# metageneration of the object, so the next run sees the tarballs directory
+# changed, and reloads it.
+def _stamp_tarball(art:Artifact, key:str) -> None:
+  bucket, obj, gen = re.fullmatch(r'gs://([^/]+)/(.+)#(\d+)', art.uri).groups()
+  _ensure_requests_session_and_gtoken()
+  resp = g_session.patch(f"{GCS_JSON_API}/b/{bucket}/o/{quote(obj, safe='')}",
+                         params={'generation': gen, 'fields': 'metadata'},
+                         json={'metadata': {'buildkey': key}},
+                         headers={'Authorization': g_gtoken})
+  _check_200(resp)
+
+# Images are stamped by pushing the same manifest under the 'bk-<key>' tag.
+# A rebuilt image supersedes the manifest that had its tag before, but the
+# 'bk-' tags would still pin the old manifest, and the delete_untagged_images
+# function would never reclaim it. So the manifests of the repository left with
+# nothing but 'bk-' tags are untagged, unless the registry lacks the GCR
+# extension to find them. Deleting a manifest by a tag deletes only the tag in
+# GCR.
+def _stamp_image(art:Artifact, key:str) -> None:
+  registry, __, imageref = art.uri.partition('/')
+  image, __, tag = imageref.rpartition(':')
+  resp = _registry_request('GET', registry, image, f"manifests/{tag}",
+                           scope='pull,push',
+                           headers={'Accept': MANIFEST_ACCEPT})
+  _check_200(resp)
+  digest = resp.headers.get('Docker-Content-Digest') or art.revision
+  resp = _registry_request('PUT', registry, image,
+                           f"manifests/{BUILDKEY_TAG}{key}", scope='pull,push',
+                           headers={'Content-Type':
+                                    resp.headers['Content-Type']},
+                           data=resp.content)
+  if resp.status_code != 201:
+    _check_200(resp)
+  resp = _registry_request('GET', registry, image, 'tags/list',
+                           scope='pull,push')
+  _check_200(resp)
+  for sha, man in json.loads(resp.text).get('manifest', {}).items():
+    tags = man.get('tag') or ()
+    if sha == digest or not all(t.startswith(BUILDKEY_TAG) for t in tags):
+      continue
+    for t in tags:
+      debug(1, f"Untagging superseded image {registry}/{image}:{t}@{sha}")
+      resp = _registry_request('DELETE', registry, image, f"manifests/{t}",
+                               scope='pull,push')
+      if resp.status_code not in (202, 404):
+        _check_200(resp)
+  state = g_artifact_state.Get(art.uri)
+  if state and state.get('digest'):
+    keys = sorted({*(state.get('buildkeys') or ()), key})
+    g_artifact_state.Put({art.uri: {**state, 'buildkeys': keys}})
+
+stamp_dispatch:Map[str,Callable[[Artifact,str],None]] = {
+  'gs': _stamp_tarball,
+  'image': _stamp_image,
+}
+
+#----- Concurrent probing. -----------------------------------------------------
+
+# Call fn on each of items, running up to g_jobs calls concurrently, and return
+# the list of results in the order of items, not in the order of completion.
+# Probes are I/O bound, so threads are just fine. An exception raised by any
+# call, including the SystemExit from fatal(), is reraised in the caller.
+def probe_all(fn:Callable, items:Seq) -> list:
+  items = list(items)
+  if g_jobs <= 1 or len(items) <= 1:
+    return list(map(fn, items))
+  with ThreadPoolExecutor(max_workers=min(g_jobs, len(items)),
+                          thread_name_prefix='probe') as pool:
+    return list(pool.map(fn, items))
+
+# Same, but yield pairs (item * result) in the order the calls complete, as
+# soon as each does, so that the caller may act on results of the fast probes
+# while the slow ones are still in flight.
+def probe_each(fn:Callable, items:Seq) -> Seq[Tuple]:
+  items = list(items)
+  if g_jobs <= 1 or len(items) <= 1:
+    yield from ((i, fn(i)) for i in items)
+    return
+  with ThreadPoolExecutor(max_workers=min(g_jobs, len(items)),
+                          thread_name_prefix='probe') as pool:
+    futures = {pool.submit(fn, i): i for i in items}
+    for f in as_completed(futures):
+      yield futures[f], f.result()
+
+#==============================================================================#
+# Build duration history.
+#==============================================================================#
+
+# Durations of successful builds are reported by bm-node-software with
+# --record, and kept in a cache file keyed by 'name version' ('-' for no
+# version), each entry holding the last HISTORY_SAMPLES durations in seconds
+# and the time of the last record. The estimate for a target is the mean of
+# its samples; absent these, the last known duration of any other version of
+# the same target; and absent even that, a wild guess of DEFAULT_BUILD_SECS.
+# Entries not updated for HISTORY_MAX_AGE are dropped.
+HISTORY_SAMPLES = 5
+HISTORY_MAX_AGE = 365 * 24 * 3600
+DEFAULT_BUILD_SECS = 900
+MAX_BUILDS = 10          # Cloud Build concurrency quota, by default.
+
+g_build_history = CacheFile('build-history')
+
+def _history_key(name:str, ver:Opt[str]) -> str:
+  return f"{name} {ver or '-'}"
+
+def record_build_time(name:str, ver:Opt[str], secs:float) -> None:
+  key = _history_key(name, ver)
+  ent = g_build_history.Get(key) or {}
+  samples = [*ent.get('secs', ()), secs][-HISTORY_SAMPLES:]
+  now = time.time()
+  g_build_history.Put(
+    {key: {'secs': samples, 'time': now}},
+    expired=lambda k, v: v.get('time', 0) < now - HISTORY_MAX_AGE)
+  debug(1, f"Recorded {secs:.0f}s build of {key}, history {samples}")
+
+# Return the estimated duration of building the target, and where it came from.
+def estimate_build_time(name:str, ver:Opt[str]) -> Tuple[float,str]:
+  ent = g_build_history.Get(_history_key(name, ver))
+  if ent and ent.get('secs'):
+    return sum(ent['secs']) / len(ent['secs']), 'history'
+  prefix = _history_key(name, None)[:-1]
+  others = [v for k, v in g_build_history.Load().items()
+            if k.startswith(prefix) and v.get('secs')]
+  if others:
+    last = max(others, key=lambda v: v.get('time', 0))
+    return last['secs'][-1], 'other version'
+  return DEFAULT_BUILD_SECS, 'guess'
+
+# 5025 => '1:23:45'.
+def _hms(secs:float) -> str:
+  m, s = divmod(round(secs), 60)
+  return f"{m // 60}:{m % 60:02}:{s:02}"
+
+#==============================================================================#
+# Build keys.
+#==============================================================================#
+
+# A build key identifies the inputs of a build: the kind, version, version
+# variable and substitutions of the target, the contents of its build directory,
+# and the build keys of the targets it depends on. A successful build stamps its
+# key on the artifact (miller.py --stamp), and an artifact stamped with keys
+# other than the current key of its target is out of date, even if its version
+# matches. Since the key includes the keys of dependencies, a change to any
+# input of a target rebuilds it and everything built from it, and nothing else.
+# Artifacts without a stamp, built before build keys were introduced, or with
+# bm-build by hand, are judged by version alone, as they always were.
+#
+# The build directory is located the same way bm-build does it: a buildpath
+# with no '/' is looked up in etc/build, then lib/build; any other is relative
+# to the current directory. The key is the SHA-256 of all this, truncated to
+# BUILDKEY_LEN hex digits to make a reasonably short image tag.
+
+BUILDKEY_LEN = 24
+BURRMILL_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def _build_dir(buildpath:str) -> Opt[str]:
+  if '/' in buildpath or buildpath in ('.', '..'):
+    dirs = [buildpath]
+  else:
+    dirs = [os.path.join(environ.get(var) or os.path.join(BURRMILL_ROOT, sub),
+                         'build', buildpath)
+            for var, sub in (('BURRMILL_ETC', 'etc'), ('BURRMILL_LIB', 'lib'))]
+  for d in dirs:
+    if os.path.isfile(os.path.join(d, 'cloudbuild.yaml')):
+      return d
+  return None
+
+# Hash names, executable bits and contents of all files under path, and targets
+# of symlinks, which are not followed.
+def _tree_digest(path:str) -> str:
+  h = hashlib.sha256()
+  for top, dirs, files in os.walk(path):
+    dirs.sort()
+    for f in sorted(files + [d for d in dirs
+                             if os.path.islink(os.path.join(top, d))]):
+      fp = os.path.join(top, f)
+      rel = os.path.relpath(fp, path)
+      if os.path.islink(fp):
+        h.update(f"L {rel}\0{os.readlink(fp)}\0".encode())
+        continue
+      with open(fp, 'rb') as fd:
+        fh = hashlib.sha256(fd.read()).hexdigest()
+      x = 'x' if os.access(fp, os.X_OK) else '-'
+      h.update(f"F{x} {rel}\0{fh}\0".encode())
+  return h.hexdigest()
+
+def build_key(t:'Target', depkeys:Map[str,str]) -> str:
+  bdir = _build_dir(t.buildpath)
+  if not bdir:
+    debug(1, f"Build directory of {t.buildpath} not found, not hashing it")
+  inputs = {'kind': t.kind, 'version': t.version, 'versvar': t.versvar,
+            'substs': t.substs, 'tree': bdir and _tree_digest(bdir),
+            'depends': {d: depkeys[d] for d in t.depends}}
+  key = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode())
+  return key.hexdigest()[:BUILDKEY_LEN]
+
 #==============================================================================#
 # Evaluating dependencies and controlling build and artifact gathering.
 #==============================================================================#
@@ -586,27 +1365,49 @@ class Target:
        ' '.join(f"{k}={v or ''}" for k, v in my.substs.items()),
        ' ## ', str(my.source)))
 
-  # E.g., "mkl 2019.5 image us.gcr.io/my-project/mkl:2019.5"
-  # None if not found, False to not gather (when for_gather only)
-  def GetArtifact(my, for_gather:bool):
-    if for_gather and my.kind == 'builder':
+  # E.g., Artifact('image', 'us.gcr.io/my-project/mkl:2019.5'); None if absent.
+  def FindArtifact(my) -> Opt[Artifact]:
+    return my.depfind(_target_name(my.buildpath), my.version)
+
+  # The artifact to gather, None if not found, False to not gather a builder.
+  def FindArtifactForGather(my):
+    if my.kind == 'builder':
       debug(1, f"Skipping non-deployable builder {my.buildpath}")
       return False
-    name = _target_name(my.buildpath)
-    art = my.depfind(name, my.version)
-    return ' '.join((name, my.version or '-', art)) if art else None
+    return my.FindArtifact()
 
+  # E.g., "mkl 2019.5 image us.gcr.io/my-project/mkl:2019.5"
+  def GetArtifactSpec(my, art:Artifact) -> str:
+    return ' '.join((_target_name(my.buildpath), my.version or '-', str(art)))
+
+  # Variables passed to the build, including the version variable.
+  def GetBuildVars(my) -> Map[str,str]:
+    bvars = dict(my.substs)
+    if my.versvar and my.version:
+      bvars[my.versvar] = my.version
+    return bvars
 
   # E. g., 'build mkl 2019.5 _MKL_VER=2019.5'
   # E. g., 'build cxx -'
   def GetBuildSpec(my) -> str:
-    spec = ['build',
-            _target_name(my.buildpath),
-            my.version or '-',
-            *(f"{k}={v}" for k, v in my.substs.items())]
-    if my.versvar and my.version:
-      spec.append(f"{my.versvar}={my.version}")
-    return ' '.join(spec)
+    return ' '.join(['build',
+                     _target_name(my.buildpath),
+                     my.version or '-',
+                     *(f"{k}={v}" for k, v in my.GetBuildVars().items())])
+
+  # An NDJSON output record of the target and its artifact art, if any; see
+  # _run() for the format.
+  def GetRecord(my, rtype:str, art:Opt[Artifact], status:str) -> dict:
+    rec = {'type': rtype, 'name': _target_name(my.buildpath),
+           'version': my.version, 'kind': my.kind,
+           'uri': art.uri if art else None}
+    if art and art.revision:
+      if art.kind == 'gs':
+        rec['generation'] = int(art.revision)
+      else:
+        rec['digest'] = art.revision
+    rec['status'] = status
+    return rec
 
 
 # Note that the data is mutable, only the references are frozen.
@@ -617,6 +1418,7 @@ class BuildPlan:
   _skips:Set[str]   = field(default_factory=set)
   _starts:Set[str]  = field(default_factory=set)
   _forces:Set[str]  = field(default_factory=set)
+  _keys:Map[str,str] = field(default_factory=dict)  # Memo for BuildKey().
 
   def __repr__(my):
     def setstr(s): return str(s) if s else '{}'
@@ -757,6 +1559,11 @@ class BuildPlan:
       my._AddToSet("force", my._forces, force)
 
 
+  # (name * version) of all tarball targets, whether selected or not.
+  def TarballVersions(my) -> Seq[Tuple[str,Opt[str]]]:
+    return [(_target_name(t.buildpath), t.version)
+            for t in my._targets.values() if t.kind == 'tar']
+
   # Check if any defined target depends on an undefined one.
   def _ValidateDanglingDeps(my) -> None:
     known = set(my._targets)
@@ -776,124 +1583,726 @@ class BuildPlan:
     starts:Set[str] = set(my._starts or my._targets) - my._skips
     debug(2, f"Inferring order from starting targets {starts}")
 
-    # Build closure off starting targets. Copy their dependency sets, we'll
-    # mutate them in-place during toposorting.
-    clos = {}; seed = starts
+    # Build closure off starting targets, visiting each target once.
+    clos:Map[str,Set[str]] = {}; seed = list(starts)
     while seed:
-      add = {k:set(my._targets[k].depends) for k in seed}
-      seed = reduce(set.union, add.values()) - set(clos)
-      clos.update(add)
+      k = seed.pop()
+      if k in clos: continue
+      clos[k] = my._targets[k].depends
+      seed.extend(clos[k])
     debug(2, f"Closure of selected dependencies: {clos}")
 
     # Now toposort with the closure with the usual Kahn's, and collect batches
-    # of satisfied dependencies into an ordered list
+    # of satisfied dependencies into an ordered list. Count unsatisfied
+    # dependencies of each target, and keep reverse edges to find the targets
+    # that depend on the just ranked ones, so that every target and edge is
+    # looked at once, and not on every rank.
+    pending = {k: len(d) for k, d in clos.items()}
+    users:Map[str,List[str]] = {k: [] for k in clos}
+    for k, deps in clos.items():
+      for d in deps: users[d].append(k)
     res = []
-    while True:
-      rank = set(filterfalse(clos.get, clos))
-      if not rank: break
-      for k in rank: del clos[k]
-      for k in clos: clos[k] -= rank
+    rank = {k for k, n in pending.items() if not n}
+    while rank:
       res.append(rank)
-    if clos:
-      fatal(f"Circular dependencies found: {clos}")
+      for k in rank: del pending[k]
+      nextrank = set()
+      for k in rank:
+        for u in users[k]:
+          pending[u] -= 1
+          if not pending[u]: nextrank.add(u)
+      rank = nextrank
+    if pending:
+      cycle = my._FindCycle(set(pending))
+      fatal(f"Circular dependencies found: {' -> '.join(cycle)}")
     debug(1, f"Evaluated build order w.r.t. dependencies: {res}")
     # Note that res may contains skips if they are dependencies of something.
     # This is not yet fatal, but will be if any of them is out-of-date.
     return res
 
 
+  # Find a dependency cycle among targets left over by the toposort, and return
+  # it as a list of targets, e.g. [a, b, c, a], meaning a depends on b, etc.
+  # Every leftover target has a leftover dependency, so following them from any
+  # target must eventually come back to a target seen before.
+  def _FindCycle(my, leftover:Set[str]) -> List[str]:
+    path, seen = [], {}
+    k = min(leftover)
+    while k not in seen:
+      seen[k] = len(path)
+      path.append(k)
+      k = min(d for d in my._targets[k].depends if d in leftover)
+    return path[seen[k]:] + [k]
+
+  # Build key of target t; see build_key(). Must be called after BuildOrder(),
+  # which rejects circular dependencies.
+  def BuildKey(my, t:str) -> str:
+    if t not in my._keys:
+      tgt = my._targets[t]
+      my._keys[t] = build_key(tgt, {d: my.BuildKey(d) for d in tgt.depends})
+    return my._keys[t]
+
   # Helpers to avoid excessively long lambdas.
   def _GetBuildSpec(my, t) -> str:
     return my._targets[t].GetBuildSpec()
 
-  def _GetArtifact(my, t, for_gather) -> Opt[str]:
-    return my._targets[t].GetArtifact(for_gather)
+  def _GetBuildRecord(my, t, need:Opt[List[str]]=None) -> dict:
+    tgt = my._targets[t]
+    rec = {'type': 'build', 'name': t, 'version': tgt.version,
+           'kind': tgt.kind, 'key': my.BuildKey(t), 'vars': tgt.GetBuildVars()}
+    if need is not None:
+      rec['need'] = need
+    return rec
 
-  # This is the where we convert build order into build sequence: collect what
-  # is missing and must be built, for the first invocation of the tool.
-  def ConstructBuild(my, plan) -> List[List[str]]:
-    # Pretend the artifact is not there if rebuilding by force.
-    def _GetArtifactForBuild(t:str):
-      return None if t in my._forces else my._GetArtifact(t, for_gather=False)
+  # Let artifact locators know in advance what they will be asked for.
+  def _PlanLookups(my, plan) -> None:
+    plan_tarball_lookups(t for t in chain(*plan)
+                         if my._targets[t].kind == 'tar')
 
+  # This is the where we convert build order into build sequence: collect what
+  # is missing and must be built, for the first invocation of the tool. All
+  # artifacts of a rank are probed concurrently; targets within a rank are
+  # sorted by name, so that the output is reproducible. If report is given, it
+  # is called with a record of each target as soon as its probe completes, and
+  # with an end record after all probes of a rank.
+  def _DirtyRanks(my, plan, report=None) -> List[List[str]]:
+    # The target is dirty if its artifact is missing, or if rebuilding it by
+    # force, or if the artifact is stamped with build keys, but not with the
+    # current one.
+    def _ProbeForBuild(t:str) -> Tuple[Opt[Artifact],str]:
+      if t in my._forces: return None, 'forced'
+      art = my._targets[t].FindArtifact()
+      if not art: return None, 'missing'
+      if art.buildkeys and my.BuildKey(t) not in art.buildkeys:
+        debug(1, f"Artifact {art} of {t} was built with build keys "
+                 f"{art.buildkeys}, current key is {my.BuildKey(t)}")
+        return art, 'stale'
+      return art, 'current'
+
+    for t in chain(*plan):  # Not in the probe threads.
+      my.BuildKey(t)
+    my._PlanLookups(plan)
     res, blockers = [], set()
-    for tset in plan:
-      dirty = set(filterfalse(_GetArtifactForBuild, tset))
+    for rank, tset in enumerate(plan):
+      dirty = []
+      for t, (art, status) in probe_each(_ProbeForBuild, tset):
+        if status != 'current':
+          dirty.append(t)
+        if report:
+          report(my._targets[t].GetRecord('probe', art, status))
+      if report:
+        report({'type': 'end', 'batch': 'probe', 'rank': rank})
       if not dirty: continue
+      dirty.sort()
       if blockers:
         fatal(f"Target(s) {blockers} are explicitly prevented from being built "
-              f"with the 'skip' directive, but one or more target in {dirty} "
-              f"are out-of-date and depend on it. As a rule, mark only "
-              f"independent targets to be skipped.")
-      blockers.update(dirty.intersection(my._skips))
-      # Turn each element of 'dirty' into a build directive.
-      res.append(list(map(my._GetBuildSpec, dirty)))
+              f"with the 'skip' directive, but one or more target in "
+              f"{set(dirty)} are out-of-date and depend on it. As a rule, mark "
+              f"only independent targets to be skipped.")
+      blockers.update(my._skips.intersection(dirty))
+      res.append(dirty)
     return res
 
+  # Map each target of the build sequence to the targets of the same sequence
+  # that must be built successfully before this one may start.
+  #
+  # A dependency that is up to date is not waited for, but it stands in for its
+  # own out-of-date dependencies, recursively. This is what ranks would do, too:
+  # an up-to-date target does not block anything, but whatever it is built from
+  # is still ordered before whatever is built from it.
+  def _BuildDeps(my, ranks) -> Map[str,Set[str]]:
+    dirty = set(chain(*ranks))
+    memo:Map[str,Set[str]] = {}
+    def dirty_deps(t:str) -> Set[str]:
+      if t not in memo:
+        memo[t] = set()
+        for d in my._targets[t].depends:
+          memo[t] |= {d} if d in dirty else dirty_deps(d)
+      return memo[t]
+    return {t: dirty_deps(t) for t in dirty}
+
+  # The critical path of a target is the longest chain of estimated build
+  # durations from its start to the end of the whole sequence, through the
+  # targets that depend on it. Starting the targets with longer critical paths
+  # first gets the sequence done sooner with a limited number of concurrent
+  # builds. Since a target's path is strictly longer than that of any target
+  # depending on it, ordering by critical path is also a valid build order.
+  def _CriticalPaths(my, ranks, deps:Map[str,Set[str]]) -> Map[str,float]:
+    cp:Map[str,float] = {}
+    for t in reversed(list(chain(*ranks))):  # Dependents come first.
+      secs, __ = estimate_build_time(t, my._targets[t].version)
+      cp[t] = max(1, secs) + cp.get(t, 0)
+      for d in deps[t]:
+        cp[d] = max(cp.get(d, 0), cp[t])
+    return cp
+
+  # Build sequence as ranks of build directives. Every build in a rank must
+  # complete before any of the next rank may start. Within a rank, targets are
+  # sorted by their critical path, longest first.
+  def ConstructBuild(my, plan, report=None) -> List[List[str]]:
+    ranks = my._DirtyRanks(plan, report)
+    cp = my._CriticalPaths(ranks, my._BuildDeps(ranks))
+    ranks = [sorted(r, key=lambda t: -cp[t]) for r in ranks]
+    if report:
+      for rank, r in enumerate(ranks):
+        for t in r:
+          report(my._GetBuildRecord(t))
+        report({'type': 'end', 'batch': 'build', 'rank': rank})
+    return [[my._GetBuildSpec(t) for t in r] for r in ranks]
+
+  # Build sequence as a DAG: a list of (name * directive * dependencies), where
+  # dependencies are the targets in the same list that must be built first.
+  # Ranks make the slowest build of a rank hold back all of the next, even
+  # targets that do not depend on it; with the DAG, the caller may start each
+  # build as soon as its own dependencies are done. The list is ordered by the
+  # critical path, longest first, and the caller should start ready builds in
+  # this order when it can run only so many at once.
+  def ConstructBuildDag(my, plan,
+                        report=None) -> List[Tuple[str,str,List[str]]]:
+    ranks = my._DirtyRanks(plan, report)
+    deps = my._BuildDeps(ranks)
+    cp = my._CriticalPaths(ranks, deps)
+    dag = [(t, my._GetBuildSpec(t), sorted(deps[t]))
+           for t in sorted(chain(*ranks), key=lambda t: (-cp[t], t))]
+    if report:
+      for t, __, need in dag:
+        report(my._GetBuildRecord(t, need))
+    return dag
+
+  # Simulate running the DAG build sequence, as returned by ConstructBuildDag,
+  # with up to max_builds concurrent builds, and report the expected start and
+  # duration of each build, and the total wall time.
+  def EstimateBuild(my, dag, max_builds:int) -> None:
+    est = {t: estimate_build_time(t, my._targets[t].version) for t, *__ in dag}
+    pending = [(t, set(deps)) for t, __, deps in dag]
+    start, finished, running, now = {}, set(), [], 0
+    while pending or running:
+      for t, deps in list(pending):
+        if len(running) >= max_builds: break
+        if deps <= finished:
+          start[t] = now
+          heapq.heappush(running, (now + est[t][0], t))
+          pending.remove((t, deps))
+      now, t = heapq.heappop(running)
+      finished.add(t)
+    info(f"Estimated build time, running at most {max_builds} builds at once, "
+         f"is {_hms(now)}:",
+         *(f"\n>|   {_hms(start[t])} +{_hms(est[t][0])} {t} ({est[t][1]})"
+           for t in sorted(start, key=lambda t: (start[t], t))))
+
+
+  # Stamp the artifact of target name with the build key, after a successful
+  # build. The key is passed from the build sequence, rather than computed
+  # again: the build directory may have been edited while the build ran.
+  def StampArtifact(my, name:str, key:str) -> None:
+    if name not in my._targets:
+      fatal(f"Unknown target '{name}' to stamp")
+    art = my._targets[name].FindArtifact()
+    if not art:
+      fatal(f"Target '{name}' has no artifact to stamp with build key {key}")
+    if key in art.buildkeys:
+      debug(1, f"Artifact {art} is already stamped with build key {key}")
+      return
+    stamp_dispatch[art.kind](art, key)
+    debug(1, f"Stamped artifact {art} with build key {key}")
+
+
+  # Serialize the targets and skips, as loaded from Millfiles, for caching.
+  def ToCache(my) -> dict:
+    return {
+      'targets': [[t.source.filename, t.source.lineno, t.kind, t.buildpath,
+                   t.version, t.versvar, sorted(t.depends), t.substs]
+                  for t in my._targets.values()],
+      'skips': sorted(my._skips)}
+
+  # The reverse of ToCache().
+  @classmethod
+  def FromCache(cls, data:dict) -> 'BuildPlan':
+    plan = cls()
+    for fn, ln, kind, bp, ver, vv, deps, substs in data['targets']:
+      plan._targets[_target_name(bp)] = Target(
+        source=FileLine(fn, ln), depfind=depfind_dispatch[kind], kind=kind,
+        buildpath=bp, version=ver, versvar=vv, depends=frozenset(deps),
+        substs=dict(substs))
+    plan._skips.update(data['skips'])
+    return plan
+
+
+  # Manifest (name * version) of artifacts to gather, not looked up; '-' if none.
+  def ManifestVersions(my, plan) -> List[Tuple[str,str]]:
+    return [(_target_name(t.buildpath), t.version or '-')
+            for t in map(my._targets.get, chain(*plan)) if t.kind != 'builder']
 
   # For the post-build gather phase, check that artifacts are really there and
   # return them for assembling the R/O software disk. It's an error if any
   # artifact is missing, and a damn tricky one to track down!
-  def ConstructGather(my, plan):
-    errs = set()
-    # Accumulate all errors for reporting in one pass as a side effect. Note
-    # that this is the only place when we distinguish None and False for the
-    # artifact: None is an error (artifact not found), and False stands to skip
-    # gathering (a builder, not yielding an artifact) without an error.
-    def _GetArtifactForGather(t:str):
-      art = my._GetArtifact(t, for_gather=True)
-      if art is None: errs.add(t)
-      return art
-
+  #
+  # If report is given, it is called with a record of each target as soon as
+  # its probe completes, so that the caller may start fetching the artifact.
+  def ConstructGather(my, plan, report=None):
     # At the gather stage the order is irrelevant. Lump all artifacts into a
-    # single flat sequence for collecting.
-    res = list(filter(None, map(_GetArtifactForGather, chain(*plan))))
+    # single flat sequence for collecting, and probe them all at once.
+    my._PlanLookups(plan)
+    arts = {}
+    for t, art in probe_each(lambda t: my._targets[t].FindArtifactForGather(),
+                             chain(*plan)):
+      arts[t] = art
+      if report:
+        status = 'skipped' if art is False else 'found' if art else 'missing'
+        report(my._targets[t].GetRecord('gather', art or None, status))
+
+    # Accumulate all errors for reporting in one pass. Note that this is the
+    # only place when we distinguish None and False for the artifact: None is
+    # an error (artifact not found), and False stands to skip gathering (a
+    # builder, not yielding an artifact) without an error.
+    errs = {t for t, a in arts.items() if a is None}
     if errs:
       fatal(f"Build did not produce expected artifacts for targets {errs}. "
             f"Check the build logs, whether the artifact type (tar or image) "
             f"is correct, and whether the build control file places the "
             f"artifact where it should be, with the correct version tarball "
             f"metadatum or image tag.")
-    return res
+    return [my._targets[t].GetArtifactSpec(arts[t])
+            for t in sorted(arts) if arts[t]]
+
+#----- Compiled Millfile cache. ------------------------------------------------
+
+# Reading, tokenizing and validating a long chain of Millfiles is not free, but
+# they rarely change. The resolved targets and skips are cached, keyed by the
+# hash of the names and contents of all files in the chain, and of this script
+# itself, in case parsing rules change. Any edit to any of them is a cache miss.
+# Warnings about suspicious 'ver' directives are printed only when the chain is
+# parsed, i.e., after it is changed, not on every run. Entries not written for
+# PLAN_CACHE_MAX_AGE are dropped.
+
+PLAN_CACHE_MAX_AGE = 7 * 24 * 3600
+
+g_plan_cache = CacheFile('millfile-plans')
+
+def _millfile_chain_key(files:Seq[str]) -> Opt[str]:
+  h = hashlib.sha256()
+  try:
+    for fn in (os.path.realpath(__file__), *files):
+      with open(fn, 'rb') as f:
+        data = f.read()
+      h.update(f"{fn}\0{len(data)}\0".encode())
+      h.update(data)
+  except OSError:
+    return None  # Let the parser report the problem.
+  return h.hexdigest()
+
+# Load a BuildPlan from the chain of Millfiles, or its cached compiled form.
+def load_plan(files:Seq[str]) -> BuildPlan:
+  files = list(files)
+  key = _millfile_chain_key(files)
+  cached = key and g_plan_cache.Get(key)
+  if cached:
+    debug(1, f"Using compiled Millfile chain {key[:12]}")
+    return BuildPlan.FromCache(cached)
+
+  plan = BuildPlan()
+  for x in _tokenize(_read_real_files(files)):
+    plan.AddDirective(x)
+  if key:
+    now = time.time()
+    g_plan_cache.Put({key: {**plan.ToCache(), 'time': now}},
+                     expired=lambda k, v: v['time'] < now - PLAN_CACHE_MAX_AGE)
+  return plan
 
 #==============================================================================#
-# Main entrypoint.
+# Garbage collection of tarball generations.
 #==============================================================================#
 
-def _unsafe_main():
-  global g_project, gs_location, gs_software
-  args = parse_args()
-  g_project = args.project
-  gs_location = args.gs_location
-  gs_software = args.gs_software
+# Every build of a tarball target uploads a new generation of the object, and
+# the versioned bucket retains the old ones, until the lifecycle policy in
+# lib/policy/software.lifecycle.json deletes them by age. Most of these are
+# never used again, but make the tarball index slower to load, and cost money.
+#
+# A noncurrent generation is referenced if it is the one _find_tarball() would
+# return for a tarball target in the Millfiles, i.e., the best candidate for
+# its (filename * version), or likewise for a (name * version) passed with
+# --keep; bm-node-software passes the versions from labels of CNS snapshots,
+# so that any existing snapshot can be reassembled. Current objects are never
+# touched. Everything else goes: older generations of a version rebuilt with
+# different inputs, versions no longer mentioned anywhere, and noncurrent
+# objects without the version metadatum, which are not candidates at all.
+#
+# The output is a line per tarball file with garbage, 'gc FILE COUNT BYTES',
+# giving the number and total size of the generations deleted, or, with
+# --dry-run, that would be deleted. Deletions are batched and run concurrently
+# by gcsdk.storage.DeleteObjects(), --jobs batch requests at a time.
+
+# All (filename * version) to keep. Unversioned targets cannot have tarballs.
+def _gc_referenced(build_plan:BuildPlan,
+                   keep:Seq[str]) -> Set[Tuple[str,str]]:
+  refs = {(name, ver) for name, ver in build_plan.TarballVersions() if ver}
+  refs.update(tuple(kv.split('=', 1)) for kv in keep)
+  return {(name + '.tar.gz', ver) for name, ver in refs}
+
+# Return the list of (name * generation * size) of garbage objects.
+def _gc_find_garbage(refs:Set[Tuple[str,str]]) -> List[Tuple[str,int,int]]:
+  best, noncurrent = {}, []
+  for o in _list_tarball_objects('', versions=True, fields=GCS_SIZED_FIELDS):
+    if not o.name.endswith('.tar.gz'): continue
+    current = 0 if o.timeDeleted else 1
+    if not current:
+      noncurrent.append(o)
+    version = o.metadata.get('version', '')
+    if not (version or current): continue
+    key = (o.name.rpartition('/')[-1], version)
+    best[key] = max(best.get(key, (-1, -1)), (current, o.generation))
+  keep = {gen for key, (cur, gen) in best.items() if key in refs and not cur}
+  debug(1, f"Listed {len(noncurrent)} noncurrent tarball generations, "
+           f"{len(keep)} referenced")
+  return [(o.name, o.generation, o.size) for o in noncurrent
+          if o.generation not in keep]
+
+# 1234567 => '1.2 MiB'.
+def _bytes(n:int) -> str:
+  for unit in ('B', 'KiB', 'MiB', 'GiB'):
+    if n < 1024: break
+    n /= 1024
+  else:
+    unit = 'TiB'
+  return f"{n:.1f} {unit}" if unit != 'B' else f"{n} B"
+
+def collect_garbage(build_plan:BuildPlan, keep:Seq[str],
+                    dry_run:bool) -> None:
+  global g_tarball_index
+  _ensure_gs_config()
+  with span('gc-list'):
+    garbage = _gc_find_garbage(_gc_referenced(build_plan, keep))
+  sizes = {(n, g): z for n, g, z in garbage}
+
+  done, failed = [], 0
+  if dry_run:
+    done = garbage
+  elif garbage:
+    with span('gc-delete', count=len(garbage)):
+      with span('sdk-import'):
+        storage = gcsdk.storage
+      for name, gen, err in storage.DeleteObjects(
+          gs_software, [(n, g) for n, g, __ in garbage], jobs=g_jobs):
+        if err:
+          warn(f"Cannot delete gs://{gs_software}/{name}#{gen}: {err}")
+          failed += 1
+        else:
+          done.append((name, gen, sizes[name, gen]))
+    # Deleted generations may be in the cached tarball index.
+    with g_lock:
+      g_tarball_index = None
+    where = f"gs://{gs_software}/{TARBALLS_DIR}"
+    g_artifact_state.Put({}, expired=lambda k, v: k.startswith(where))
+
+  files = {}
+  for name, __, size in done:
+    count, total = files.get(name, (0, 0))
+    files[name] = (count + 1, total + size)
+  for name, (count, total) in sorted(files.items()):
+    print('gc', name.rpartition('/')[-1], count, total)
+  total = sum(size for *__, size in done)
+  info(f"{'Would reclaim' if dry_run else 'Reclaimed'} {_bytes(total)} "
+       f"in {len(done)} noncurrent tarball generations")
+  if failed:
+    fatal(f"Failed to delete {failed} tarball generations")
+
+#==============================================================================#
+# CNS snapshot index.
+#==============================================================================#
+
+# A CNS snapshot is labeled with the names and versions of the software on it,
+# a 'bmv_<name>=<version>' label each, so looking for a snapshot with a given
+# manifest takes listing all snapshots and matching all labels. Instead, the
+# manifest is identified by its digest, which is also stamped on the snapshot
+# as the label 'bmdigest=<digest>', and the snapshots with known digests are
+# kept in the local index, a cache file keyed by the project and digest. Same
+# as bmv_* labels, the digest covers only names and versions: the lines 'name
+# version' of the gather manifest ('-' for no version), sorted, and hashed.
+# It is truncated to 128 bits, as label values are limited to 63 characters.
+#
+# The index is only a hint, and the snapshots may be deleted behind its back.
+# The callers (see FindCnsSnapshots in cluster.inc.sh) verify that indexed
+# snapshots exist, and update the index with the verified list.
+
+MANIFEST_DIGEST_LEN = 32
+SNAPSHOT_INDEX_MAX_AGE = 365 * 24 * 3600
+
+g_snapshot_index = CacheFile('cns-snapshots')
 
-  build_plan = BuildPlan()
+def manifest_digest(pairs:Seq[Tuple[str,str]]) -> str:
+  text = ''.join(f"{name} {ver}\n" for name, ver in sorted(set(pairs)))
+  return hashlib.sha256(text.encode()).hexdigest()[:MANIFEST_DIGEST_LEN]
 
-  x = _read_real_files(args.files)
-  for x in _tokenize(x):
-    build_plan.AddDirective(x)
+def find_snapshots(project:str, digest:str) -> List[str]:
+  ent = g_snapshot_index.Get(f"{project} {digest}")
+  return ent['names'] if ent else []
 
-  # Process command line args only when all files are loaded.
-  build_plan.FromCommandLineArgs(**vars(args))
+# An empty list of names is stored, too, so that it overrides a non-empty one
+# which may have been loaded from the file already.
+def index_snapshots(project:str, digest:str, names:Seq[str]) -> None:
+  now = time.time()
+  g_snapshot_index.Put(
+    {f"{project} {digest}": {'names': list(names), 'time': now}},
+    expired=lambda k, v: v['time'] < now - SNAPSHOT_INDEX_MAX_AGE)
+
+#==============================================================================#
+# Service mode.
+#==============================================================================#
+
+# The shell tooling invokes miller.py a few times per command, and each time it
+# would import the SDK, authenticate, get the project configuration and list
+# GCS from scratch. With --serve, miller.py listens on a Unix socket instead,
+# and runs requests sent by miller_client.py one at a time, keeping all this
+# state warm between them. Each request is an ordinary miller.py command line,
+# and its stdout, stderr and exit status are sent back for the client to
+# reproduce. The project configuration and the tarball index are dropped after
+# --serve-ttl seconds, or on the 'invalidate' request, which the tooling sends
+# when a build may have changed artifacts. Image state is revalidated with a
+# conditional request on every use anyway.
+#
+# The protocol is one JSON object per connection in each direction. Requests:
+#   {"argv": [...], "cwd": "/dir", "env": {"gs_location": ..., ...}}
+#   {"op": "invalidate"}
+#   {"op": "stop"}
+# Response: {"stdout": "...", "stderr": "...", "status": 0}
+
+SERVE_TTL = 600
+SERVE_ENV = ('gs_location', 'gs_software')  # Environment passed by client.
+
+g_serve_ttl:int = SERVE_TTL
+g_warm_since:float = 0
+
+def _drop_warm_state() -> None:
+  global g_warm_since, g_gtoken, g_project, gs_location, gs_software
+  global g_tarball_index, g_tarball_names
+  with g_lock:
+    g_gtoken = g_project = gs_location = gs_software = None
+    g_tarball_index = g_tarball_names = None
+    g_warm_since = time.time()
+
+
+# Run one miller.py command line, capturing its output and exit status.
+def _serve_run(argv:Seq[str], cwd:str, env:Map[str,str]) -> dict:
+  global g_gtoken
+  if time.time() - g_warm_since > g_serve_ttl:
+    debug(1, 'Warm state has expired')
+    _drop_warm_state()
+  g_gtoken = None  # Cheap to get again, and this one may be about to expire.
+  # One-shot runs may have written to the cache files meanwhile, e.g., recorded
+  # a build time while the service was not running.
+  for cache in (g_artifact_state, g_regtokens, g_build_history, g_plan_cache,
+                g_snapshot_index):
+    cache.Refresh()
+
+  out, err, status = io.StringIO(), io.StringIO(), 0
+  saved_env = {k: environ.get(k) for k in SERVE_ENV}
+  try:
+    os.chdir(cwd)
+    for k in SERVE_ENV:
+      if env.get(k): environ[k] = env[k]
+      else: environ.pop(k, None)
+    with redirect_stdout(out), redirect_stderr(err):
+      try:
+        _unsafe_main(argv)
+      except _Error as e:
+        fatal(e)
+      except Exception:
+        traceback.print_exc()
+        status = 1
+  except SystemExit as e:
+    status = e.code if isinstance(e.code, int) else int(e.code is not None)
+  finally:
+    for k, v in saved_env.items():
+      if v is None: environ.pop(k, None)
+      else: environ[k] = v
+  return {'stdout': out.getvalue(), 'stderr': err.getvalue(), 'status': status}
+
+
+class _ServeHandler(socketserver.StreamRequestHandler):
+  def handle(my):
+    try:
+      req = json.loads(my.rfile.read())
+    except ValueError as e:
+      debug(1, f"Malformed request: {e}")
+      return
+    op = req.get('op', 'run')
+    debug(1, f"Request {op}: {req.get('argv', '')}")
+    if op == 'run':
+      resp = _serve_run(req['argv'], req['cwd'], req.get('env', {}))
+    elif op == 'invalidate':
+      _drop_warm_state()
+      resp = {'status': 0}
+    elif op == 'stop':
+      threading.Thread(target=my.server.shutdown).start()
+      resp = {'status': 0}
+    else:
+      resp = {'stderr': f"{ME}: unknown request '{op}'\n", 'status': 2}
+    my.wfile.write(json.dumps(resp).encode())
+
+
+def serve(path:str, ttl:int) -> None:
+  global g_colors_ready, g_serve_ttl, INFO, WARNING, FATAL, SGR0
+  g_serve_ttl = ttl
+  # Replies may go to a different terminal, or to none at all.
+  g_colors_ready = True
+  INFO, WARNING, FATAL, SGR0 = 'INFO', 'WARNING', 'FATAL', ''
+
+  # Refuse to run if the socket is live; remove it if stale.
+  if os.path.exists(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      try:
+        sock.connect(path)
+        fatal(f"Another instance is already serving on {path}")
+      except OSError:
+        os.unlink(path)
+
+  _drop_warm_state()
+  signal.signal(signal.SIGTERM, lambda *__: sys.exit(0))
+  old_umask = os.umask(0o077)  # The socket is for the user only.
+  try:
+    with socketserver.UnixStreamServer(path, _ServeHandler) as server:
+      os.umask(old_umask)
+      info(f"Serving on {path}, warm state TTL {ttl}s")
+      server.serve_forever()
+  finally:
+    os.umask(old_umask)
+    try: os.unlink(path)
+    except OSError: pass
+    info('Stopped serving')
+
+#==============================================================================#
+# Main entrypoint.
+#==============================================================================#
+
+def _unsafe_main(argv:Opt[Seq[str]]=None):
+  global g_gcs_api, g_jobs, g_max_stale
+  # In service mode, the run starts now, not when the process did.
+  origin = time.perf_counter() if g_warm_since else T_START
+  args = parse_args(argv)
+  g_gcs_api = args.gcs_api
+  g_jobs = args.jobs
+  g_max_stale = args.max_stale
+  debug(1, f"Cold start took {1000*(time.perf_counter() - T_START):.0f} ms")
+  if args.serve:
+    return serve(args.socket or environ.get('MILLER_SOCKET') or
+                 DefaultSocketPath(create=True), args.serve_ttl)
+  with collect_stats(args.stats, args.trace, origin):
+    _run(args)
+
+# With --format=ndjson, the output is a stream of JSON records, one per line,
+# each printed as soon as it is known, rather than directives after all probes.
+# Artifact records of targets, of the type 'probe' when building, or 'gather'
+# when gathering, come in the order the probes complete:
+#   {"type": "probe", "name": "kaldi", "version": "1234abc", "kind": "tar",
+#    "uri": "gs://b/tarballs/kaldi.tar.gz#1588041253412345",
+#    "generation": 1588041253412345, "status": "current"}
+# uri is null if there is no artifact. The tarball object generation is given
+# in "generation", the image manifest digest in "digest". The status is one of:
+#   probe:  "current" | "missing" | "stale" (built from different inputs) |
+#           "forced" (not probed at all, rebuilt by --force);
+#   gather: "found" | "missing" | "skipped" (builders are not gathered).
+# The build sequence follows all probes, a 'build' record per build directive:
+#   {"type": "build", "name": "kaldi", "version": "1234abc", "kind": "tar",
+#    "key": "<build key>", "vars": {"_KALDI_VER": "1234abc"},
+#    "need": ["cxx", "mkl"]}
+# with "need" only with --dag. End-of-batch records {"type": "end", "batch":
+# "probe" | "build", "rank": N} follow all probes of a rank of the build order,
+# and all builds of a rank of the build sequence without --dag (where text
+# output has 'wait'). The last record is always {"type": "end"}, with the
+# manifest digest in "digest" if --digest is given; if it is missing, the run
+# has failed. Records are streamed only when miller.py is run
+# directly: the service sends the output all at once when the run completes.
+
+def _print_record(rec:dict) -> None:
+  print(json.dumps(rec), flush=True)
+
+def _run(args:ap.Namespace):
+  global g_project, gs_location, gs_software, g_tarball_index
+  if args.record:
+    record_build_time(*args.record)
+    if not args.stamp: return
+
+  # In service mode, globals may retain values from the previous request.
+  if args.project and args.project != g_project:
+    _drop_warm_state()
+  g_project = args.project or g_project
+  gs_location = args.gs_location or gs_location
+  gs_software = args.gs_software or gs_software
+
+  if args.find_snapshot:
+    for name in find_snapshots(g_project, args.find_snapshot):
+      print(name)
+    return
+  if args.index_snapshots:
+    return index_snapshots(g_project, args.index_snapshots[0],
+                           args.index_snapshots[1:])
+
+  with span('load'):
+    build_plan = load_plan(args.files)
+
+    # Process command line args only when all files are loaded.
+    build_plan.FromCommandLineArgs(**vars(args))
 
   debug(1, f"Load complete. {build_plan}")
-  plan = build_plan.BuildOrder()
+  if args.gc:
+    return collect_garbage(build_plan, args.keep, args.dry_run)
+  if args.stamp:
+    # In service mode, the index may predate the build just completed.
+    with g_lock:
+      g_tarball_index = None
+    with span('stamp'):
+      return build_plan.StampArtifact(*args.stamp)
+
+  with span('order'):
+    plan = build_plan.BuildOrder()
+
+  # Output builder or gatherer directives to stdout, or records, which are
+  # printed by the Construct* methods as they go.
+  report = _print_record if args.format == 'ndjson' else None
+  digest = None
+  if args.gather:
+    # Doing gather.
+    with span('gather'):
+      gather = build_plan.ConstructGather(plan, report)
+    for direc in gather if not report else ():
+      print(direc)
+    if args.digest:
+      digest = manifest_digest(tuple(d.split()[:2]) for d in gather)
+
+  elif args.digest:
+    # Only the digest, from Millfiles alone.
+    digest = manifest_digest(build_plan.ManifestVersions(plan))
+
+  elif args.dag:
+    # Doing build, dependency graph form. 'key' and 'need' precede the target's
+    # 'build'.
+    with span('build'):
+      buildseq = build_plan.ConstructBuildDag(plan, report)
+    for name, direc, deps in buildseq if not report else ():
+      print('key', name, build_plan.BuildKey(name))
+      if deps:
+        print('need', name, *deps)
+      print(direc)
+    if not buildseq:
+      info(f"Examined build targets {sorted(chain(*plan))} are all up-to-date")
+    elif args.estimate:
+      build_plan.EstimateBuild(buildseq, args.max_builds)
 
-  # Output builder or gatherer directives to stdout.
-  if not args.gather:
+  else:
     # Doing build.
-    buildspec:Seq[Seq[str]] = build_plan.ConstructBuild(plan)
-    for batch in buildspec:
+    with span('build'):
+      buildspec:Seq[Seq[str]] = build_plan.ConstructBuild(plan, report)
+    for batch in buildspec if not report else ():
       for direc in batch:
         print(direc)
       print('wait')
     if not buildspec:
       info(f"Examined build targets {sorted(chain(*plan))} are all up-to-date")
 
-  else:
-    # Doing gather.
-    for direc in build_plan.ConstructGather(plan):
-      print(direc)
+  if report:
+    report({'type': 'end', **({'digest': digest} if digest else {})})
+  elif digest:
+    print('digest', digest)
 
 def _main():
   try:
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- python-indent-offset: 2; -*-
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2020 Kirill 'kkm' Katsnelson
+
+# A thin client to 'miller.py --serve'. It accepts the same command line as
+# miller.py, sends it to the service and reproduces its stdout, stderr and exit
+# status, so the two are interchangeable. If the service is not running, it
+# simply runs miller.py in its place. This module imports only the standard
+# library, so that it starts fast: the whole point is to not pay the startup
+# costs of miller.py on every invocation.
+#
+# Two options are handled by the client itself, and must go first:
+#   --invalidate  Tell the service to drop the warm state, e.g., after a build
+#                 has changed artifacts. Nothing is done if it is not running.
+#   --stop        Stop the service.
+#
+# The service socket is taken from the environment variable MILLER_SOCKET, or
+# the default location is used, same as that of 'miller.py --serve'.
+
+import json
+import os
+import socket
+import sys
+import tempfile
+
+from cachefile import UserCacheDir
+
+def DefaultSocketPath(create:bool=False) -> str:
+  """Return the default path of the miller.py service socket.
+
+  The socket is in the user's cache directory if it exists, or can be created
+  if create is true, which only the service needs to do; otherwise it is in the
+  temporary directory.
+  """
+  try:
+    path = UserCacheDir(create=create)
+    if os.path.isdir(path):
+      return os.path.join(path, 'miller.sock')
+  except OSError:
+    pass
+  return os.path.join(tempfile.gettempdir(), f"miller-{os.getuid()}.sock")
+
+
+# Send request to the service and return its response, or None if the service
+# is not running.
+def Request(req:dict, path:str=None):
+  path = path or os.environ.get('MILLER_SOCKET') or DefaultSocketPath()
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    try:
+      sock.connect(path)
+    except OSError:
+      return None
+    sock.sendall(json.dumps(req).encode())
+    sock.shutdown(socket.SHUT_WR)
+    chunks = []
+    while True:
+      chunk = sock.recv(65536)
+      if not chunk: break
+      chunks.append(chunk)
+  return json.loads(b''.join(chunks)) if chunks else None
+
+
+def _main(argv) -> int:
+  if argv[:1] in (['--invalidate'], ['--stop']):
+    Request({'op': argv[0][2:]})
+    return 0
+
+  resp = Request({'argv': argv, 'cwd': os.getcwd(),
+                  'env': {k: os.environ.get(k)
+                          for k in ('gs_location', 'gs_software')}})
+  if resp is None:
+    miller = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          'miller.py')
+    os.execv(sys.executable, [sys.executable, miller, *argv])
+
+  sys.stdout.write(resp.get('stdout', ''))
+  sys.stderr.write(resp.get('stderr', ''))
+  return resp.get('status', 1)
+
+if __name__ == '__main__':
+  sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- python-indent-offset: 2; -*-
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2020 Kirill 'kkm' Katsnelson
+
+# Checks of libexec/buildtrack.py against a local stand-in for the builds.list
+# method of the Cloud Build API, so that no project is needed. The tracker is
+# run as bm-node-software runs it, as a separate process reading its output,
+# but with short polling intervals. Builds in the stand-in are queued for a
+# moment, then work, then finish at set times. Each check prints 'ok' or what
+# is wrong, and the exit status is non-zero if any has failed.
+#
+# Usage: maint/buildcheck.py [--timeout 60] [CHECK...]
+
+import argparse as ap
+import faulthandler
+import os
+import re
+import subprocess
+import sys
+import time
+
+from typing import List, Optional as Opt
+from urllib.parse import parse_qs, urlsplit
+
+import millbench as mb
+
+BUILDTRACK = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          '..', 'libexec', 'buildtrack.py')
+PROJECT = 'bench'
+QUEUED = 0.1  # Seconds a build is queued before it starts working.
+
+class FakeCloudBuild(mb._Handler):
+  """The builds.list method of the Cloud Build API, filtered by build IDs.
+
+  builds: maps build IDs to (start * finish * status * secs), where start and
+          finish are the time.monotonic() when the build starts working, and
+          when it finishes with the status, and secs is the run time it
+          reports. 'STATUS_UNKNOWN' is reported as is.
+  page_size: the most builds returned per page, to exercise pagination.
+  faults: HTTP statuses to reply to the next requests instead of serving them,
+          one each.
+  """
+  builds = {}
+  page_size = 2
+  faults = []
+
+  # The resource of the build i as it is at the moment.
+  def _Build(my, i:str) -> dict:
+    start, finish, status, secs = my.builds[i]
+    now = time.monotonic()
+    if now < start:
+      return {'id': i, 'status': 'QUEUED'}
+    start = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(1588000000))
+    b = {'id': i, 'status': 'WORKING', 'startTime': f"{start}.123456789Z"}
+    if now >= finish:
+      end = time.gmtime(1588000000 + secs)
+      b['finishTime'] = time.strftime('%Y-%m-%dT%H:%M:%S.5Z', end)
+      b['status'] = status
+    return b
+
+  def do_GET(my):
+    my._Count()
+    with my.lock:
+      code = my.faults and FakeCloudBuild.faults.pop(0)
+    if code:
+      return my._Reply(code)
+    url = urlsplit(my.path)
+    if url.path != f"/v1/projects/{PROJECT}/builds":
+      return my._Reply(404)
+    q = {k: v[0] for k, v in parse_qs(url.query).items()}
+    ids = [i for i in re.findall(r'build_id="([^"]+)"', q.get('filter', ''))
+           if i in my.builds]
+    start = int(q.get('pageToken') or 0)
+    size = min(int(q.get('pageSize') or my.page_size), my.page_size)
+    page = {'builds': [my._Build(i) for i in ids[start:start + size]]}
+    if start + size < len(ids):
+      page['nextPageToken'] = str(start + size)
+    my._ReplyJson(page)
+
+
+g_endpoint:str = ''
+
+# Set up the builds in the stand-in, each given as (id * delay * status * secs),
+# finishing delay seconds from now.
+def _Builds(*builds) -> None:
+  now = time.monotonic()
+  FakeCloudBuild.builds = {i: (now + min(QUEUED, delay), now + delay,
+                               status, secs)
+                           for i, delay, status, secs in builds}
+  FakeCloudBuild.faults = []
+  mb._Handler.requests = 0
+
+def _Track(*args, stdin=subprocess.DEVNULL) -> subprocess.Popen:
+  return subprocess.Popen(
+    [sys.executable, BUILDTRACK, f"--project={PROJECT}", '--anonymous',
+     f"--endpoint={g_endpoint}", '--min-interval=0.05', '--max-interval=0.2',
+     *args], stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    text=True)
+
+# Run the tracker to completion; return its exit status and output lines.
+def _Run(*args) -> (int, List[str]):
+  proc = _Track(*args)
+  out, __ = proc.communicate()
+  return proc.returncode, out.splitlines()
+
+#----- Checks. -----------------------------------------------------------------
+
+# Builds finishing at different times are each reported as soon as observed,
+# in the order they finish, with the time they ran. There are more than fit on
+# one page, and the first to finish is on the second page.
+def CheckCompletions() -> Opt[str]:
+  _Builds(('b1', 0.6, 'SUCCESS', 300), ('b2', 1.0, 'TIMEOUT', 3600),
+          ('b3', 0.2, 'FAILURE', 100))
+  status, lines = _Run('--all', 'b1', 'b2', 'b3')
+  expect = ['done b3 FAILURE 100', 'done b1 SUCCESS 300',
+            'done b2 TIMEOUT 3600']
+  if status != 0 or lines != expect:
+    return f"exit status {status}, output {lines}"
+  # Without --all, only the first completion is waited for.
+  _Builds(('b1', 0.6, 'SUCCESS', 300), ('b3', 0.2, 'FAILURE', 100))
+  status, lines = _Run('b1', 'b3')
+  if status != 0 or lines != expect[:1]:
+    return f"exit status {status}, output {lines} without --all"
+  return None
+
+# A build with STATUS_UNKNOWN but with the finishTime is complete.
+def CheckUnknownStatus() -> Opt[str]:
+  _Builds(('b1', 0.2, 'STATUS_UNKNOWN', 60), ('b2', 30, 'SUCCESS', 60))
+  status, lines = _Run('b1', 'b2')
+  if status != 0 or lines != ['done b1 STATUS_UNKNOWN 60']:
+    return f"exit status {status}, output {lines}"
+  return None
+
+# Server errors and throttling are retried.
+def CheckRetries() -> Opt[str]:
+  _Builds(('b1', 0.3, 'SUCCESS', 60))
+  FakeCloudBuild.faults = [500, 503, 429, 502]
+  status, lines = _Run('b1')
+  if FakeCloudBuild.faults:
+    return f"{len(FakeCloudBuild.faults)} faults were not replied"
+  if status != 0 or lines != ['done b1 SUCCESS 60']:
+    return f"exit status {status}, output {lines}"
+  return None
+
+# Other client errors are not retried, and fail the tracker right away.
+def CheckClientError() -> Opt[str]:
+  _Builds(('b1', 0.3, 'SUCCESS', 60))
+  FakeCloudBuild.faults = [403]
+  status, lines = _Run('b1')
+  if status != 1 or lines:
+    return f"exit status {status}, output {lines}"
+  if mb._Handler.requests != 1:
+    return f"{mb._Handler.requests} requests made after a 403"
+  return None
+
+# With --follow, builds started later are watched by the same tracker, which
+# exits as soon as stdin is closed, whether or not any builds are pending.
+def CheckFollow() -> Opt[str]:
+  _Builds(('b1', 0.2, 'SUCCESS', 60), ('b2', 0.4, 'SUCCESS', 120),
+          ('b3', 30, 'SUCCESS', 60))
+  proc = _Track('--follow', 'b1', stdin=subprocess.PIPE)
+  lines = [proc.stdout.readline().strip()]
+  proc.stdin.write('b2\nb3\n')
+  proc.stdin.flush()
+  lines.append(proc.stdout.readline().strip())
+  proc.stdin.close()
+  lines += proc.stdout.read().splitlines()
+  proc.wait()
+  if proc.returncode != 0 or lines != ['done b1 SUCCESS 60',
+                                       'done b2 SUCCESS 120']:
+    return f"exit status {proc.returncode}, output {lines}"
+  return None
+
+
+CHECKS = {'completions': CheckCompletions, 'unknown-status': CheckUnknownStatus,
+          'retries': CheckRetries, 'client-error': CheckClientError,
+          'follow': CheckFollow}
+
+def _main() -> int:
+  global g_endpoint
+  p = ap.ArgumentParser(
+    description="Check buildtrack.py against a local Cloud Build stand-in.")
+  a = p.add_argument
+  a('checks', metavar='CHECK', nargs='*',
+    help=f"Checks to run: {', '.join(CHECKS)}. Default all.")
+  a('--timeout', metavar='SECS', type=float, default=60,
+    help="Consider a check hung after that long. Default %(default)s.")
+  o = p.parse_args()
+  unknown = set(o.checks) - set(CHECKS)
+  if unknown:
+    p.error(f"Unknown checks: {', '.join(sorted(unknown))}")
+
+  g_endpoint = mb.StartServer(FakeCloudBuild)
+  failed = 0
+  for name in o.checks or CHECKS:
+    faulthandler.dump_traceback_later(o.timeout, exit=True)
+    err = CHECKS[name]()
+    faulthandler.cancel_dump_traceback_later()
+    print(f"{name}: {err or 'ok'}")
+    failed += bool(err)
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(_main())
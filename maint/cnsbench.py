@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- python-indent-offset: 2; -*-
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2020 Kirill 'kkm' Katsnelson
+
+# Benchmark and check of the CNS disk assembler, lib/imaging/scripts/
+# cns_assemble.py, against the local stand-ins for the GCS JSON API and the
+# registry v2 API from millbench.py, so that neither a project nor an assembly
+# VM is needed.
+#
+# --artifacts synthetic tarballs are generated, each with --files files of
+# random content, --size MiB in total, under opt/<name>/, and also a slice env
+# file, a symlink and a hard link, a file shared by all artifacts (the last one
+# in the manifest must win), and files outside opt/, which must not be
+# extracted. Half of the tarballs have members named './opt/...'.
+#
+# --images synthetic images of --layers layers are generated, too. The first
+# layer has files which the last one hides with a whiteout, a whole directory
+# hidden likewise, and a directory made opaque. The middle layers hold the
+# --size MiB of files. Half of the images are listed in an OCI index, so that
+# the assembler has to pick the linux/amd64 one. The registry stand-in asks for
+# a token, and redirects blob requests, as GCR does.
+#
+# The manifest is then assembled twice: first one artifact at a time with a
+# single request per tarball or layer, which is about what 'gsutil cat | tar'
+# in cns_disk.sh did, and then by Assemble() with all the concurrency it has.
+# Both results are compared with what is expected file by file, and the wall
+# times reported.
+#
+# The stand-ins delay each response by --latency, and send media at most at
+# --bandwidth MiB/s per request, which is about what a single stream from GCS
+# to a small VM gets. With --fail-every, every so many media requests fail,
+# to see that retries work. With --composite, objects have no MD5, as is the
+# case with composite objects, and CRC32C is verified instead, however slow.
+#
+# Usage: maint/cnsbench.py [--artifacts 8] [--images 2] [--size 32]
+
+import argparse as ap
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import time
+
+_HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..', 'lib', 'imaging', 'scripts'))
+import cns_assemble as cns  # pylint: disable=wrong-import-position
+import millbench as mb      # pylint: disable=wrong-import-position
+
+MiB = cns.MiB
+
+#----- Synthetic artifacts. ----------------------------------------------------
+
+class Tar:
+  """A tar being made in memory, and the map of what it holds under opt/:
+  path => ('file', sha256) | ('link', target). Member names get the prefix.
+  """
+  def __init__(my, prefix:str=''):
+    my.prefix = prefix
+    my.content = {}
+    my._buf = io.BytesIO()
+    my._tf = tarfile.open(fileobj=my._buf, mode='w')
+
+  def _Add(my, path:str, kind:bytes, data:bytes=b'', link:str='') -> None:
+    ti = tarfile.TarInfo(my.prefix + path)
+    ti.type, ti.linkname, ti.mode, ti.size = kind, link, 0o755, len(data)
+    my._tf.addfile(ti, io.BytesIO(data))
+
+  def Dir(my, path:str) -> None:
+    my._Add(path, tarfile.DIRTYPE)
+
+  def File(my, path:str, data:bytes) -> None:
+    my._Add(path, tarfile.REGTYPE, data)
+    if path.startswith('opt/') and '/.wh.' not in path:
+      my.content[path] = ('file', hashlib.sha256(data).hexdigest())
+
+  def Symlink(my, path:str, target:str) -> None:
+    my._Add(path, tarfile.SYMTYPE, link=target)
+    my.content[path] = ('link', target)
+
+  def Hardlink(my, path:str, target:str) -> None:
+    my._Add(path, tarfile.LNKTYPE, link=my.prefix + target)
+    my.content[path] = my.content[target]
+
+  def Gzip(my) -> bytes:
+    my._tf.close()
+    return gzip.compress(my._buf.getvalue(), compresslevel=1)
+
+
+# Return the gzipped tarball of artifact i, and the map of what it holds.
+def MakeTarball(i:int, nfiles:int, size:int) -> tuple:
+  name = f"a{i:02}"
+  tar = Tar('./' if i % 2 else '')
+  tar.Dir('opt')
+  tar.Dir(f"opt/{name}")
+  tar.Dir(f"opt/{name}/bin")
+  for k in range(nfiles):
+    tar.File(f"opt/{name}/bin/f{k:04}", os.urandom(size // nfiles))
+  tar.Dir('opt/etc')
+  tar.File(f"opt/etc/{name}.user.slice.env", f"PATH=/opt/{name}/bin\n".encode())
+  tar.File('opt/etc/shared', f"written by {name}\n".encode())
+  tar.Symlink(f"opt/{name}/latest", 'bin/f0000')
+  tar.Hardlink(f"opt/{name}/f0000.hard", f"opt/{name}/bin/f0000")
+  tar.File('README', b'Not under opt/, must not be extracted.\n')
+  tar.File('junk/opt/x', b'Not under opt/ either.\n')
+  return tar.Gzip(), tar.content
+
+
+# Return the gzipped layers of image i, and the map of what the image holds.
+def MakeImage(i:int, nlayers:int, nfiles:int, size:int) -> tuple:
+  name = f"im{i:02}"
+  layers, content = [], {}
+  def layer(tar:Tar) -> None:
+    layers.append(tar.Gzip())
+    content.update(tar.content)
+
+  tar = Tar()
+  tar.Dir('opt')
+  tar.Dir(f"opt/{name}")
+  tar.File(f"opt/{name}/gone", b'Hidden by a whiteout.\n')
+  tar.File(f"opt/{name}/olddir/x", b'Hidden with the directory.\n')
+  tar.File(f"opt/{name}/cache/old", b'Hidden by the opaque directory.\n')
+  tar.Dir('opt/etc')
+  tar.File(f"opt/etc/{name}.user.slice.env", f"PATH=/opt/{name}/bin\n".encode())
+  tar.File('opt/etc/shared', f"written by {name} too early\n".encode())
+  tar.File('etc/passwd', b'Not under opt/, must not be extracted.\n')
+  layer(tar)
+
+  nmiddle = nlayers - 2
+  for k in range(1, nlayers - 1):
+    tar = Tar()
+    for f in range(nfiles):
+      tar.File(f"opt/{name}/bin/l{k}f{f:04}",
+               os.urandom(size // (nmiddle * nfiles)))
+    layer(tar)
+
+  tar = Tar()
+  tar.File(f"opt/{name}/.wh.gone", b'')
+  tar.File(f"opt/{name}/.wh.olddir", b'')
+  tar.File(f"opt/{name}/cache/.wh..wh..opq", b'')
+  tar.File(f"opt/{name}/cache/new", b'Not hidden, same layer.\n')
+  tar.File('opt/etc/shared', f"written by {name}\n".encode())
+  tar.File('.wh.etc', b'')
+  tar.Symlink(f"opt/{name}/latest", 'bin/l1f0000')
+  layer(tar)
+  for path in ('gone', 'olddir/x', 'cache/old'):
+    del content[f"opt/{name}/{path}"]
+  return layers, content
+
+
+# Put the tarballs to the stand-in, and return the manifest lines.
+def PopulateGcs(tarballs:list, composite:bool) -> list:
+  objects, manifest = [], []
+  for i, data in enumerate(tarballs):
+    name, gen = f"tarballs/a{i:02}.tar.gz", str(1588000000000000 + i)
+    o = {'name': name, 'generation': gen, 'metageneration': '1',
+         'size': str(len(data))}
+    if composite or cns.FAST_CRC32C:
+      crc = (cns.FAST_CRC32C or cns.Crc32c)(data)
+      o['crc32c'] = base64.b64encode(crc.to_bytes(4, 'big')).decode()
+    if not composite:
+      o['md5Hash'] = base64.b64encode(hashlib.md5(data).digest()).decode()
+    objects.append(o)
+    mb.FakeGcs.media[name, gen] = data
+    manifest.append(f"a{i:02} 1.0 gs gs://{mb.BUCKET}/{name}#{gen}")
+  mb.FakeGcs.objects = objects
+  return manifest
+
+
+# Put the images to the registry stand-in, and return the manifest lines.
+def PopulateRegistry(images:list) -> list:
+  def put(mtype:str, data:dict) -> dict:
+    body = json.dumps(data).encode()
+    digest = f"sha256:{hashlib.sha256(body).hexdigest()}"
+    mb.FakeRegistry.manifests[digest] = mtype, body
+    return {'mediaType': mtype, 'digest': digest, 'size': len(body)}
+
+  manifest = []
+  for i, layers in enumerate(images):
+    descs = []
+    for data in layers:
+      digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+      mb.FakeRegistry.blobs[digest] = data
+      descs.append({'mediaType': LAYER_TYPE, 'digest': digest,
+                    'size': len(data)})
+    desc = put(MANIFEST_TYPE, {'schemaVersion': 2, 'mediaType': MANIFEST_TYPE,
+                               'layers': descs})
+    if i % 2:
+      # A decoy for the wrong platform first, as the real one has nothing.
+      decoy = put(MANIFEST_TYPE, {'schemaVersion': 2, 'layers': []})
+      desc = put(INDEX_TYPE, {'schemaVersion': 2, 'manifests': [
+        {**decoy, 'platform': {'os': 'linux', 'architecture': 'arm64'}},
+        {**desc, 'platform': {'os': 'linux', 'architecture': 'amd64'}}]})
+    mb.FakeRegistry.images[f"bench/im{i:02}:1.0"] = desc['digest']
+    manifest.append(f"im{i:02} 1.0 image bench.gcr.io/bench/im{i:02}:1.0")
+  mb.FakeRegistry.require_token = True
+  return manifest
+
+MANIFEST_TYPE = 'application/vnd.oci.image.manifest.v1+json'
+INDEX_TYPE = 'application/vnd.oci.image.index.v1+json'
+LAYER_TYPE = 'application/vnd.oci.image.layer.v1.tar+gzip'
+
+#----- Checking the result. ----------------------------------------------------
+
+# Return the map of what is in the directory root, same as Tar has, and the
+# list of paths which should not be there at all, including empty directories.
+def ScanTree(root:str) -> tuple:
+  found, stray = {}, []
+  for top, dirs, files in os.walk(root):
+    if not (dirs or files):
+      stray.append(os.path.relpath(top, root) + '/')
+    for fn in files + [d for d in dirs if os.path.islink(os.path.join(top, d))]:
+      full = os.path.join(top, fn)
+      path = os.path.relpath(full, root)
+      if not path.startswith('opt/') or '.~cns' in fn:
+        stray.append(path)
+      elif os.path.islink(full):
+        found[path] = ('link', os.readlink(full))
+      else:
+        with open(full, 'rb') as f:
+          found[path] = ('file', hashlib.sha256(f.read()).hexdigest())
+  return found, stray
+
+def Check(root:str, expect:dict) -> bool:
+  found, stray = ScanTree(root)
+  ok = True
+  for path in sorted(set(found) | set(expect)):
+    if found.get(path) != expect.get(path):
+      print(f"  MISMATCH {path}: expected {expect.get(path)}, "
+            f"found {found.get(path)}", file=sys.stderr)
+      ok = False
+  for path in stray:
+    print(f"  STRAY {path}", file=sys.stderr)
+    ok = False
+  return ok
+
+
+def _main() -> int:
+  p = ap.ArgumentParser(
+    description="Benchmark cns_assemble.py on synthetic tarballs locally.")
+  a = p.add_argument
+  a('--artifacts', type=int, default=8,
+    help="Number of tarballs. Default %(default)s.")
+  a('--images', type=int, default=2,
+    help="Number of images. Default %(default)s.")
+  a('--layers', type=int, default=4,
+    help="Number of layers in each image, at least 3. Default %(default)s.")
+  a('--size', metavar='MIB', type=int, default=32,
+    help="Size of each artifact, MiB. Default %(default)s.")
+  a('--files', type=int, default=20,
+    help="Number of files in each tarball or layer. Default %(default)s.")
+  a('--latency', metavar='MS', type=float, default=20,
+    help="Response latency of the stand-in. Default %(default)s.")
+  a('--bandwidth', metavar='MIB', type=float, default=40,
+    help="Bandwidth of each media response, MiB/s. Default %(default)s.")
+  a('--fail-every', metavar='N', type=int, default=0,
+    help="Fail every N'th media request with a 503. Default never.")
+  a('--composite', action='store_true',
+    help="Objects have no MD5 hash, only CRC32C.")
+  a('--jobs', '-j', type=int, default=cns.JOBS,
+    help="Concurrent range requests. Default %(default)s.")
+  a('--chunk-size', metavar='MIB', type=int, default=cns.CHUNK_SIZE // MiB,
+    help="Size of a range request, MiB. Default %(default)s.")
+  a('--memory', metavar='MIB', type=int, default=cns.MEMORY // MiB,
+    help="Memory budget for chunks in flight, MiB. Default %(default)s.")
+  o = p.parse_args()
+  if o.layers < 3:
+    p.error('Need at least 3 --layers')
+
+  print(f"Generating {o.images} images and {o.artifacts} tarballs "
+        f"of {o.size} MiB", file=sys.stderr)
+  # Images are applied first, then tarballs, each in order.
+  expect, images, tarballs = {}, [], []
+  for i in range(o.images):
+    layers, content = MakeImage(i, o.layers, o.files, o.size * MiB)
+    images.append(layers)
+    expect.update(content)
+  for i in range(o.artifacts):
+    data, content = MakeTarball(i, o.files, o.size * MiB)
+    tarballs.append(data)
+    expect.update(content)
+  # Listed out of order, for the assembler to sort out.
+  arts = cns.ReadManifest(PopulateGcs(tarballs, o.composite) +
+                          PopulateRegistry(images))
+  sizes = [sum(map(len, layers)) for layers in images] + \
+          [len(data) for data in tarballs]
+  total = sum(sizes) / MiB
+
+  mb._Handler.latency = o.latency / 1000
+  mb._Handler.bandwidth = o.bandwidth * MiB
+  mb._Handler.fail_every = o.fail_every
+  gcs = cns.GcsClient(mb.StartServer(mb.FakeGcs))
+  registry = cns.RegistryClient(mb.StartServer(mb.FakeRegistry))
+
+  def serial(root:str) -> None:
+    for art, size in zip(arts, sizes):
+      cns.Assemble([art], root, gcs, registry, jobs=1, chunk=size,
+                   memory=2 * size)
+
+  def concurrent(root:str) -> None:
+    cns.Assemble(arts, root, gcs, registry,
+                 o.jobs, o.chunk_size * MiB, o.memory * MiB)
+
+  print(f"{'mode':>10} {'s':>7} {'MiB/s':>7} {'requests':>9} result")
+  ok = True
+  for mode, fn in (('serial', serial), ('concurrent', concurrent)):
+    with tempfile.TemporaryDirectory() as root:
+      mb._Handler.requests = 0
+      t = time.perf_counter()
+      fn(root)
+      t = time.perf_counter() - t
+      good = Check(root, expect)
+      ok &= good
+      print(f"{mode:>10} {t:7.2f} {total / t:7.1f} {mb._Handler.requests:9} "
+            f"{'ok' if good else 'MISMATCH'}")
+  return 0 if ok else 1
+
+if __name__ == '__main__':
+  sys.exit(_main())
@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+# -*- python-indent-offset: 2; -*-
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2020 Kirill 'kkm' Katsnelson
+
+# Benchmark of the miller.py hot paths on synthetic Millfiles, against local
+# stand-ins for the GCS JSON API and the Docker registry v2 API, so that no
+# project is needed. Our own Millfile has under a dozen targets, but generated
+# ones may have thousands, and what is linear and what is not starts to matter.
+#
+# For each size N, a Millfile of N targets is generated with a dependency DAG
+# of the given shape, and these phases are measured:
+#   parse   read, tokenize and validate the Millfile;
+#   load    load it the way miller.py does, from the compiled Millfile cache;
+#   order   BuildPlan.BuildOrder();
+#   build   BuildPlan.ConstructBuild(), probing all artifacts;
+#   gather  BuildPlan.ConstructGather(), probing all artifacts again;
+#   relist  ConstructBuild() with a warm index, stale names: see below;
+#   prefix  same, but rebuilding the index by per-prefix lookups.
+# For each phase, the wall time (best of --repeat runs), the number of requests
+# the stand-ins served, and the peak Python memory allocated by the phase are
+# reported. The memory is measured in a separate run under tracemalloc, which is
+# slow, so that it does not skew the time. Artifact probes in the build and
+# gather phases start cold, without the artifact state cached by the previous
+# run.
+#
+# The last two phases are what a warm miller.py service does after the Millfile
+# has changed: the state of the tarballs directory, with the object count from
+# the last full listing, is cached, but the index is not, nor is the state of
+# any name prefix. The index is rebuilt either by revalidating the full listing
+# (relist), or by listing only the name prefixes of the tarball targets
+# (prefix). miller.py picks one by PREFIX_LIST_RATIO; here, each is forced in
+# turn, so that both are measured.
+#
+# Dependency graph shapes are:
+#   chain    each target depends on the previous one, N ranks deep.
+#   wide     all targets depend on one common builder, 2 ranks.
+#   layered  targets are in ~sqrt(N) layers, each depends on up to --fanin
+#            random targets of the layers above. This is the realistic one.
+#
+# Every --image-every'th target is an image, the rest are tarballs. All their
+# artifacts exist, each tarball also has --generations noncurrent versions, and
+# the bucket holds --extra-objects unrelated tarballs. The stand-ins delay every
+# response by --latency milliseconds.
+#
+# Usage: maint/millbench.py [--sizes 100,1000] [--shape layered] [--latency 20]
+
+import argparse as ap
+import hashlib
+import http.server
+import json
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from urllib.parse import parse_qs, unquote, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'libexec'))
+import miller  # pylint: disable=wrong-import-position
+
+SHAPES = ('chain', 'wide', 'layered')
+PHASES = ('parse', 'load', 'order', 'build', 'gather', 'relist', 'prefix')
+
+PROJECT = 'bench'
+LOCATION = 'us'
+BUCKET = 'bench-software'
+
+#----- Synthetic Millfiles. ----------------------------------------------------
+
+# Return the text of a Millfile with n targets t00000 ... of the given shape.
+def GenerateMillfile(n:int, shape:str, fanin:int=3, image_every:int=0,
+                     seed:int=42) -> str:
+  rnd = random.Random(seed)
+  names = [f"t{i:05}" for i in range(n)]
+  if shape == 'chain':
+    deps = [names[i-1:i] for i in range(n)]
+  elif shape == 'wide':
+    deps = [names[:1] if i else [] for i in range(n)]
+  else:
+    width = max(1, round(math.sqrt(n)))
+    deps = [rnd.sample(names[:i - i % width],
+                       min(fanin, i - i % width))
+            for i in range(n)]
+  lines = ['# Generated by millbench.py']
+  for i, (name, dd) in enumerate(zip(names, deps)):
+    kind = 'image' if image_every and i % image_every == 0 else 'tar'
+    line = f"{kind} {name} 1.0 _{name.upper()}_VER"
+    if dd:
+      line += ' : ' + ' '.join(dd)
+    lines.append(line)
+  return '\n'.join(lines) + '\n'
+
+#----- API stand-ins. ----------------------------------------------------------
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  """Common part of the stand-ins: latency, request counting, replies.
+
+  bandwidth: bytes per second a media response is sent at, 0 for unlimited.
+  fail_every: reply 503 to every fail_every'th media request, 0 for never.
+  """
+  protocol_version = 'HTTP/1.1'  # Keep-alive, like the real thing.
+  latency = 0.0
+  requests = 0
+  bandwidth = 0
+  fail_every = 0
+  media_requests = 0
+  lock = threading.Lock()
+
+  def log_message(my, *args): pass
+
+  def _Count(my) -> None:
+    with my.lock:
+      _Handler.requests += 1
+    time.sleep(my.latency)
+
+  def _Reply(my, code:int, body:bytes=b'', headers:dict=None) -> None:
+    my.send_response(code)
+    for k, v in (headers or {}).items():
+      my.send_header(k, v)
+    my.send_header('Content-Length', str(len(body)))
+    my.end_headers()
+    if my.command != 'HEAD':
+      my.wfile.write(body)
+
+  def _ReplyJson(my, data) -> None:
+    my._Reply(200, json.dumps(data).encode(),
+              {'Content-Type': 'application/json'})
+
+  # Reply the content of an object or blob, honoring Range.
+  def _ReplyMedia(my, data:bytes) -> None:
+    with my.lock:
+      _Handler.media_requests += 1
+      fail = my.fail_every and my.media_requests % my.fail_every == 0
+    if fail:
+      return my._Reply(503)
+    m = re.fullmatch(r'bytes=(\d+)-(\d+)', my.headers.get('Range', ''))
+    if m:
+      start, end = int(m[1]), min(int(m[2]) + 1, len(data))
+      headers = {'Content-Range': f"bytes {start}-{end - 1}/{len(data)}"}
+      code, data = 206, data[start:end]
+    else:
+      code, headers = 200, {}
+    if my.bandwidth:
+      time.sleep(len(data) / my.bandwidth)
+    my._Reply(code, data, headers)
+
+
+class FakeGcs(_Handler):
+  """The objects.list and objects.get methods of the GCS JSON API, over a fixed
+  object list.
+
+  objects: object resources, sorted by name and generation.
+  media: maps (name, generation) to the content of objects which have it.
+  """
+  objects = []
+  media = {}
+  page_size = 1000  # The API default and maximum.
+
+  # Reply the object resource, or its content with alt=media, honoring Range.
+  def _GetObject(my, name:str, q:dict) -> None:
+    gen = q.get('generation')
+    found = [o for o in my.objects if o['name'] == name and
+             (o['generation'] == gen if gen else 'timeDeleted' not in o)]
+    if not found:
+      return my._Reply(404)
+    obj = found[-1]
+    if q.get('alt') != 'media':
+      return my._ReplyJson(obj)
+    my._ReplyMedia(my.media[name, obj['generation']])
+
+  def do_GET(my):
+    my._Count()
+    url = urlsplit(my.path)
+    q = {k: v[0] for k, v in parse_qs(url.query).items()}
+    m = re.fullmatch(r'/storage/v1/b/[^/]+/o/([^/]+)', url.path)
+    if m:
+      return my._GetObject(unquote(m[1]), q)
+    if not re.fullmatch(r'/storage/v1/b/[^/]+/o', url.path):
+      return my._Reply(404)
+    prefix = q.get('prefix', '')
+    versions = q.get('versions') == 'true'
+    delim = q.get('delimiter')
+    items = [o for o in my.objects
+             if o['name'].startswith(prefix)
+             and (versions or 'timeDeleted' not in o)
+             and not (delim and delim in o['name'][len(prefix):])]
+    start = int(q.get('pageToken') or 0)
+    size = min(int(q.get('maxResults') or my.page_size), my.page_size)
+    page = {'items': items[start:start + size]}
+    if start + size < len(items):
+      page['nextPageToken'] = str(start + size)
+    my._ReplyJson(page)
+
+
+class FakeRegistry(_Handler):
+  """Just enough of the registry v2 API for miller.py, cns_assemble.py and the
+  delete_untagged_images cloud function: tokens, manifests, blobs, paginated
+  tag lists with the GCR extensions, pushing manifests under new tags, and
+  deletion of tags and of untagged manifests.
+
+  images: maps 'repo:tag' to the manifest digest.
+  untagged: maps repo to a dict of the digests of its untagged manifests to
+            their sizes in bytes.
+  manifests: maps digests to (media type * body) of manifests which have them;
+             others get a dummy body naming the digest.
+  blobs: maps digests to the content of blobs. Blob requests are redirected to
+         a storage URL on the same server, like GCR does.
+  require_token: reply 401 with a challenge to requests without a valid token.
+  revoke_after: once that many requests have been authorized, revoke all tokens
+                issued so far, as if they have expired; 0 for never.
+  faults: HTTP statuses to reply to the next requests instead of serving them,
+          one each; a 429 comes with 'Retry-After: 1'.
+  """
+  images = {}
+  untagged = {}
+  manifests = {}
+  blobs = {}
+  require_token = False
+  revoke_after = 0
+  faults = []
+  issued = 0      # Tokens are 'bench', then 'bench.1', 'bench.2'...
+  revoked = 0     # ...and these numbered below revoked are rejected.
+  authorized = 0
+
+  # Reply the next fault, if any, and return True if replied.
+  def _Fault(my) -> bool:
+    with my.lock:
+      code = my.faults and FakeRegistry.faults.pop(0)
+    if code:
+      my._Reply(code, headers={'Retry-After': '1'} if code == 429 else {})
+    return bool(code)
+
+  def _Token(my) -> None:
+    with my.lock:
+      n = FakeRegistry.issued
+      FakeRegistry.issued += 1
+    my._ReplyJson({'token': f"bench.{n}" if n else 'bench',
+                   'expires_in': 3600})
+
+  def _Authorized(my, repo:str) -> bool:
+    m = re.fullmatch(r'Bearer bench(?:\.(\d+))?',
+                     my.headers.get('Authorization', ''))
+    with my.lock:
+      valid = m and int(m[1] or 0) >= my.revoked
+      if valid:
+        FakeRegistry.authorized += 1
+        if my.revoke_after and my.authorized >= my.revoke_after:
+          FakeRegistry.revoked, FakeRegistry.revoke_after = my.issued, 0
+    if not my.require_token or valid:
+      return True
+    realm = f"http://{my.headers['Host']}/v2/token"
+    my._Reply(401, headers={'WWW-Authenticate':
+                            f'Bearer realm="{realm}",service="bench",'
+                            f'scope="repository:{repo}:pull"'})
+    return False
+
+  def _Manifest(my, repo:str, tag:str) -> None:
+    digest = tag if tag in my.manifests else my.images.get(f"{repo}:{tag}")
+    if not digest:
+      return my._Reply(404)
+    etag = f'"{digest}"'
+    if my.headers.get('If-None-Match') == etag:
+      return my._Reply(304, headers={'ETag': etag})
+    mtype, body = my.manifests.get(digest) or (
+      'application/vnd.docker.distribution.manifest.v2+json',
+      json.dumps({'schemaVersion': 2, 'digest': digest}).encode())
+    my._Reply(200, body, {'Content-Type': mtype,
+                          'Docker-Content-Digest': digest, 'ETag': etag})
+
+  # The tag list with the GCR extensions: 'manifest' maps digests to their tags
+  # and sizes, 'child' lists nested repositories. Manifests are paginated by n
+  # and last, in the order of digests, with a Link to the next page; children
+  # are all on the first page.
+  def _TagList(my, repo:str, q:dict) -> None:
+    manifest, children = {}, set()
+    for ref, digest in my.images.items():
+      r, __, tag = ref.rpartition(':')
+      if r == repo:
+        manifest.setdefault(digest, {'tag': []})['tag'].append(tag)
+    for digest, size in my.untagged.get(repo, {}).items():
+      manifest[digest] = {'tag': [], 'imageSizeBytes': str(size)}
+    for r in [ref.rpartition(':')[0] for ref in my.images] + [*my.untagged]:
+      if r.startswith(repo + '/'):
+        children.add(r[len(repo) + 1:].partition('/')[0])
+    last, n = q.get('last', ''), int(q.get('n') or len(manifest) or 1)
+    digests = [d for d in sorted(manifest) if d > last]
+    page = {d: manifest[d] for d in digests[:n]}
+    headers = {}
+    if len(digests) > n:
+      headers['Link'] = (f'</v2/{repo}/tags/list?n={n}&last={digests[n-1]}>; '
+                         'rel="next"')
+    my._Reply(200, json.dumps({
+      'name': repo, 'manifest': page,
+      'child': [] if last else sorted(children),
+      'tags': sorted(t for m in page.values() for t in m['tag'])}).encode(),
+              {'Content-Type': 'application/json', **headers})
+
+  def do_HEAD(my):
+    my.do_GET()
+
+  def do_GET(my):
+    my._Count()
+    url = urlsplit(my.path)
+    path = url.path
+    if path.startswith('/v2/') and my._Fault():
+      return None
+    if path == '/v2/token':
+      return my._Token()
+    m = re.fullmatch(r'/_storage/([^/]+)', path)
+    if m:
+      blob = my.blobs.get(m[1])
+      return my._ReplyMedia(blob) if blob else my._Reply(404)
+    m = re.fullmatch(r'/v2/(.+)/(manifests|blobs|tags)/([^/]+)', path)
+    if not m:
+      return my._Reply(404)
+    if not my._Authorized(m[1]):
+      return None
+    if m[2] == 'manifests':
+      return my._Manifest(m[1], m[3])
+    if m[2] == 'blobs':
+      return my._Reply(307 if m[3] in my.blobs else 404,
+                       headers={'Location': f"/_storage/{m[3]}"})
+    if m[3] == 'list':
+      return my._TagList(m[1], {k: v[0]
+                                for k, v in parse_qs(url.query).items()})
+    my._Reply(404)
+
+  # Push a manifest under a tag. A dummy body is that of the digest it names.
+  def do_PUT(my):
+    my._Count()
+    body = my.rfile.read(int(my.headers.get('Content-Length') or 0))
+    if my._Fault():
+      return None
+    m = re.fullmatch(r'/v2/(.+)/manifests/([^/]+)', urlsplit(my.path).path)
+    if not m:
+      return my._Reply(404)
+    if not my._Authorized(m[1]):
+      return None
+    digest = json.loads(body).get('digest')
+    if not digest:
+      digest = 'sha256:' + hashlib.sha256(body).hexdigest()
+      my.manifests[digest] = (my.headers['Content-Type'], body)
+    with my.lock:
+      my.untagged.get(m[1], {}).pop(digest, None)
+      my.images[f"{m[1]}:{m[2]}"] = digest
+    my._Reply(201, headers={'Docker-Content-Digest': digest})
+
+  # Deleting a manifest by a tag deletes only the tag, like GCR does, and the
+  # manifest becomes untagged with its last tag gone. Only untagged manifests
+  # can be deleted by digest; GCR refuses to delete tagged ones.
+  def do_DELETE(my):
+    my._Count()
+    if my._Fault():
+      return None
+    m = re.fullmatch(r'/v2/(.+)/manifests/([^/]+)', urlsplit(my.path).path)
+    if not m:
+      return my._Reply(404)
+    if not my._Authorized(m[1]):
+      return None
+    if not m[2].startswith('sha256:'):
+      with my.lock:
+        digest = my.images.pop(f"{m[1]}:{m[2]}", None)
+        if digest and not any(r.rpartition(':')[0] == m[1] and d == digest
+                              for r, d in my.images.items()):
+          my.untagged.setdefault(m[1], {})[digest] = 0
+      return my._Reply(202 if digest else 404)
+    with my.lock:
+      found = my.untagged.get(m[1], {}).pop(m[2], None) is not None
+    if found:
+      return my._Reply(202)
+    my._Reply(400 if m[2] in my.images.values() else 404)
+
+
+# Start a stand-in server on an ephemeral port, and return its base URL.
+def StartServer(handler) -> str:
+  srv = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+  srv.daemon_threads = True
+  threading.Thread(target=srv.serve_forever, daemon=True).start()
+  return f"http://127.0.0.1:{srv.server_address[1]}"
+
+
+# Start the stand-ins, and point miller.py to them. The project config and the
+# token are preset, so that the Cloud SDK is never called into.
+def UseStandIns(jobs:int) -> None:
+  miller.GCS_JSON_API = StartServer(FakeGcs) + '/storage/v1'
+  miller.REGISTRY_ENDPOINT = StartServer(FakeRegistry)
+  miller.g_gcs_api = 'json'
+  miller.g_jobs = jobs
+  miller.g_gtoken = 'Bearer bench'
+  miller.g_project, miller.gs_location = PROJECT, LOCATION
+  miller.gs_software = BUCKET
+
+
+# Fill the stand-ins with the artifacts of all targets of the Millfile text.
+def PopulateServers(millfile:str, generations:int, extra:int) -> None:
+  objects, images = [], {}
+  def add(name:str, version:str, deleted:bool) -> None:
+    o = {'name': f"{miller.TARBALLS_DIR}{name}",
+         'generation': str(1588000000000000 + len(objects)),
+         'metageneration': '1', 'metadata': {'version': version}}
+    if deleted:
+      o['timeDeleted'] = '2020-05-01T00:00:00.000Z'
+    objects.append(o)
+
+  for line in millfile.splitlines():
+    kind, name, ver = (line.split() + [None] * 3)[:3]
+    if kind == 'tar':
+      for g in range(generations):
+        add(f"{name}.tar.gz", f"0.{g}", deleted=True)
+      add(f"{name}.tar.gz", ver, deleted=False)
+    elif kind == 'image':
+      digest = 'sha256:' + hashlib.sha256(name.encode()).hexdigest()
+      images[f"{PROJECT}/{name}:{ver}"] = digest
+  for i in range(extra):
+    add(f"extra{i:06}.tar.gz", '1.0', deleted=False)
+  FakeGcs.objects = sorted(objects, key=lambda o: o['name'])
+  FakeRegistry.images = images
+
+#----- Measurement. ------------------------------------------------------------
+
+# Parse the Millfile, bypassing the compiled Millfile cache.
+def ParsePlan(path:str) -> miller.BuildPlan:
+  plan = miller.BuildPlan()
+  for rec in miller._tokenize(miller._read_real_files([path])):
+    plan.AddDirective(rec)
+  plan.FromCommandLineArgs(targets=None, force=None, rebuild_all=False)
+  return plan
+
+# Load the Millfile the way miller.py does. The cache file is read anew, as it
+# would be by a new miller.py process.
+def LoadPlan(path:str) -> miller.BuildPlan:
+  miller.g_plan_cache = miller.CacheFile('millfile-plans')
+  plan = miller.load_plan([path])
+  plan.FromCommandLineArgs(targets=None, force=None, rebuild_all=False)
+  return plan
+
+# Forget all artifact state, so that the next probe starts cold. Registry
+# tokens are kept: a real run would have them cached, too.
+def ColdProbes() -> None:
+  miller.g_artifact_state.Clear()
+  miller.g_tarball_index = miller.g_tarball_names = None
+
+# Forget the tarball index and the state of all name prefixes, but keep the
+# state of the whole directory with its object count. ratio replaces
+# PREFIX_LIST_RATIO: 0 always lists the name prefixes, inf never does.
+def StaleIndex(ratio:float) -> None:
+  where = f"gs://{BUCKET}/{miller.TARBALLS_DIR}"
+  miller.g_artifact_state.Put(
+    {}, expired=lambda k, v: k.startswith(where) and k != where)
+  miller.g_tarball_index = None
+  miller.PREFIX_LIST_RATIO = ratio
+
+
+# Call fn() repeat times, each preceded by prep(), and return a tuple of the
+# best wall time, the number of requests made by the last run, the peak memory
+# allocated during a separate traced run, and the result of the last run.
+def Measure(fn, repeat:int, prep=lambda: None):
+  best, res = math.inf, None
+  for __ in range(repeat):
+    prep()
+    _Handler.requests = 0
+    t = time.perf_counter()
+    res = fn()
+    best = min(best, time.perf_counter() - t)
+  nreq = _Handler.requests
+  prep()
+  tracemalloc.start()
+  try:
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+  return best, nreq, peak, res
+
+
+def _main() -> int:
+  p = ap.ArgumentParser(
+    description="Benchmark miller.py on synthetic input and local servers.")
+  a = p.add_argument
+  a('--sizes', default='100,1000',
+    help="Comma-separated numbers of targets. Default %(default)s.")
+  a('--shape', choices=SHAPES, default='layered',
+    help="Dependency graph shape. Default %(default)s.")
+  a('--fanin', type=int, default=3,
+    help="Max dependencies per target, for the layered shape.")
+  a('--image-every', metavar='K', type=int, default=5,
+    help="Make every K'th target an image, 0 for none. Default %(default)s.")
+  a('--generations', type=int, default=3,
+    help="Noncurrent generations per tarball. Default %(default)s.")
+  a('--extra-objects', metavar='N', type=int, default=0,
+    help="Unrelated objects in the tarballs directory. Default none.")
+  a('--latency', metavar='MS', type=float, default=20,
+    help="Response latency of the stand-ins. Default %(default)s.")
+  a('--page-size', type=int, default=1000,
+    help="Max GCS listing page size. Default %(default)s.")
+  a('--jobs', '-j', type=int, default=miller.g_jobs,
+    help="Concurrent artifact probes, as miller.py --jobs. "
+         "Default %(default)s.")
+  a('--repeat', type=int, default=3, help="Best of that many runs.")
+  o = p.parse_args()
+
+  _Handler.latency = o.latency / 1000
+  FakeGcs.page_size = o.page_size
+  UseStandIns(o.jobs)
+
+  print(f"{'targets':>8} {'phase':>7} {'ms':>9} {'requests':>9} "
+        f"{'peak,KiB':>9}")
+  with tempfile.TemporaryDirectory() as tmp:
+    # Do not touch the user's cache files.
+    os.environ['XDG_CACHE_HOME'] = tmp
+    for n in map(int, o.sizes.split(',')):
+      text = GenerateMillfile(n, o.shape, o.fanin, o.image_every)
+      path = os.path.join(tmp, f"Millfile.{n}")
+      with open(path, 'w') as f:
+        f.write(text)
+      PopulateServers(text, o.generations, o.extra_objects)
+      LoadPlan(path)  # Populate the compiled Millfile cache.
+
+      res = {}
+      res['parse'] = Measure(lambda: ParsePlan(path), o.repeat)
+      res['load'] = Measure(lambda: LoadPlan(path), o.repeat)
+      plan = res['parse'][-1]
+      res['order'] = Measure(plan.BuildOrder, o.repeat)
+      order = res['order'][-1]
+      res['build'] = Measure(lambda: plan.ConstructBuild(order), o.repeat,
+                             prep=ColdProbes)
+      res['gather'] = Measure(lambda: plan.ConstructGather(order), o.repeat,
+                              prep=ColdProbes)
+      # The gather phase has left the full directory state behind.
+      ratio = miller.PREFIX_LIST_RATIO
+      res['relist'] = Measure(lambda: plan.ConstructBuild(order), o.repeat,
+                              prep=lambda: StaleIndex(math.inf))
+      res['prefix'] = Measure(lambda: plan.ConstructBuild(order), o.repeat,
+                              prep=lambda: StaleIndex(0))
+      miller.PREFIX_LIST_RATIO = ratio
+      stale = sum(map(len, res['build'][-1]))
+      if stale:
+        print(f"WARNING: {stale} of {n} targets are out of date; the build "
+              f"phase did not measure what it should.", file=sys.stderr)
+      for phase in PHASES:
+        t, nreq, peak, __ = res[phase]
+        print(f"{n:8} {phase:>7} {1000*t:9.1f} {nreq:9} {peak/1024:9.0f}")
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(_main())
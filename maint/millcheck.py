@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- python-indent-offset: 2; -*-
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2020 Kirill 'kkm' Katsnelson
+
+# Regression checks of miller.py paths which the benchmark in millbench.py does
+# not exercise or cannot judge, run against the same local stand-ins. Each
+# check prints 'ok' or what is wrong, and the exit status is non-zero if any
+# has failed. A check that hangs is a failure, too: after --timeout seconds,
+# the stacks of all threads are dumped, and the process exits.
+#
+# Usage: maint/millcheck.py [--timeout 60] [CHECK...]
+
+import argparse as ap
+import faulthandler
+import os
+import sys
+import tempfile
+
+from typing import Optional as Opt
+
+import millbench as mb
+
+miller = mb.miller
+
+# Write a Millfile of n tarball targets into the directory tmp, put them with
+# the extra unrelated objects into the stand-in, and return the loaded plan.
+def _TarballPlan(tmp:str, n:int, extra:int) -> miller.BuildPlan:
+  text = mb.GenerateMillfile(n, 'wide')
+  path = os.path.join(tmp, f"Millfile.{n}")
+  with open(path, 'w') as f:
+    f.write(text)
+  mb.PopulateServers(text, generations=3, extra=extra)
+  return mb.LoadPlan(path)
+
+# Targets out of date in the build plan, with artifacts probed as miller.py
+# does it, from probe threads.
+def _Stale(plan:miller.BuildPlan) -> list:
+  return [t for rank in plan.ConstructBuild(plan.BuildOrder()) for t in rank]
+
+#----- Checks. -----------------------------------------------------------------
+
+# With the directory count cached by an earlier full listing, a plan with few
+# tarballs lists only their name prefixes, concurrently, from inside a probe
+# thread, and finds them all. This used to deadlock on g_lock.
+def CheckPrefixLookups(tmp:str) -> Opt[str]:
+  mb.ColdProbes()
+  plan = _TarballPlan(tmp, 20, extra=5000)
+  stale = _Stale(plan)
+  if stale:
+    return f"{len(stale)} targets out of date after a full listing"
+  # Keep the cached directory state, forget only the index.
+  miller.g_tarball_index = None
+  mb._Handler.requests = 0
+  stale = _Stale(plan)
+  where = f"gs://{mb.BUCKET}/{miller.TARBALLS_DIR}t"
+  prefixes = [k for k in miller.g_artifact_state.Load() if k.startswith(where)]
+  if stale:
+    return f"{len(stale)} targets out of date after prefix lookups"
+  if len(prefixes) != 20:
+    return f"{len(prefixes)} name prefixes were listed instead of 20"
+  if mb._Handler.requests > 20:
+    return f"{mb._Handler.requests} requests made for 20 prefixes"
+  return None
+
+# A noncurrent generation deleted since the last listing, which leaves the
+# current objects as they were, is not found again from the revalidated index.
+def CheckDeletedGeneration(tmp:str) -> Opt[str]:
+  mb.ColdProbes()
+  _TarballPlan(tmp, 5, extra=0)
+  index = miller._load_tarball_index('')
+  name = next(n for n, v in index if v == '0.0')
+  gone = [o for o in mb.FakeGcs.objects
+          if o['name'] == miller.TARBALLS_DIR + name and
+          o['metadata']['version'] == '0.0']
+  if len(gone) != 1:
+    return f"{len(gone)} generations of {name} version 0.0 in the stand-in"
+  mb.FakeGcs.objects = [o for o in mb.FakeGcs.objects if o is not gone[0]]
+  if (name, '0.0') in miller._load_tarball_index(''):
+    return f"deleted generation of {name} version 0.0 is still indexed"
+  return None
+
+# A noncurrent generation whose version metadatum has been corrected since the
+# last listing is found again under the new version, not the old one.
+def CheckNoncurrentMetadata(tmp:str) -> Opt[str]:
+  mb.ColdProbes()
+  _TarballPlan(tmp, 5, extra=0)
+  index = miller._load_tarball_index('')
+  name = next(n for n, v in index if v == '0.1')
+  obj = next(o for o in mb.FakeGcs.objects
+             if o['name'] == miller.TARBALLS_DIR + name and
+             o['metadata']['version'] == '0.1')
+  obj['metadata'] = {'version': '0.1.1'}
+  obj['metageneration'] = str(int(obj['metageneration']) + 1)
+  index = miller._load_tarball_index('')
+  if (name, '0.1') in index or (name, '0.1.1') not in index:
+    return f"old version metadatum of {name} is still indexed"
+  return None
+
+# Each request to the service sees what other processes have written to the
+# cache files since it last looked, e.g., a build time recorded by a one-shot
+# 'miller.py --record'.
+def CheckServeRefresh(tmp:str) -> Opt[str]:
+  history = miller.g_build_history
+  history.Get('')  # Load the snapshot, as an earlier request would.
+  miller.CacheFile(history.name).Put({'check': {'secs': [1], 'time': 0}})
+  if history.Get('check'):
+    return "the snapshot has changed without a refresh; the check is broken"
+  # The request drops the preset token and project config; restore them.
+  preset = (miller.g_gtoken, miller.g_project, miller.gs_location,
+            miller.gs_software)
+  resp = miller._serve_run(['--help'], tmp, {})
+  (miller.g_gtoken, miller.g_project, miller.gs_location,
+   miller.gs_software) = preset
+  if resp['status'] != 0:
+    return f"the request failed: {resp['stderr']}"
+  return None if history.Get('check') else "the service missed the record"
+
+# Stamping a rebuilt image untags the manifest it has superseded, which would
+# otherwise keep its build key tag forever, and never be reclaimed. Build key
+# tags of the other current images are left alone.
+def CheckRestamp(tmp:str) -> Opt[str]:
+  R = mb.FakeRegistry
+  repo = f"{mb.PROJECT}/restamp"
+  old, new, other = (f"sha256:{c * 64}" for c in '123')
+  R.images.update({f"{repo}:bk-k1": old, f"{repo}:bk-k0": old,
+                   f"{repo}:1.0": new, f"{repo}:2.0": other,
+                   f"{repo}:bk-k2": other})
+  art = miller.Artifact('image', f"{mb.LOCATION}.gcr.io/{repo}:1.0",
+                        revision=new)
+  miller.stamp_dispatch['image'](art, 'k3')
+  tags = sorted(r.rpartition(':')[2] for r in R.images if r.startswith(repo))
+  if tags != ['1.0', '2.0', 'bk-k2', 'bk-k3']:
+    return f"tags after stamping: {tags}"
+  if R.images[f"{repo}:bk-k3"] != new:
+    return "the build key tag is on a wrong manifest"
+  return None if old in R.untagged.get(repo, {}) else "old image not untagged"
+
+
+CHECKS = {'prefix-lookups': CheckPrefixLookups,
+          'deleted-generation': CheckDeletedGeneration,
+          'noncurrent-metadata': CheckNoncurrentMetadata,
+          'serve-refresh': CheckServeRefresh, 'restamp': CheckRestamp}
+
+def _main() -> int:
+  p = ap.ArgumentParser(
+    description="Check miller.py paths against local stand-ins.")
+  a = p.add_argument
+  a('checks', metavar='CHECK', nargs='*',
+    help=f"Checks to run: {', '.join(CHECKS)}. Default all.")
+  a('--timeout', metavar='SECS', type=float, default=60,
+    help="Consider a check hung after that long. Default %(default)s.")
+  o = p.parse_args()
+  unknown = set(o.checks) - set(CHECKS)
+  if unknown:
+    p.error(f"Unknown checks: {', '.join(sorted(unknown))}")
+
+  mb.UseStandIns(jobs=8)
+  failed = 0
+  with tempfile.TemporaryDirectory() as tmp:
+    # Do not touch the user's cache files.
+    os.environ['XDG_CACHE_HOME'] = tmp
+    for name in o.checks or CHECKS:
+      faulthandler.dump_traceback_later(o.timeout, exit=True)
+      err = CHECKS[name](tmp)
+      faulthandler.cancel_dump_traceback_later()
+      print(f"{name}: {err or 'ok'}")
+      failed += bool(err)
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(_main())
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- python-indent-offset: 2; -*-
+# SPDX-License-Identifier: Apache-2.0
+# Copyright 2020 Kirill 'kkm' Katsnelson
+
+# Checks of the delete_untagged_images cloud function against the local registry
+# stand-in of millbench.py, so that no project is needed. Each check sweeps a
+# synthetic registry with nested repositories, with more untagged images than
+# fit on one page of a tag list, and expects exactly the untagged images outside
+# of the 'gcf' repositories to be gone, and everything else to be left alone.
+# Images tagged only with build keys, 'bk-<key>', count as untagged.
+# Each check prints 'ok' or what is wrong, and the exit status is non-zero if
+# any has failed.
+#
+# Usage: maint/untaggedcheck.py [--timeout 60] [CHECK...]
+
+import argparse as ap
+import contextlib
+import faulthandler
+import hashlib
+import io
+import os
+import sys
+import time
+
+from typing import Optional as Opt
+
+import millbench as mb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'lib', 'functions',
+                                'delete_untagged_images'))
+import main as dui  # pylint: disable=wrong-import-position
+
+PROJECT = 'bench'
+LOCATION = 'us'
+
+# Repositories of the synthetic registry, with the numbers of their tagged and
+# untagged images. Nested ones are only found by walking the registry.
+REPOS = {'a': (2, 250), 'a/nested': (1, 5), 'b': (3, 0), 'c/d/e': (0, 7),
+         'gcf/fn': (1, 4)}
+
+def _Digest(repo:str, i:int) -> str:
+  return 'sha256:' + hashlib.sha256(f"{repo} {i}".encode()).hexdigest()
+
+# Fill the registry stand-in afresh, and reset its fault injection.
+def _Populate() -> None:
+  R = mb.FakeRegistry
+  R.images, R.untagged = {}, {}
+  for repo, (tagged, untagged) in REPOS.items():
+    repo = f"{PROJECT}/{repo}"
+    for i in range(tagged):
+      R.images[f"{repo}:1.{i}"] = _Digest(repo, i)
+    R.untagged[repo] = {_Digest(repo, -1 - i): 2**20 for i in range(untagged)}
+  R.require_token, R.revoke_after, R.faults = False, 0, []
+  R.issued = R.revoked = R.authorized = 0
+
+# Sweep the registry, quietly, and return what is wrong with the result.
+def _Sweep(images:Opt[list]=None) -> Opt[str]:
+  swept = [f"{PROJECT}/{r}" for r in images or REPOS if not r.startswith('gcf')]
+  live = {}
+  for ref, digest in mb.FakeRegistry.images.items():
+    repo, __, tag = ref.rpartition(':')
+    if repo not in swept or not tag.startswith(dui.BUILDKEY_TAG):
+      live[f"{repo}@{digest}"] = True
+  tagged = {ref: d for ref, d in mb.FakeRegistry.images.items()
+            if f"{ref.rpartition(':')[0]}@{d}" in live}
+  with contextlib.redirect_stdout(io.StringIO()):
+    try:
+      dui._delete_untagged_images(PROJECT, LOCATION, 'Bearer bench', images)
+    except Exception as e:  # The response dump is of little use here.
+      return str(e).partition('. Response was:')[0]
+  left = {r: len(d) for r, d in mb.FakeRegistry.untagged.items()
+          if d and r in swept}
+  if left:
+    return f"untagged images left: {left}"
+  stale = sorted(set(mb.FakeRegistry.images) - set(tagged))
+  if stale:
+    return f"build key tags left on superseded images: {stale}"
+  if mb.FakeRegistry.images != tagged:
+    return f"{len(set(tagged) - set(mb.FakeRegistry.images))} tags are gone"
+  gcf = len(mb.FakeRegistry.untagged[f"{PROJECT}/gcf/fn"])
+  if gcf != REPOS['gcf/fn'][1]:
+    return f"{REPOS['gcf/fn'][1] - gcf} images deleted from gcf/fn"
+  return None
+
+#----- Checks. -----------------------------------------------------------------
+
+# The full sweep walks nested repositories, and follows the Link to the next
+# page of a tag list.
+def CheckSweep() -> Opt[str]:
+  _Populate()
+  return _Sweep()
+
+# Only the given repositories are swept, as after a build.
+def CheckRepos() -> Opt[str]:
+  _Populate()
+  err = _Sweep(['a', 'c/d/e'])
+  if err:
+    return err
+  left = len(mb.FakeRegistry.untagged[f"{PROJECT}/a/nested"])
+  return None if left else "a nested repository has been swept, too"
+
+# Images rebuilt since they were stamped with build keys keep only their 'bk-'
+# tags, which are deleted with them. The build key tags of the current images,
+# and of any images in the 'gcf' repositories, are left alone.
+def CheckBuildKeys() -> Opt[str]:
+  _Populate()
+  R = mb.FakeRegistry
+  for repo in 'a', 'a/nested', 'gcf/fn':
+    repo = f"{PROJECT}/{repo}"
+    for ref, digest in list(R.images.items()):
+      if ref.startswith(repo + ':'):
+        R.images[f"{repo}:bk-{digest[7:31]}"] = digest
+    for i in range(3):
+      digest = _Digest(repo, 100 + i)
+      R.images[f"{repo}:bk-old{i}"] = digest
+      if i == 0:
+        R.images[f"{repo}:bk-older{i}"] = digest
+  err = _Sweep()
+  if err:
+    return err
+  left = sum(ref.startswith(f"{PROJECT}/gcf/fn:bk-old") for ref in R.images)
+  return None if left == 4 else "images deleted from gcf/fn"
+
+# Throttled and failed requests are retried with backoff, and a Retry-After of
+# 1 second is honored.
+def CheckRetries() -> Opt[str]:
+  _Populate()
+  mb.FakeRegistry.faults = [503, 429, 500, 502, 503]
+  start = time.monotonic()
+  err = _Sweep()
+  if err:
+    return err
+  if mb.FakeRegistry.faults:
+    return f"{len(mb.FakeRegistry.faults)} faults were not replied"
+  if time.monotonic() - start < 1:
+    return "Retry-After was not honored"
+  return None
+
+# Registry tokens expiring in the middle of the sweep are obtained again.
+def CheckTokenExpiry() -> Opt[str]:
+  _Populate()
+  mb.FakeRegistry.require_token = True
+  mb.FakeRegistry.revoke_after = 50
+  err = _Sweep()
+  if err:
+    return err
+  return None if mb.FakeRegistry.revoked else "no token was revoked"
+
+
+CHECKS = {'sweep': CheckSweep, 'repos': CheckRepos,
+          'build-keys': CheckBuildKeys, 'retries': CheckRetries,
+          'token-expiry': CheckTokenExpiry}
+
+def _main() -> int:
+  p = ap.ArgumentParser(
+    description="Check delete_untagged_images against a local registry.")
+  a = p.add_argument
+  a('checks', metavar='CHECK', nargs='*',
+    help=f"Checks to run: {', '.join(CHECKS)}. Default all.")
+  a('--timeout', metavar='SECS', type=float, default=60,
+    help="Consider a check hung after that long. Default %(default)s.")
+  o = p.parse_args()
+  unknown = set(o.checks) - set(CHECKS)
+  if unknown:
+    p.error(f"Unknown checks: {', '.join(sorted(unknown))}")
+
+  dui.REGISTRY_ENDPOINT = mb.StartServer(mb.FakeRegistry)
+  dui.BACKOFF_BASE = 0.01  # The retries check would take forever otherwise.
+  failed = 0
+  for name in o.checks or CHECKS:
+    faulthandler.dump_traceback_later(o.timeout, exit=True)
+    err = CHECKS[name]()
+    faulthandler.cancel_dump_traceback_later()
+    print(f"{name}: {err or 'ok'}")
+    failed += bool(err)
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(_main())